@@ -0,0 +1,259 @@
+"""Local stand-ins for the deSEC REST API and deSEC's authoritative nameservers, for benchmarking."""
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+NS_NAME = "ns1.desec.test."
+
+
+class FakeDesec(object):
+    """
+    In-memory deSEC account with zones and TXT RRsets, served over HTTP by `FakeDesecServer`.
+
+    :param latency: seconds every API request is delayed
+    :param throttle_rate: fraction of API requests answered with 429
+    :param retry_after: Retry-After value sent with 429 responses
+    :param page_size: number of domains per page of the domain list
+    """
+
+    def __init__(self, token, latency=0.0, throttle_rate=0.0, retry_after=1, page_size=500):
+        self.token = token
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.zones = {}  # name -> {'minimum_ttl', 'serial', 'rrsets': {subname: {'ttl', 'records'}}}
+        self.requests = {}  # (method, kind) -> count
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def add_zone(self, name, minimum_ttl=3600):
+        self.zones[name] = {'minimum_ttl': minimum_ttl, 'serial': 1, 'rrsets': {}}
+
+    def find_zone(self, qname):
+        labels = qname.rstrip('.').lower().split('.')
+        for i in range(len(labels)):
+            candidate = '.'.join(labels[i:])
+            if candidate in self.zones:
+                return candidate
+        return None
+
+    def count(self, method, kind):
+        with self.lock:
+            self.requests[method, kind] = self.requests.get((method, kind), 0) + 1
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def domain(self, name):
+        zone = self.zones[name]
+        return {'name': name, 'minimum_ttl': zone['minimum_ttl'], 'created': '2021-06-14T14:30:35.463899Z'}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are written separately
+    RRSET_PATH = re.compile(r"^/api/v1/domains/(?P<zone>[^/]+)/rrsets/(?P<subname>[^/]*)\.\.\./TXT/$")
+    RRSETS_PATH = re.compile(r"^/api/v1/domains/(?P<zone>[^/]+)/rrsets/$")
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        return b""
+
+    def _handle(self, method):
+        body = self._body()
+        url = urllib.parse.urlsplit(self.path)
+        match = self.RRSET_PATH.match(url.path) or self.RRSETS_PATH.match(url.path)
+        kind = 'rrset' if match else 'domains'
+        self.fake.count(method, kind)
+        time.sleep(self.fake.latency)
+        if self.headers.get("Authorization") != f"Token {self.fake.token}":
+            return self._send(401, {"detail": "Invalid token."})
+        if self.fake.throttle_rate and self.fake.random.random() < self.fake.throttle_rate:
+            return self._send(429, {"detail": "Request was throttled."},
+                              headers={"Retry-After": str(self.fake.retry_after)})
+
+        with self.fake.lock:
+            if url.path == "/api/v1/domains/" and method == 'GET':
+                return self._domains(urllib.parse.parse_qs(url.query, keep_blank_values=True))
+            if match and match.group('zone') not in self.fake.zones:
+                return self._send(404, {"detail": "Not found."})
+            if match and 'subname' in match.groupdict():
+                return self._rrset(method, match.group('zone'), match.group('subname'))
+            if match and method == 'PUT':
+                return self._bulk_write(match.group('zone'), json.loads(body))
+            if match and method == 'GET':
+                return self._rrsets(match.group('zone'), urllib.parse.parse_qs(url.query, keep_blank_values=True))
+        return self._send(405, {"detail": f"Method \"{method}\" not allowed."})
+
+    def _domains(self, query):
+        if 'owns_qname' in query:
+            zone = self.fake.find_zone(query['owns_qname'][0])
+            return self._send(200, [self.fake.domain(zone)] if zone else [])
+        return self._page([self.fake.domain(name) for name in sorted(self.fake.zones)], query, "/api/v1/domains/?")
+
+    def _rrsets(self, zone_name, query):
+        rrsets = self.fake.zones[zone_name]['rrsets']
+        items = [
+            {'subname': subname, 'type': 'TXT', 'ttl': rrset['ttl'], 'records': rrset['records']}
+            for subname, rrset in sorted(rrsets.items())
+        ] if query.get('type', ['TXT']) == ['TXT'] else []
+        return self._page(items, query, f"/api/v1/domains/{zone_name}/rrsets/?type=TXT&")
+
+    def _page(self, items, query, path):
+        if 'cursor' not in query:
+            if len(items) > self.fake.page_size:
+                return self._send(400, {"detail": "Pagination required. You can query up to 500 items at a time."})
+            return self._send(200, items)
+        start = int(query['cursor'][0] or 0)
+        headers = {}
+        if start + self.fake.page_size < len(items):
+            next_url = f"http://{self.headers['Host']}{path}cursor={start + self.fake.page_size}"
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return self._send(200, items[start:start + self.fake.page_size], headers=headers)
+
+    def _rrset(self, method, zone_name, subname):
+        zone = self.fake.zones[zone_name]
+        if method == 'GET':
+            rrset = zone['rrsets'].get(subname)
+            if rrset is None:
+                return self._send(404, {"detail": "Not found."})
+            return self._send(200, {'subname': subname, 'type': 'TXT', 'ttl': rrset['ttl'],
+                                    'records': rrset['records']})
+        if method == 'DELETE':
+            if zone['rrsets'].pop(subname, None) is not None:
+                zone['serial'] += 1
+            return self._send(204)
+        return self._send(405, {"detail": f"Method \"{method}\" not allowed."})
+
+    def _bulk_write(self, zone_name, rrsets):
+        zone = self.fake.zones[zone_name]
+        for rrset in rrsets:
+            if rrset['records']:
+                zone['rrsets'][rrset['subname']] = {'ttl': rrset['ttl'], 'records': list(rrset['records'])}
+            else:
+                zone['rrsets'].pop(rrset['subname'], None)
+        zone['serial'] += 1
+        return self._send(200, [rrset for rrset in rrsets if rrset['records']])
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeDesecServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the REST API of a `FakeDesec` account on localhost.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fake):
+        super(FakeDesecServer, self).__init__(("127.0.0.1", 0), _Handler)
+        self.fake = fake
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.server_port}/api/v1"
+
+
+class _DnsHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        sock.sendto(self.server.answer(query).to_wire(), self.client_address)
+
+
+class FakeNameserver(socketserver.ThreadingUDPServer):
+    """
+    Authoritative DNS stub on localhost answering NS, SOA and TXT queries from a `FakeDesec` account.
+
+    All zones are delegated to a single nameserver name that resolves to 127.0.0.1.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fake):
+        super(FakeNameserver, self).__init__(("127.0.0.1", 0), _DnsHandler)
+        self.fake = fake
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def answer(self, query):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        qname = question.name.to_text().rstrip('.').lower()
+        rdtype = question.rdtype
+
+        if qname == NS_NAME.rstrip('.'):
+            if rdtype == dns.rdatatype.A:
+                response.answer.append(dns.rrset.from_text(question.name, 60, 'IN', 'A', '127.0.0.1'))
+            return response
+
+        with self.fake.lock:
+            zone_name = self.fake.find_zone(qname)
+            if zone_name is None:
+                response.set_rcode(dns.rcode.REFUSED)
+                return response
+            zone = self.fake.zones[zone_name]
+            subname = qname[:-len(zone_name)].rstrip('.')
+            rrset = zone['rrsets'].get(subname)
+            if rdtype == dns.rdatatype.TXT and rrset:
+                response.answer.append(dns.rrset.from_text_list(question.name, rrset['ttl'], 'IN', 'TXT',
+                                                                rrset['records']))
+            elif rdtype == dns.rdatatype.NS and not subname:
+                response.answer.append(dns.rrset.from_text(question.name, 3600, 'IN', 'NS', NS_NAME))
+            elif rdtype == dns.rdatatype.SOA and not subname:
+                response.answer.append(dns.rrset.from_text(
+                    question.name, 300, 'IN', 'SOA',
+                    f"{NS_NAME} hostmaster.desec.test. {zone['serial']} 86400 3600 2419200 3600",
+                ))
+            elif not rrset and subname:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+        return response
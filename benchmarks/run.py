@@ -0,0 +1,139 @@
+"""
+Benchmarks perform and cleanup of the deSEC Authenticator against local stand-ins for the deSEC API and
+nameservers.
+
+For each number of challenge names, reports the wall time of perform plus cleanup, the number of API requests
+sent, and the peak memory allocated by Python during the run. Run from the repository root, e.g.::
+
+    python3 benchmarks/run.py --sizes 1 10 100 1000 --zones 50 --latency 0.005
+"""
+import argparse
+import functools
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from unittest import mock
+
+from acme import challenges
+from acme import messages
+from certbot import achallenges
+from certbot.tests import acme_util
+from cryptography.hazmat.primitives.asymmetric import rsa
+import josepy as jose
+
+from fakes import FakeDesec
+from fakes import FakeDesecServer
+from fakes import FakeNameserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from certbot_dns_desec import dns_desec  # noqa: E402
+
+TOKEN = "benchmark-token"
+
+
+def plugin_defaults():
+    """
+    Returns the default values of all command line options of the plugin, keyed by their config attribute.
+    """
+    defaults = {}
+
+    def add(name, **kwargs):
+        defaults[f"dns_desec_{name.replace('-', '_')}"] = kwargs.get('default')
+
+    dns_desec.Authenticator.add_parser_arguments(add)
+    return defaults
+
+
+def make_achalls(names, account_key):
+    return [
+        achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.chall_to_challb(challenges.DNS01(token=os.urandom(32)), messages.STATUS_PENDING),
+            account_key=account_key,
+            # certbot 4.0 replaced the domain argument with identifier
+            **({'identifier': messages.Identifier(typ=messages.IDENTIFIER_FQDN, value=name)}
+               if 'identifier' in achallenges.KeyAuthorizationAnnotatedChallenge.__slots__ else {'domain': name}),
+        )
+        for name in names
+    ]
+
+
+def run(size, args, account_key):
+    fake = FakeDesec(TOKEN, latency=args.latency, throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+                     page_size=args.page_size)
+    zones = [f"zone{i}.example" for i in range(min(args.zones, size))]
+    for zone in zones:
+        fake.add_zone(zone, minimum_ttl=60)
+    names = [f"host{i}.{zones[i % len(zones)]}" for i in range(size)]
+
+    api = FakeDesecServer(fake)
+    nameserver = FakeNameserver(fake)
+    for server in [api, nameserver]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        credentials = os.path.join(work_dir, "desec.ini")
+        with open(credentials, "w") as f:
+            f.write(f"dns_desec_token = {TOKEN}\ndns_desec_endpoint = {api.endpoint}\n")
+        os.chmod(credentials, 0o600)
+
+        config = types.SimpleNamespace(**plugin_defaults())
+        config.work_dir = work_dir
+        config.dns_desec_credentials = credentials
+        config.dns_desec_propagation_seconds = args.propagation_seconds
+        config.dns_desec_propagation_check = args.propagation_check
+        config.dns_desec_resolver_nameservers = "127.0.0.1"
+        config.dns_desec_rate_limit = ""  # the fake API is not rate limited, unless 429s are injected
+        config.dns_desec_async = args.use_async
+
+        auth = dns_desec.Authenticator(config, "dns-desec")
+        auth._get_resolver().resolver.port = nameserver.port  # pylint: disable=protected-access
+        achalls = make_achalls(names, account_key)
+
+        checker = functools.partial(dns_desec._PropagationChecker, port=nameserver.port)
+        with mock.patch.object(dns_desec, '_PropagationChecker', checker), \
+                mock.patch.object(dns_desec.display_util, 'notify'):
+            tracemalloc.start()
+            begin = time.perf_counter()
+            auth.perform(achalls)
+            auth.cleanup(achalls)
+            elapsed = time.perf_counter() - begin
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    for server in [api, nameserver]:
+        server.shutdown()
+        server.server_close()
+    leftover = sum(len(zone['rrsets']) for zone in fake.zones.values())
+    return elapsed, fake.total_requests(), peak, leftover
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="numbers of challenge names to benchmark")
+    parser.add_argument("--zones", type=int, default=50, help="number of zones the names are spread across")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds of latency per API request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of API requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After value of 429 responses")
+    parser.add_argument("--page-size", type=int, default=500, help="page size of the domain list")
+    parser.add_argument("--propagation-check", choices=["sleep", "txt", "soa"], default="txt")
+    parser.add_argument("--propagation-seconds", type=int, default=0)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asynchronous client")
+    args = parser.parse_args(argv)
+
+    account_key = jose.JWKRSA(key=rsa.generate_private_key(public_exponent=65537, key_size=2048))
+    print(f"{'names':>6} {'seconds':>9} {'requests':>9} {'req/name':>9} {'peak KiB':>9}")
+    for size in args.sizes:
+        elapsed, requests, peak, leftover = run(size, args, account_key)
+        print(f"{size:>6} {elapsed:>9.3f} {requests:>9} {requests / size:>9.2f} {peak / 1024:>9.0f}")
+        if leftover:
+            print(f"warning: {leftover} RRsets were not cleaned up", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,23 @@ Named Arguments
                                           to propagate before asking the ACME
                                           server to verify the DNS record.
                                           (Default: 120)  # TODO default, needed?
+``--dns-desec-propagation-check``         ``sleep`` (default) to always wait the
+                                          propagation time, ``txt`` to poll
+                                          deSEC's nameservers for the records
+                                          and stop waiting once all serve them,
+                                          ``soa`` to check one record per zone
+                                          and then wait for the zone's SOA
+                                          serial on all nameservers.
+``--dns-desec-challenge-ttl``             TTL of challenge TXT RRsets, in
+                                          seconds and/or ``<zone>:<seconds>``
+                                          entries. (Default: zone minimum)
+``--dns-desec-prestage``                  Only lower the TTL of existing
+                                          challenge RRsets, ahead of issuance.
+``--dns-desec-prune-stale``               Drop stale validations from written
+                                          RRsets, keeping at most this many.
+``--dns-desec-defer-cleanup``             Journal the challenge records for
+                                          later removal instead of removing
+                                          them during cleanup.
 ========================================  =====================================
 
 
@@ -31,6 +48,12 @@ access token obtained from the deSEC website.
    dns_desec_token = asdf
    dns_desec_endpoint = https://localhost:8080
 
+Zones held by other deSEC accounts can be assigned their own tokens with
+``dns_desec_zone_tokens``, a comma-separated list of ``<zone suffix>:<token>``
+entries such as ``example.org:tokenB, other.net:tokenC``. Each challenge uses
+the token of the longest matching suffix and ``dns_desec_token`` otherwise,
+which may be omitted if all zones are listed.
+
 The path to this file can be provided interactively or using the
 ``--dns-desec-credentials`` command-line argument. Certbot records the path
 to this file for use during renewal, but does not store the file's contents.
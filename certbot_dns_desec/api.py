@@ -0,0 +1,493 @@
+"""Client of the deSEC REST API, based on requests."""
+import email.utils
+import itertools
+import json
+import logging
+import random
+import time
+
+import requests
+import requests.adapters
+from certbot import errors
+
+from certbot_dns_desec import telemetry
+from certbot_dns_desec import txt
+
+logger = logging.getLogger(__name__)
+
+
+class ZoneIndex(object):
+    """
+    Longest-suffix index over a list of zones, implemented as a trie of reversed domain name labels.
+    """
+
+    _ZONE = object()  # trie key under which a node stores the zone ending there
+
+    def __init__(self, zones):
+        self.root = {}
+        for zone in zones:
+            node = self.root
+            for label in self._labels(zone['name']):
+                node = node.setdefault(label, {})
+            node[self._ZONE] = zone
+
+    @staticmethod
+    def _labels(name):
+        return reversed(name.rstrip('.').lower().split('.'))
+
+    def lookup(self, qname):
+        """
+        Returns the zone with the longest name that is a suffix of (or equal to) ``qname``, or None.
+        """
+        node, zone = self.root, None
+        for label in self._labels(qname):
+            node = node.get(label)
+            if node is None:
+                break
+            zone = node.get(self._ZONE, zone)
+        return zone
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and after which delay a deSEC API request is retried.
+
+    Throttled requests (429) are retried after the time given in their Retry-After header. Idempotent requests
+    are also retried on gateway errors (502, 503, 504) and transport errors, using exponential backoff with full
+    jitter unless the server sent a Retry-After header. No retry happens after ``max_attempts`` attempts or if
+    it would end after ``deadline`` seconds since the first attempt.
+
+    Each attempt times out after ``request_timeout`` seconds without progress on the connection, or earlier if
+    the deadline is closer; see `timeout`.
+    """
+
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+    RETRY_STATUS_CODES = {502, 503, 504}
+    MIN_REQUEST_TIMEOUT = 1
+
+    def __init__(self, max_attempts=4, deadline=600, backoff_base=1, backoff_cap=30, request_timeout=30):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.request_timeout = request_timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.waited = 0  # total seconds of delay handed out
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Parses a Retry-After header value given in seconds or as HTTP-date; returns None if it is invalid.
+        """
+        try:
+            return max(int(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def timeout(self, started):
+        """
+        Returns the timeout in seconds for an attempt, given the `time.monotonic` timestamp of the first attempt.
+
+        The timeout ends with the deadline, but leaves every attempt at least ``MIN_REQUEST_TIMEOUT`` seconds.
+        """
+        remaining = self.deadline - (time.monotonic() - started)
+        return max(min(self.request_timeout, remaining), self.MIN_REQUEST_TIMEOUT)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+
+    def delay(self, method, attempt, started, response=None, error=None):
+        """
+        Returns the number of seconds to wait before retrying, or None if the request must not be retried.
+
+        :param method: HTTP method of the request
+        :param attempt: number of the attempt that just finished, starting at 1
+        :param started: `time.monotonic` timestamp of the first attempt
+        :param response: the response, if any was received
+        :param error: the transport error, if no response was received
+        """
+        if attempt >= self.max_attempts:
+            return None
+        retry_after = None
+        if response is not None and 'Retry-After' in response.headers:
+            retry_after = self.parse_retry_after(response.headers['Retry-After'])
+
+        if error is not None:
+            if method not in self.IDEMPOTENT_METHODS:
+                return None
+            delay = self.backoff(attempt)
+            logger.debug("Request to deSEC API failed (%r). Retrying request after %.1fs.", error, delay)
+        elif response.status_code == 429:
+            if retry_after is None:
+                return None
+            delay = retry_after
+            logger.debug("deSEC API limit reached. Retrying request after %ss.", delay)
+        elif response.status_code in self.RETRY_STATUS_CODES and method in self.IDEMPOTENT_METHODS:
+            delay = self.backoff(attempt) if retry_after is None else retry_after
+            logger.debug("deSEC API unavailable (status %d). Retrying request after %.1fs.",
+                         response.status_code, delay)
+        else:
+            return None
+
+        if time.monotonic() + delay - started > self.deadline:
+            logger.debug("Not retrying, the retry deadline of %ss would be exceeded", self.deadline)
+            return None
+        self.waited += delay
+        return delay
+
+
+class DesecClientBase(object):
+    """
+    Transport-independent parts of the deSEC REST API clients: request building, caching and response handling.
+    """
+
+    def __init__(self, endpoint, token, zone_cache=None, rate_limiter=None, retry_policy=None, metrics=None):
+        logger.debug("creating %s", type(self).__name__)
+        self.endpoint = endpoint.rstrip('/')
+        self.token = token
+        self.zone_cache = zone_cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics or telemetry.Metrics()
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "application/json",
+        }
+
+    @staticmethod
+    def _operation(method, url):
+        """
+        Classifies a request for the metrics.
+        """
+        if 'owns_qname=' in url:
+            return 'zone_lookup'
+        if '/rrsets/?' in url:
+            return 'rrset_list'
+        if 'cursor=' in url:
+            return 'domain_list'
+        return 'rrset_read' if method == 'GET' else 'rrset_write'
+
+    def _split_cached(self, qnames):
+        zones = {}
+        uncached = []
+        for qname in dict.fromkeys(qnames):
+            zone = self.zone_cache.get(qname) if self.zone_cache else None
+            if zone:
+                logger.debug("Using cached zone %s for %s", zone['name'], qname)
+                zones[qname] = zone
+            else:
+                uncached.append(qname)
+        return zones, uncached
+
+    def _zone_from_response(self, qname, response):
+        self._check_response_status(response)
+        data = self._response_json(response)
+        try:
+            zone = data[0]
+        except IndexError:
+            raise errors.PluginError(f"Could not find suitable domain in your account (did you create it?): {qname}")
+        if self.zone_cache:
+            self.zone_cache.put(qname, zone)
+        return zone
+
+    def _zones_from_domains(self, qnames, domains):
+        logger.debug("Fetched %d domains", len(domains))
+        index = ZoneIndex(domains)
+        zones = {}
+        for qname in qnames:
+            zone = index.lookup(qname)
+            if zone is None:
+                raise errors.PluginError(
+                    f"Could not find suitable domain in your account (did you create it?): {qname}"
+                )
+            zones[qname] = zone
+            if self.zone_cache:
+                self.zone_cache.put(qname, zone)
+        return zones
+
+    def _txt_rrset_url(self, zone, subname):
+        return f"{self.endpoint}/domains/{zone['name']}/rrsets/{subname}.../TXT/"
+
+    def _txt_rrset_from_response(self, zone, response):
+        if response.status_code == 404:
+            return txt.TXTRecords()
+
+        self._check_response_status(response, domain=zone['name'])
+        data = self._response_json(response)
+        return txt.TXTRecords(data.get('records', ()), ttl=data.get('ttl'))
+
+    def _txt_rrsets_url(self, zone):
+        return f"{self.endpoint}/domains/{zone['name']}/rrsets/?type=TXT&cursor="
+
+    @staticmethod
+    def _txt_rrsets_from_list(subnames, rrsets):
+        rrsets = {rrset['subname']: rrset for rrset in rrsets}
+        return {
+            subname: txt.TXTRecords(rrsets[subname]['records'], ttl=rrsets[subname].get('ttl'))
+            if subname in rrsets else txt.TXTRecords()
+            for subname in subnames
+        }
+
+    def _rrsets_url(self, zone):
+        return f"{self.endpoint}/domains/{zone['name']}/rrsets/"
+
+    @staticmethod
+    def _single_deletion(rrsets):
+        """
+        Returns the subname if ``rrsets`` only asks for deleting a single RRset, None otherwise.
+        """
+        if len(rrsets) == 1:
+            subname, records = next(iter(rrsets.items()))
+            if not records:
+                return subname
+        return None
+
+    @staticmethod
+    def _rrsets_payload(zone, rrsets):
+        """
+        Returns the body of a bulk write: bytes if it is small, or else a `RRsetsBody` to stream it.
+        """
+        body = RRsetsBody(zone, rrsets)
+        chunks = iter(body)
+        first = next(chunks)
+        return body if next(chunks, None) is not None else first
+
+    def _check_zone_response(self, zone, response):
+        domain = zone['name']
+        if response.status_code == 404 and self.zone_cache:
+            # the zone is gone (or moved), so the cached lookups leading here are stale
+            self.zone_cache.invalidate_zone(domain)
+            self.zone_cache.save()
+        return self._check_response_status(response, domain=domain)
+
+    def _check_response_status(self, response, **kwargs):
+        if 200 <= response.status_code <= 299:
+            return
+        elif response.status_code in [401, 403]:
+            raise errors.PluginError(f"Could not authenticate against deSEC API: {response.content}")
+        elif response.status_code == 404:
+            raise errors.PluginError(f"Not found ({kwargs}): {response.content}")
+        elif response.status_code == 429:
+            raise errors.PluginError(f"deSEC throttled your request even after we waited the prescribed cool-down "
+                                     f"time. Did you use the API in parallel? {response.content}")
+        elif response.status_code >= 500:
+            raise errors.PluginError(f"deSEC API server error (status {response.status_code}): {response.content}")
+        else:
+            # requests calls the request payload body, httpx calls it content
+            body = getattr(response.request, 'body', None) or getattr(response.request, 'content', None)
+            raise errors.PluginError(f"Unknown error when talking to deSEC (status {response.status_code}: "
+                                     f"Request was on '{response.request.url}' with payload {body}. "
+                                     f"Response was '{response.content}'.")
+
+    def _response_json(self, response):
+        try:
+            return response.json()
+        except json.JSONDecodeError:
+            raise errors.PluginError(f"deSEC API sent non-JSON response (status {response.status_code}): "
+                                     f"{response.content}")
+
+
+class RRsetsBody(object):
+    """
+    Request body of a bulk RRset write, encoded as JSON one RRset at a time and sent in chunks of about
+    ``CHUNK_SIZE`` bytes, so that large writes are never built as one string.
+
+    It can be iterated any number of times, e.g. for retries; `asynchronous` returns a view for httpx's async client.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, zone, rrsets):
+        self.zone = zone
+        self.rrsets = rrsets
+
+    def __iter__(self):
+        parts, size = [b'['], 1
+        for i, (subname, records) in enumerate(self.rrsets.items()):
+            part = (b',' if i else b'') + json.dumps({
+                "subname": subname, "type": "TXT", "ttl": getattr(records, 'ttl', None) or self.zone['minimum_ttl'],
+                "records": list(records),
+            }).encode()
+            parts.append(part)
+            size += len(part)
+            if size >= self.CHUNK_SIZE:
+                yield b''.join(parts)
+                parts, size = [], 0
+        parts.append(b']')
+        yield b''.join(parts)
+
+    def asynchronous(self):
+        return AsyncRRsetsBody(self)
+
+    def __repr__(self):
+        return f"<{len(self.rrsets)} TXT RRsets of {self.zone['name']}>"
+
+
+class AsyncRRsetsBody(object):
+    """
+    Async iterable over the chunks of a `RRsetsBody`, which httpx would otherwise send synchronously.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        for chunk in self.body:
+            yield chunk
+
+    def __repr__(self):
+        return repr(self.body)
+
+
+class DesecConfigClient(DesecClientBase):
+    """
+    Encapsulates all communication with the deSEC REST API.
+    """
+
+    def __init__(self, endpoint, token, zone_cache=None, rate_limiter=None, retry_policy=None, metrics=None,
+                 pool_size=8):
+        super(DesecConfigClient, self).__init__(
+            endpoint, token, zone_cache=zone_cache, rate_limiter=rate_limiter, retry_policy=retry_policy,
+            metrics=metrics,
+        )
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # retries are up to the retry policy; connections are kept alive for reuse across requests
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def connections_opened(self):
+        """
+        Number of connections (i.e. TCP and TLS handshakes) the session has opened so far.
+        """
+        count = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+            if pools is not None:
+                count += sum(pools[key].num_connections for key in pools.keys())
+        return count
+
+    def close(self):
+        self.session.close()
+
+    def desec_request(self, method, category, **kwargs):
+        operation = self._operation(method, kwargs['url'])
+        started = time.monotonic()
+        for attempt in itertools.count(1):
+            if self.rate_limiter:
+                self.metrics.add('rate_limit_wait_seconds', self.rate_limiter.acquire(category))
+            begin = time.perf_counter()
+            try:
+                response: requests.Response = self.session.request(
+                    method, timeout=self.retry_policy.timeout(started), **kwargs,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            else:
+                error = None
+            self.metrics.observe_request(operation, response.status_code if error is None else 'error',
+                                         time.perf_counter() - begin)
+            delay = self.retry_policy.delay(method, attempt, started, response=response, error=error)
+            if delay is None:
+                if error:
+                    raise errors.PluginError(f"Could not connect to deSEC API: {error}")
+                return response
+            self.metrics.add('retry_wait_seconds', delay)
+            time.sleep(delay)
+
+    def desec_get(self, **kwargs):
+        return self.desec_request('GET', 'read', **kwargs)
+
+    def desec_put(self, **kwargs):
+        return self.desec_request('PUT', 'write', **kwargs)
+
+    def desec_delete(self, **kwargs):
+        return self.desec_request('DELETE', 'write', **kwargs)
+
+    def get_authoritative_zone(self, qname):
+        zones, uncached = self._split_cached([qname])
+        if zones:
+            return zones[qname]
+        response = self.desec_get(url=f"{self.endpoint}/domains/?owns_qname={qname}")
+        return self._zone_from_response(qname, response)
+
+    def get_authoritative_zones(self, qnames, list_threshold=10):
+        """
+        Looks up the zones responsible for several names.
+
+        Names not found in the zone cache are resolved one by one, unless there are more than ``list_threshold`` of
+        them, in which case all domains of the account are fetched once and matched locally.
+
+        :return: mapping of each given name to its zone
+        """
+        zones, uncached = self._split_cached(qnames)
+        if len(uncached) <= list_threshold:
+            zones.update({qname: self.get_authoritative_zone(qname) for qname in uncached})
+        else:
+            zones.update(self._zones_from_domains(uncached, self.get_domains()))
+        return zones
+
+    def get_domains(self):
+        """
+        Fetches all domains of the account, following the API's cursor pagination.
+        """
+        domains = []
+        url = f"{self.endpoint}/domains/?cursor="
+        while url:
+            response = self.desec_get(url=url)
+            self._check_response_status(response)
+            domains += self._response_json(response)
+            url = response.links.get('next', {}).get('url')
+        return domains
+
+    def get_txt_rrset(self, zone, subname):
+        response = self.desec_get(url=self._txt_rrset_url(zone, subname))
+        return self._txt_rrset_from_response(zone, response)
+
+    def get_txt_rrsets(self, zone, subnames):
+        """
+        Reads the TXT RRsets of several subnames of ``zone``.
+
+        A single RRset is read directly; several are read with one request listing all TXT RRsets of the zone
+        (following the API's cursor pagination), instead of one request per subname.
+
+        :return: mapping of each subname to its `txt.TXTRecords`, which are empty if the RRset does not exist
+        """
+        subnames = list(subnames)
+        if len(subnames) <= 1:
+            return {subname: self.get_txt_rrset(zone, subname) for subname in subnames}
+        rrsets = []
+        url = self._txt_rrsets_url(zone)
+        while url:
+            response = self.desec_get(url=url)
+            self._check_zone_response(zone, response)
+            rrsets += self._response_json(response)
+            url = response.links.get('next', {}).get('url')
+        return self._txt_rrsets_from_list(subnames, rrsets)
+
+    def set_txt_rrset(self, zone, subname, records: set):
+        return self.set_txt_rrsets(zone, {subname: records})
+
+    def set_txt_rrsets(self, zone, rrsets: dict):
+        """
+        Writes the TXT RRsets of several subnames of ``zone`` in a single bulk request.
+
+        An empty set of records deletes the RRset; if that is the only RRset to write, a DELETE request is used.
+
+        :param zone: zone as returned by `get_authoritative_zone`
+        :param rrsets: mapping of subname to the set of TXT records it should hold; the TTL is that of a
+            `txt.TXTRecords` value, or the zone's minimum TTL
+        """
+        if not rrsets:
+            return
+        subname = self._single_deletion(rrsets)
+        if subname is not None:
+            response = self.desec_delete(url=self._txt_rrset_url(zone, subname))
+        else:
+            response = self.desec_put(url=self._rrsets_url(zone), data=self._rrsets_payload(zone, rrsets))
+        return self._check_zone_response(zone, response)
@@ -0,0 +1,466 @@
+"""Tests for certbot_dns_desec.api."""
+
+import http.server
+import json
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import mock
+import requests
+import requests_mock
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+
+from certbot_dns_desec import api
+from certbot_dns_desec import txt
+from certbot_dns_desec.dns_desec_test import FAKE_TOKEN, FAKE_ENDPOINT
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = api.RetryPolicy(max_attempts=4, deadline=60, backoff_base=1, backoff_cap=5)
+
+    @staticmethod
+    def _response(status_code, retry_after=None):
+        return mock.MagicMock(status_code=status_code, headers={'Retry-After': retry_after} if retry_after else {})
+
+    def test_parse_retry_after(self):
+        self.assertEqual(self.policy.parse_retry_after("120"), 120)
+        with patch('time.time', return_value=1445412480):  # Wed, 21 Oct 2015 07:28:00 GMT
+            self.assertEqual(self.policy.parse_retry_after("Wed, 21 Oct 2015 07:28:42 GMT"), 42)
+            self.assertEqual(self.policy.parse_retry_after("Wed, 21 Oct 2015 07:27:00 GMT"), 0)
+        self.assertIsNone(self.policy.parse_retry_after("asdf"))
+
+    def test_throttled(self):
+        started = time.monotonic()
+        self.assertEqual(self.policy.delay('PUT', 1, started, response=self._response(429, '3')), 3)
+        self.assertIsNone(self.policy.delay('PUT', 1, started, response=self._response(429)))
+        self.assertIsNone(self.policy.delay('PUT', 4, started, response=self._response(429, '3')))
+        self.assertIsNone(self.policy.delay('PUT', 1, started, response=self._response(429, '61')))
+        self.assertEqual(self.policy.waited, 3)
+
+    @patch('random.uniform', side_effect=lambda low, high: high)
+    def test_server_errors(self, unused_patched_uniform):
+        started = time.monotonic()
+        self.assertEqual([self.policy.delay('GET', attempt, started, response=self._response(503))
+                          for attempt in range(1, 5)], [1, 2, 4, None])
+        self.assertEqual(self.policy.delay('GET', 1, started, response=self._response(502, '7')), 7)
+        self.assertEqual(self.policy.delay('GET', 2, started, response=self._response(504)), 2)
+        self.assertEqual(self.policy.backoff(10), 5)
+        self.assertIsNone(self.policy.delay('POST', 1, started, response=self._response(503)))
+        self.assertIsNone(self.policy.delay('GET', 1, started, response=self._response(500)))
+        self.assertIsNone(self.policy.delay('GET', 1, started, response=self._response(404)))
+        self.assertEqual(self.policy.waited, 1 + 2 + 4 + 7 + 2)
+
+    @patch('random.uniform', side_effect=lambda low, high: high)
+    def test_transport_errors(self, unused_patched_uniform):
+        started = time.monotonic()
+        self.assertEqual(self.policy.delay('PUT', 1, started, error=ConnectionResetError()), 1)
+        self.assertIsNone(self.policy.delay('POST', 1, started, error=ConnectionResetError()))
+        self.assertIsNone(self.policy.delay('PUT', 1, started - 60, error=ConnectionResetError()))
+
+    def test_timeout(self):
+        self.policy.request_timeout = 30
+        started = time.monotonic()
+        self.assertEqual(self.policy.timeout(started), 30)
+        self.assertAlmostEqual(self.policy.timeout(started - 50), 10, delta=1)
+        self.assertEqual(self.policy.timeout(started - 70), self.policy.MIN_REQUEST_TIMEOUT)
+
+
+class ZoneIndexTest(unittest.TestCase):
+    def test_lookup(self):
+        zones = [{'name': name} for name in ["example.com", "sub.example.com", "com.example", "Example.org"]]
+        index = api.ZoneIndex(zones)
+
+        self.assertEqual(index.lookup("example.com")['name'], "example.com")
+        self.assertEqual(index.lookup("_acme-challenge.example.com.")['name'], "example.com")
+        self.assertEqual(index.lookup("_acme-challenge.notsub.example.com")['name'], "example.com")
+        self.assertEqual(index.lookup("_acme-challenge.a.sub.example.com")['name'], "sub.example.com")
+        self.assertEqual(index.lookup("_acme-challenge.EXAMPLE.org")['name'], "Example.org")
+        self.assertIsNone(index.lookup("com"))
+        self.assertIsNone(index.lookup("otherexample.com"))
+
+
+class DesecConfigClientTest(unittest.TestCase):
+    record_name = "foo"
+    record_content = ["bar"]
+    record_ttl = 42
+
+    def setUp(self):
+        self.adapter = requests_mock.Adapter()
+
+        self.client = api.DesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN)
+        self.client.session.mount("mock", self.adapter)
+
+    def _register_response(self, url, response=None, requires_token=True, status=200):
+        def additional_matcher(request):
+            okay = True
+            okay &= request.headers["Content-Type"] == "application/json"
+            if requires_token:
+                okay &= request.headers["Authorization"] == f"Token {FAKE_TOKEN}"
+            return okay
+
+        self.adapter.register_uri(
+            method=requests_mock.ANY,
+            url=url,
+            text=json.dumps(response),
+            additional_matcher=additional_matcher,
+            status_code=status,
+        )
+
+    def test_get_authoritative_zone(self):
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/?owns_qname=_acme-challenge.{DOMAIN}",
+            response=[
+                {
+                    "created": "2021-06-14T14:30:35.463899Z",
+                    "minimum_ttl": 3600,
+                    "name": 'name.to.be.extracted',
+                    "published": "2021-06-14T14:30:35.772212Z",
+                    "touched": "2021-06-14T14:30:35.772212Z"
+                }
+            ]
+        )
+
+        zone = self.client.get_authoritative_zone(f"_acme-challenge.{DOMAIN}")
+        self.assertEqual(zone['name'], 'name.to.be.extracted')
+        self.assertEqual(zone['minimum_ttl'], 3600)
+
+    def test_get_authoritative_zone_cached(self):
+        from certbot_dns_desec.dns_desec import _ZoneCache
+
+        self.client.zone_cache = _ZoneCache(os.devnull, ttl=60)
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/?owns_qname=_acme-challenge.{DOMAIN}",
+            response=[{"name": DOMAIN, "minimum_ttl": 3600}],
+        )
+
+        for _ in range(3):
+            zone = self.client.get_authoritative_zone(f"_acme-challenge.{DOMAIN}")
+            self.assertEqual(zone, {"name": DOMAIN, "minimum_ttl": 3600})
+        self.assertEqual(self.adapter.call_count, 1)
+
+    def test_set_txt_rrsets_invalidates_cached_zone(self):
+        from certbot_dns_desec.dns_desec import _ZoneCache
+
+        self.client.zone_cache = _ZoneCache(os.devnull, ttl=60)
+        self.client.zone_cache.save = mock.MagicMock()
+        self.client.zone_cache.put(f"_acme-challenge.{DOMAIN}", {"name": DOMAIN, "minimum_ttl": 3600})
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            response={"detail": "Not found."},
+            status=404,
+        )
+
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrsets({'name': DOMAIN, 'minimum_ttl': 3600}, {"_acme-challenge": {'"a"'}})
+        self.assertIsNone(self.client.zone_cache.get(f"_acme-challenge.{DOMAIN}"))
+        self.client.zone_cache.save.assert_called_once_with()
+
+    def test_get_txt_rrsets_invalidates_cached_zone(self):
+        from certbot_dns_desec.dns_desec import _ZoneCache
+
+        self.client.zone_cache = _ZoneCache(os.devnull, ttl=60)
+        self.client.zone_cache.save = mock.MagicMock()
+        for qname in [f"_acme-challenge.{DOMAIN}", f"_acme-challenge.www.{DOMAIN}"]:
+            self.client.zone_cache.put(qname, {"name": DOMAIN, "minimum_ttl": 3600})
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/?type=TXT&cursor=",
+            response={"detail": "Not found."},
+            status=404,
+        )
+
+        with self.assertRaises(errors.PluginError):
+            self.client.get_txt_rrsets({'name': DOMAIN, 'minimum_ttl': 3600}, ["_acme-challenge", "_acme-challenge.www"])
+        self.assertIsNone(self.client.zone_cache.get(f"_acme-challenge.{DOMAIN}"))
+        self.assertIsNone(self.client.zone_cache.get(f"_acme-challenge.www.{DOMAIN}"))
+        self.client.zone_cache.save.assert_called_once_with()
+
+    def test_get_authoritative_zones_individually(self):
+        for qname, zone_name in [("a.example.com", "example.com"), ("b.example.org", "example.org")]:
+            self._register_response(
+                url=f"{FAKE_ENDPOINT}/domains/?owns_qname={qname}",
+                response=[{"name": zone_name, "minimum_ttl": 3600}],
+            )
+
+        zones = self.client.get_authoritative_zones(["a.example.com", "b.example.org", "a.example.com"])
+
+        self.assertEqual({qname: zone['name'] for qname, zone in zones.items()},
+                         {"a.example.com": "example.com", "b.example.org": "example.org"})
+        self.assertEqual(self.adapter.call_count, 2)
+
+    def test_get_authoritative_zones_from_domain_list(self):
+        self.adapter.register_uri(
+            'GET', f"{FAKE_ENDPOINT}/domains/?cursor=",
+            text=json.dumps([{"name": "example.com", "minimum_ttl": 3600}, {"name": "example.org", "minimum_ttl": 60}]),
+            headers={'Link': f'<{FAKE_ENDPOINT}/domains/?cursor=abc>; rel="next"'},
+        )
+        self.adapter.register_uri(
+            'GET', f"{FAKE_ENDPOINT}/domains/?cursor=abc",
+            text=json.dumps([{"name": "sub.example.com", "minimum_ttl": 300}]),
+        )
+        qnames = ["_acme-challenge.example.com", "_acme-challenge.www.example.com",
+                  "_acme-challenge.sub.example.com", "_acme-challenge.deep.sub.example.com", "example.org"]
+
+        zones = self.client.get_authoritative_zones(qnames, list_threshold=2)
+
+        self.assertEqual([zones[qname]['name'] for qname in qnames],
+                         ["example.com", "example.com", "sub.example.com", "sub.example.com", "example.org"])
+        self.assertEqual(self.adapter.call_count, 2)
+
+        with self.assertRaises(errors.PluginError):
+            self.client.get_authoritative_zones(["a.example.net", "b.example.net"], list_threshold=1)
+
+    def test_get_txt_rrsets(self):
+        zone = {'name': DOMAIN, 'minimum_ttl': self.record_ttl}
+        self.adapter.register_uri(
+            'GET', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/?type=TXT&cursor=",
+            text=json.dumps([{"subname": "a", "type": "TXT", "ttl": 60, "records": ['"x"']}]),
+            headers={'Link': f'<{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/?type=TXT&cursor=abc>; rel="next"'},
+        )
+        self.adapter.register_uri(
+            'GET', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/?type=TXT&cursor=abc",
+            text=json.dumps([{"subname": "c", "type": "TXT", "ttl": 3600, "records": ['"y"', '"z"']}]),
+        )
+
+        rrsets = self.client.get_txt_rrsets(zone, ["a", "b", "c"])
+
+        self.assertEqual(rrsets, {"a": {'"x"'}, "b": set(), "c": {'"y"', '"z"'}})
+        self.assertEqual([rrsets[subname].ttl for subname in "abc"], [60, None, 3600])
+        self.assertEqual(self.adapter.call_count, 2)  # one request per page, not per subname
+
+        self.adapter.register_uri('GET', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/b.../TXT/", status_code=404)
+        self.assertEqual(self.client.get_txt_rrsets(zone, ["b"]), {"b": set()})  # a single RRset is read directly
+        self.assertEqual(self.adapter.call_count, 3)
+
+    def test_set_txt_rrset(self):
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            response=[
+                {
+                    "created": "2021-05-13T09:38:41.576975Z",
+                    "domain": DOMAIN,
+                    "subname": "_acme_challenge",
+                    "name": self.record_name,
+                    "records": [self.record_content],
+                    "ttl": self.record_ttl,
+                    "type": "TXT",
+                    "touched": "2021-05-13T09:38:41.585257Z"
+                }
+            ]
+        )
+
+        self.client.set_txt_rrset(
+            {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+        )
+
+    def test_set_txt_rrsets(self):
+        self._register_response(url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/", response=[])
+
+        self.client.set_txt_rrsets(
+            {'name': DOMAIN, 'minimum_ttl': self.record_ttl},
+            {"a": {'"1"'}, "b": txt.TXTRecords({'"2"', '"3"'}, ttl=3600), "c": set()},
+        )
+
+        self.assertEqual(self.adapter.call_count, 1)
+        payload = json.loads(self.adapter.last_request.body)
+        self.assertEqual(
+            {rrset['subname']: (rrset['type'], rrset['ttl'], set(rrset['records'])) for rrset in payload},
+            {"a": ("TXT", 42, {'"1"'}), "b": ("TXT", 3600, {'"2"', '"3"'}), "c": ("TXT", 42, set())},
+        )
+
+    def test_rate_limiter(self):
+        self.client.rate_limiter = mock.MagicMock()
+        self._register_response(url=f"{FAKE_ENDPOINT}/domains/?owns_qname={DOMAIN}", response=[{"name": DOMAIN}])
+        self._register_response(url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/", response=[])
+
+        zone = self.client.get_authoritative_zone(DOMAIN)
+        self.client.set_txt_rrsets(zone | {'minimum_ttl': 3600}, {"": {'"a"'}})
+
+        self.assertEqual(self.client.rate_limiter.acquire.call_args_list, [mock.call('read'), mock.call('write')])
+
+    def test_metrics(self):
+        self.adapter.register_uri('GET', f"{FAKE_ENDPOINT}/domains/?owns_qname={DOMAIN}",
+                                  text=json.dumps([{"name": DOMAIN, "minimum_ttl": 60}]))
+        self.adapter.register_uri('PUT', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/", [
+            dict(status_code=429, headers={'Retry-After': '0'}), dict(status_code=200, text="[]"),
+        ])
+
+        zone = self.client.get_authoritative_zone(DOMAIN)
+        self.client.set_txt_rrsets(zone, {"": {'"a"'}})
+
+        summary = self.client.metrics.summary()
+        self.assertEqual(summary['requests'], [
+            {'operation': 'rrset_write', 'status': 200, 'count': 1},
+            {'operation': 'rrset_write', 'status': 429, 'count': 1},
+            {'operation': 'zone_lookup', 'status': 200, 'count': 1},
+        ])
+        self.assertEqual(summary['phases']['api_rrset_write']['count'], 2)
+
+    def test_connection_reuse(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = json.dumps({'records': ['"a"']}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = api.DesecConfigClient(f"http://127.0.0.1:{server.server_port}/api/v1", FAKE_TOKEN)
+        for subname in ["a", "b", "c"]:
+            client.get_txt_rrset({'name': DOMAIN, 'minimum_ttl': 60}, subname)
+        self.assertEqual(client.connections_opened, 1)
+        client.close()
+
+    def test_set_txt_rrsets_delete(self):
+        self.adapter.register_uri('DELETE', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/_acme-challenge.../TXT/",
+                                  status_code=204)
+
+        self.client.set_txt_rrsets({'name': DOMAIN, 'minimum_ttl': 3600}, {})
+        self.assertEqual(self.adapter.call_count, 0)
+        self.client.set_txt_rrsets({'name': DOMAIN, 'minimum_ttl': 3600}, {"_acme-challenge": set()})
+        self.assertEqual(self.adapter.call_count, 1)
+        self.assertEqual(self.adapter.last_request.method, 'DELETE')
+
+    def test_set_txt_rrset_fail_to_find_domain(self):
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            response={"detail": "Not found."},
+            status=404,
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrset(
+                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+            )
+
+    def test_set_txt_rrset_fail_to_authenticate(self):
+        self._register_response(
+            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            response={"detail": "Invalid token."},
+            status=403,
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrset(
+                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+            )
+
+    @patch('time.sleep', return_value=None)
+    def test_set_txt_rrset_throttling_retry(self, patched_time_sleep):
+        self.adapter.register_uri(
+            'PUT',
+            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            [
+                dict(status_code=429, headers={'Retry-After': '2'}),
+                dict(status_code=429, headers={'Retry-After': '31'}),
+                dict(status_code=200),
+            ]
+        )
+        self.client.set_txt_rrset(
+            {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+        )
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(2), mock.call(31)])
+
+    @patch('time.sleep', return_value=None)
+    @patch('certbot_dns_desec.api.RRsetsBody.CHUNK_SIZE', 100)
+    def test_set_txt_rrsets_streamed(self, patched_time_sleep):
+        bodies = []
+
+        def text(request, context):
+            bodies.append(b''.join(request.body))
+            return "[]"
+
+        self.adapter.register_uri('PUT', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/", [
+            dict(status_code=429, headers={'Retry-After': '1'}), dict(status_code=200, text=text),
+        ])
+        rrsets = {f"_acme-challenge.h{i}": {f'"{i}"'} for i in range(10)}
+
+        self.client.set_txt_rrsets({'name': DOMAIN, 'minimum_ttl': self.record_ttl}, rrsets)
+
+        self.assertGreater(len(list(self.adapter.last_request.body)), 1)  # sent in several chunks
+        self.assertEqual(
+            {rrset['subname']: set(rrset['records']) for rrset in json.loads(bodies[0])}, rrsets,
+        )
+
+    @patch('time.sleep', return_value=None)
+    def test_set_txt_rrset_throttling_retry_fail(self, patched_time_sleep):
+        self.adapter.register_uri(
+            'PUT',
+            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            [
+                dict(status_code=429, headers={'Retry-After': '2'}),
+            ] * 4
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrset(
+                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+            )
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(2)] * 3)
+
+    @patch('time.sleep', return_value=None)
+    def test_get_txt_rrset_server_error_retry(self, patched_time_sleep):
+        self.adapter.register_uri(
+            'GET',
+            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/{self.record_name}.../TXT/",
+            [
+                dict(exc=requests.ConnectionError),
+                dict(status_code=503, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+                dict(status_code=200, text=json.dumps({'records': ['"a"'], 'ttl': 3600})),
+            ]
+        )
+        records = self.client.get_txt_rrset({'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name)
+        self.assertEqual(records, {'"a"'})
+        self.assertEqual(records.ttl, 3600)
+        self.assertEqual(patched_time_sleep.call_count, 2)
+        self.assertEqual(patched_time_sleep.call_args_list[1], mock.call(0))
+        self.assertEqual(self.adapter.last_request.timeout, self.client.retry_policy.request_timeout)
+
+    @patch('time.sleep', return_value=None)
+    def test_get_txt_rrset_connection_error(self, patched_time_sleep):
+        self.adapter.register_uri(
+            'GET', f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/{self.record_name}.../TXT/", exc=requests.ConnectTimeout,
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.get_txt_rrset({'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name)
+        self.assertEqual(patched_time_sleep.call_count, 3)
+        self.assertEqual(self.client.retry_policy.waited, sum(c.args[0] for c in patched_time_sleep.call_args_list))
+
+    def test_set_txt_rrset_throttling_no_retry(self):
+        self.adapter.register_uri(
+            'PUT',
+            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            [
+                dict(status_code=429),  # no Retry-After header
+            ]
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrset(
+                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+            )
+        self.adapter.register_uri(
+            'PUT',
+            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
+            [
+                dict(status_code=429, headers={'Retry-After': 'asdf'}),  # Retry-After header not int
+            ]
+        )
+        with self.assertRaises(errors.PluginError):
+            self.client.set_txt_rrset(
+                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
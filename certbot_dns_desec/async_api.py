@@ -0,0 +1,182 @@
+"""asyncio client of the deSEC REST API, based on httpx, which is an optional dependency."""
+import asyncio
+import itertools
+import time
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from certbot import errors
+
+from certbot_dns_desec import api
+
+
+class AsyncDesecConfigClient(api.DesecClientBase):
+    """
+    asyncio variant of `api.DesecConfigClient`, based on httpx, with the same methods as coroutines.
+
+    Connections are pooled and kept alive; at most ``max_concurrency`` requests are in flight at any time.
+    """
+
+    def __init__(self, endpoint, token, zone_cache=None, rate_limiter=None, retry_policy=None, metrics=None,
+                 max_concurrency=8, http2=False):
+        if httpx is None:
+            raise errors.PluginError("The asynchronous deSEC client requires httpx, which can be installed with "
+                                     "'pip install certbot-dns-desec[async]'.")
+        super(AsyncDesecConfigClient, self).__init__(
+            endpoint, token, zone_cache=zone_cache, rate_limiter=rate_limiter, retry_policy=retry_policy,
+            metrics=metrics,
+        )
+        self.max_concurrency = max_concurrency
+        self.http2 = http2
+        self.transport = None  # may be set before first use, e.g. for testing
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def open(self):
+        """
+        Creates the connection pool, unless it is open already. It is bound to the running event loop, which all
+        further use of the client has to happen in until `aclose`.
+        """
+        if self._client is not None:
+            return
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._client = httpx.AsyncClient(
+            headers=self.headers,
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+            transport=self.transport,
+        )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = self._semaphore = None
+
+    async def desec_request(self, method, category, **kwargs):
+        operation = self._operation(method, kwargs['url'])
+        started = time.monotonic()
+        for attempt in itertools.count(1):
+            if self.rate_limiter:
+                waited = await asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.acquire, category)
+                self.metrics.add('rate_limit_wait_seconds', waited)
+            try:
+                async with self._semaphore:
+                    begin = time.perf_counter()
+                    response = await self._client.request(
+                        method, timeout=self.retry_policy.timeout(started), **kwargs,
+                    )
+            except httpx.TransportError as e:
+                response, error = None, e
+            else:
+                error = None
+            self.metrics.observe_request(operation, response.status_code if error is None else 'error',
+                                         time.perf_counter() - begin)
+            delay = self.retry_policy.delay(method, attempt, started, response=response, error=error)
+            if delay is None:
+                if error:
+                    raise errors.PluginError(f"Could not connect to deSEC API: {error!r}")
+                return response
+            self.metrics.add('retry_wait_seconds', delay)
+            await asyncio.sleep(delay)
+
+    async def desec_get(self, **kwargs):
+        return await self.desec_request('GET', 'read', **kwargs)
+
+    async def desec_put(self, **kwargs):
+        return await self.desec_request('PUT', 'write', **kwargs)
+
+    async def desec_delete(self, **kwargs):
+        return await self.desec_request('DELETE', 'write', **kwargs)
+
+    async def get_authoritative_zone(self, qname):
+        zones, uncached = self._split_cached([qname])
+        if zones:
+            return zones[qname]
+        response = await self.desec_get(url=f"{self.endpoint}/domains/?owns_qname={qname}")
+        return self._zone_from_response(qname, response)
+
+    async def get_authoritative_zones(self, qnames, list_threshold=10):
+        """
+        See `api.DesecConfigClient.get_authoritative_zones`; individual lookups are done concurrently.
+        """
+        zones, uncached = self._split_cached(qnames)
+        if len(uncached) <= list_threshold:
+            results = await asyncio.gather(*(self.get_authoritative_zone(qname) for qname in uncached))
+            zones.update(zip(uncached, results))
+        else:
+            zones.update(self._zones_from_domains(uncached, await self.get_domains()))
+        return zones
+
+    async def get_domains(self):
+        domains = []
+        url = f"{self.endpoint}/domains/?cursor="
+        while url:
+            response = await self.desec_get(url=url)
+            self._check_response_status(response)
+            domains += self._response_json(response)
+            url = response.links.get('next', {}).get('url')
+        return domains
+
+    async def get_txt_rrset(self, zone, subname):
+        response = await self.desec_get(url=self._txt_rrset_url(zone, subname))
+        return self._txt_rrset_from_response(zone, response)
+
+    async def get_txt_rrsets(self, zone, subnames):
+        """
+        See `api.DesecConfigClient.get_txt_rrsets`.
+        """
+        subnames = list(subnames)
+        if len(subnames) <= 1:
+            return {subname: await self.get_txt_rrset(zone, subname) for subname in subnames}
+        rrsets = []
+        url = self._txt_rrsets_url(zone)
+        while url:
+            response = await self.desec_get(url=url)
+            self._check_zone_response(zone, response)
+            rrsets += self._response_json(response)
+            url = response.links.get('next', {}).get('url')
+        return self._txt_rrsets_from_list(subnames, rrsets)
+
+    async def set_txt_rrset(self, zone, subname, records: set):
+        return await self.set_txt_rrsets(zone, {subname: records})
+
+    async def set_txt_rrsets(self, zone, rrsets: dict):
+        if not rrsets:
+            return
+        subname = self._single_deletion(rrsets)
+        if subname is not None:
+            response = await self.desec_delete(url=self._txt_rrset_url(zone, subname))
+        else:
+            payload = self._rrsets_payload(zone, rrsets)
+            if isinstance(payload, api.RRsetsBody):
+                payload = payload.asynchronous()
+            response = await self.desec_put(url=self._rrsets_url(zone), content=payload)
+        return self._check_zone_response(zone, response)
+
+
+class BlockingClient(object):
+    """
+    Exposes the RRset methods of an `AsyncDesecConfigClient` to a worker thread, blocking until ``loop`` ran them.
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def get_txt_rrsets(self, zone, subnames):
+        return self._run(self.client.get_txt_rrsets(zone, subnames))
+
+    def set_txt_rrsets(self, zone, rrsets):
+        return self._run(self.client.set_txt_rrsets(zone, rrsets))
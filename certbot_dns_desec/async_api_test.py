@@ -0,0 +1,129 @@
+"""Tests for certbot_dns_desec.async_api."""
+
+import asyncio
+import json
+import unittest
+from unittest.mock import patch
+
+import mock
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+
+from certbot_dns_desec import async_api
+from certbot_dns_desec.dns_desec_test import FAKE_TOKEN, FAKE_ENDPOINT
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class AsyncDesecConfigClientTest(unittest.IsolatedAsyncioTestCase):
+    zone = {'name': DOMAIN, 'minimum_ttl': 42}
+
+    async def asyncSetUp(self):
+
+        self.responses = []
+        self.requests = []
+        self.client = async_api.AsyncDesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN, max_concurrency=2)
+        self.client.transport = httpx.MockTransport(self._handle)
+        await self.client.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.client.__aexit__(None, None, None)
+
+    def _handle(self, request):
+        self.assertEqual(request.headers["Authorization"], f"Token {FAKE_TOKEN}")
+        self.assertEqual(request.headers["Content-Type"], "application/json")
+        self.requests.append(request)
+        return self.responses.pop(0)
+
+    async def test_get_authoritative_zones(self):
+        self.responses = [httpx.Response(200, json=[{'name': DOMAIN, 'minimum_ttl': 3600}])] * 2
+
+        zones = await self.client.get_authoritative_zones([f"a.{DOMAIN}", f"b.{DOMAIN}"])
+
+        self.assertEqual({qname: zone['name'] for qname, zone in zones.items()},
+                         {f"a.{DOMAIN}": DOMAIN, f"b.{DOMAIN}": DOMAIN})
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_get_txt_rrset(self):
+        self.responses = [httpx.Response(200, json={'records': ['"a"', '"b"']}), httpx.Response(404)]
+
+        self.assertEqual(await self.client.get_txt_rrset(self.zone, "_acme-challenge"), {'"a"', '"b"'})
+        self.assertEqual(await self.client.get_txt_rrset(self.zone, "_acme-challenge"), set())
+        self.assertEqual(str(self.requests[0].url), f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/_acme-challenge.../TXT/")
+
+    async def test_get_txt_rrsets_invalidates_cached_zone(self):
+        from certbot_dns_desec.dns_desec import _ZoneCache
+
+        self.client.zone_cache = _ZoneCache(os.devnull, ttl=60)
+        self.client.zone_cache.save = mock.MagicMock()
+        self.client.zone_cache.put(f"_acme-challenge.{DOMAIN}", self.zone)
+        self.responses = [httpx.Response(404, json={"detail": "Not found."})]
+
+        with self.assertRaises(errors.PluginError):
+            await self.client.get_txt_rrsets(self.zone, ["_acme-challenge", "_acme-challenge.www"])
+        self.assertIsNone(self.client.zone_cache.get(f"_acme-challenge.{DOMAIN}"))
+        self.assertEqual(self.requests[0].url.path, f"/domains/{DOMAIN}/rrsets/")
+
+    async def test_set_txt_rrsets(self):
+        self.responses = [httpx.Response(200, json=[]), httpx.Response(403, json={"detail": "Invalid token."})]
+
+        await self.client.set_txt_rrsets(self.zone, {"a": {'"1"'}})
+        self.assertEqual(json.loads(self.requests[0].content),
+                         [{"subname": "a", "type": "TXT", "ttl": 42, "records": ['"1"']}])
+        with self.assertRaises(errors.PluginError):
+            await self.client.set_txt_rrsets(self.zone, {"a": {'"1"'}})
+
+    @patch('certbot_dns_desec.api.RRsetsBody.CHUNK_SIZE', 100)
+    async def test_set_txt_rrsets_streamed(self):
+        self.responses = [httpx.Response(200, json=[])]
+        rrsets = {f"_acme-challenge.h{i}": {f'"{i}"'} for i in range(10)}
+
+        await self.client.set_txt_rrsets(self.zone, rrsets)
+
+        self.assertEqual(self.requests[0].headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual({rrset['subname']: set(rrset['records']) for rrset in json.loads(self.requests[0].content)},
+                         rrsets)
+
+    async def test_set_txt_rrsets_delete(self):
+        self.responses = [httpx.Response(204)]
+
+        await self.client.set_txt_rrsets(self.zone, {})
+        await self.client.set_txt_rrsets(self.zone, {"a": set()})
+        self.assertEqual([(r.method, r.url.path) for r in self.requests],
+                         [('DELETE', f"/domains/{DOMAIN}/rrsets/a.../TXT/")])
+
+    @patch('asyncio.sleep', return_value=None)
+    async def test_throttling_retry(self, patched_sleep):
+        self.responses = [
+            httpx.Response(429, headers={'Retry-After': '2'}),
+            httpx.Response(429, headers={'Retry-After': '31'}),
+            httpx.Response(200, json=[]),
+        ]
+
+        await self.client.set_txt_rrsets(self.zone, {"a": {'"1"'}})
+        self.assertEqual(patched_sleep.call_args_list, [mock.call(2), mock.call(31)])
+        self.assertEqual(self.requests[0].extensions['timeout']['read'], self.client.retry_policy.request_timeout)
+
+    async def test_concurrency_limit(self):
+
+        in_flight = []
+
+        async def handler(request):
+            in_flight.append(request)
+            self.assertLessEqual(len(in_flight), 2)
+            await asyncio.sleep(0.01)
+            in_flight.remove(request)
+            return httpx.Response(404)
+
+        client = async_api.AsyncDesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN, max_concurrency=2)
+        client.transport = httpx.MockTransport(handler)
+        async with client:
+            await asyncio.gather(*(client.get_txt_rrset(self.zone, str(i)) for i in range(6)))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,268 @@
+"""
+Batch mode: adds and removes many TXT records at deSEC from a manifest, outside of certbot.
+
+The manifest is read as a stream, one record per line, either as JSON lines::
+
+    {"name": "_acme-challenge.example.com", "value": "<token>", "op": "add"}
+
+or as CSV with the columns ``name,value,op`` (an optional header row is skipped). ``op`` is ``add`` (the default)
+or ``remove``. Lines are processed in chunks; within each chunk, all changes of a zone are applied with one read of
+the zone's TXT RRsets and one bulk write, so memory use does not grow with the size of the manifest.
+
+With ``--prestage``, the TTL of the existing TXT RRsets at the manifest's names is only lowered to the challenge TTL,
+so that the manifest can be applied without resolvers caching the RRsets with their original TTL.
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import sys
+import time
+
+from certbot import errors
+
+from certbot_dns_desec import api
+from certbot_dns_desec import cli
+from certbot_dns_desec import dns_desec
+from certbot_dns_desec import txt
+
+logger = logging.getLogger(__name__)
+
+
+def read_manifest(lines, fmt):
+    """
+    Parses manifest lines lazily.
+
+    :param lines: iterable of text lines
+    :param fmt: ``jsonl`` or ``csv``
+    :return: iterator of ``(line number, name, value, op)``; fields of lines that cannot be parsed are None
+    """
+    if fmt == 'csv':
+        for lineno, row in enumerate(csv.reader(lines), 1):
+            row = [field.strip() for field in row]
+            if not row or (lineno == 1 and row[0] == 'name'):
+                continue
+            if len(row) == 2:
+                row.append('add')
+            yield (lineno, *row) if len(row) == 3 else (lineno, None, None, None)
+        return
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            yield lineno, entry['name'], entry['value'], entry.get('op', 'add')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield lineno, None, None, None
+
+
+class BatchRunner(object):
+    """
+    Applies manifest entries chunk by chunk through a `api.DesecConfigClient`, collecting per-zone statistics.
+
+    :param client: the API client used for all requests
+    :param rrset_locks: `locking.RRsetLocks` shared with certbot processes on the host
+    :param zone_list_threshold: if a chunk has more names than this, the account's domain list is fetched once and
+        used for all further zone lookups
+    :param resolver: `dns_desec._CnameResolver` factory used to follow CNAMEs of the names, or None
+    :param challenge_ttls: `dns_desec._ChallengeTTLs` choosing the TTL of written RRsets, or None for the zone's
+        minimum TTL
+    :param prune_stale: see ``--dns-desec-prune-stale``
+    :param prestage: instead of applying the entries, only lower the TTL of the existing TXT RRsets at their names to
+        the challenge TTL, see ``--dns-desec-prestage``; requires ``challenge_ttls``
+    """
+
+    def __init__(self, client, rrset_locks, zone_list_threshold=10, resolver=None, challenge_ttls=None,
+                 prune_stale=None, prestage=False):
+        self.client = client
+        self.rrset_locks = rrset_locks
+        self.zone_list_threshold = zone_list_threshold
+        self.resolver = resolver
+        self.challenge_ttls = challenge_ttls
+        self.prune_stale = prune_stale
+        self.prestage = prestage
+        self.index = None  # api.ZoneIndex over the account's domains, once fetched
+        self.stats = {}  # zone name -> {'changes', 'writes', 'seconds'}
+        self.original_ttls = {}  # name -> TTL it had before pre-staging lowered it
+        self.failed = 0
+
+    def _fail(self, lineno, reason):
+        logger.error("Line %s: %s", lineno, reason)
+        self.failed += 1
+
+    def _zones(self, names):
+        """
+        Returns the zone of each name, or None if it has none.
+        """
+        if self.index is None and len(names) > self.zone_list_threshold:
+            self.index = api.ZoneIndex(self.client.get_domains())
+        if self.index is not None:
+            return {name: self.index.lookup(name) for name in names}
+        zones = {}
+        for name in names:
+            try:
+                zones[name] = self.client.get_authoritative_zone(name)
+            except errors.PluginError as e:
+                logger.debug("Zone lookup for %s failed: %s", name, e)
+                zones[name] = None
+        return zones
+
+    def run(self, entries, chunk_size=1000):
+        """
+        Applies all entries.
+
+        :param entries: iterable of ``(line number, name, value, op)``, see `read_manifest`
+        :return: True if all entries were applied, False otherwise
+        """
+        entries = iter(entries)
+        while True:
+            chunk = list(itertools.islice(entries, chunk_size))
+            if not chunk:
+                return not self.failed
+            self.apply_chunk(chunk)
+
+    def apply_chunk(self, chunk):
+        valid = []
+        for lineno, name, value, op in chunk:
+            set_operator = txt.OPERATORS.get(op) if isinstance(op, str) else None
+            if self.prestage and name and isinstance(name, str):
+                # an empty addition, so that changes queued by other processes are written along
+                valid.append((lineno, name.rstrip('.').lower(), None, set.union))
+            elif not (name and isinstance(name, str) and value and isinstance(value, str) and set_operator):
+                self._fail(lineno, "expected a name, a value and an op 'add' or 'remove'")
+            else:
+                valid.append((lineno, name.rstrip('.').lower(), value, set_operator))
+        names = list(dict.fromkeys(name for _, name, _, _ in valid))
+        targets = self.resolver().resolve_all(names) if self.resolver else {name: name for name in names}
+        zones_by_name = self._zones(list(dict.fromkeys(targets.values())))
+
+        zones, changes, linenos = {}, {}, {}  # zone name -> zone, subname -> [(set_operator, values)], line numbers
+        for lineno, name, value, set_operator in valid:
+            zone = zones_by_name[targets[name]]
+            if zone is None:
+                self._fail(lineno, f"no zone in the deSEC account contains {targets[name]}")
+                continue
+            zones[zone['name']] = zone
+            operations = changes.setdefault(zone['name'], {}).setdefault(
+                txt.relative_name(targets[name], zone['name']), [],
+            )
+            values = {f'"{value}"'} if value is not None else set()
+            if operations and operations[-1][0] is set_operator:
+                operations[-1][1].update(values)
+            else:
+                operations.append((set_operator, values))
+            linenos.setdefault(zone['name'], []).append(lineno)
+
+        for zone_name, zone_changes in changes.items():
+            zone = zones[zone_name]
+            begin = time.perf_counter()
+            try:
+                self.write_zone(zone, zone_changes)
+            except errors.PluginError as e:
+                for lineno in linenos[zone_name]:
+                    self._fail(lineno, f"could not write to {zone_name}: {e}")
+            else:
+                stats = self.stats.setdefault(zone_name, {'changes': 0, 'writes': 0, 'seconds': 0.0})
+                stats['changes'] += len(linenos[zone_name])
+                stats['writes'] += 1
+                stats['seconds'] += time.perf_counter() - begin
+                logger.info("Applied %d change(s) to %s", len(linenos[zone_name]), zone_name)
+        if self.client.zone_cache:
+            self.client.zone_cache.save()  # also evicts entries, bounding the cache's memory use
+
+    def write_zone(self, zone, changes):
+        """
+        Applies changes to TXT RRsets of one zone with a single bulk write.
+
+        :param changes: mapping of subname to a list of ``(set_operator, values)`` to apply in order
+        """
+        _, _, original_ttls = dns_desec._write_txt_rrsets(
+            self.client, self.rrset_locks, zone, changes,
+            challenge_ttls=self.challenge_ttls, prune_stale=self.prune_stale, lower_ttls=self.prestage,
+        )
+        self.original_ttls.update(original_ttls)
+
+    def drain(self, journal):
+        """
+        Removes the challenge records whose cleanup certbot deferred, see `cleanup_journal.CleanupJournal.drain`.
+        """
+        return journal.drain(
+            self._zones,
+            lambda zone, subnames: self.write_zone(
+                zone, {subname: [(set.difference, values)] for subname, values in subnames.items()},
+            ),
+        )
+
+    def report(self, out):
+        """
+        Writes a table of the per-zone statistics.
+        """
+        out.write(f"{'zone':<40} {'changes':>8} {'writes':>7} {'seconds':>9}\n")
+        for zone_name, stats in sorted(self.stats.items()):
+            out.write(f"{zone_name:<40} {stats['changes']:>8} {stats['writes']:>7} {stats['seconds']:>9.3f}\n")
+        if self.failed:
+            out.write(f"{self.failed} line(s) failed\n")
+        if self.original_ttls:
+            out.write(f"Lowered the TTL of {', '.join(sorted(self.original_ttls))}. Resolvers may serve cached copies "
+                      f"for up to {max(self.original_ttls.values())} seconds.\n")
+        elif self.prestage and not self.failed:
+            out.write("No TXT RRset has a TTL above the challenge TTL.\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="certbot-dns-desec-batch",
+        description="Add and remove many TXT records at deSEC from a JSON lines or CSV manifest of "
+                    "(name, value, op) entries.",
+    )
+    parser.add_argument("manifest", nargs="?", default="-", help="manifest file, or - for standard input (default)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None,
+                        help="manifest format (default: csv for files ending in .csv, jsonl otherwise)")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="number of manifest lines that are grouped by zone and written together")
+    parser.add_argument("--follow-cnames", action="store_true",
+                        help="write the records at the end of the CNAME chain of each name")
+    parser.add_argument("--prestage", action="store_true",
+                        help="instead of applying the manifest, only lower the TTL of the existing TXT RRsets at its "
+                             "names to the challenge TTL; run this well before applying the manifest")
+    parser.add_argument("--drain-cleanup", action="store_true",
+                        help="instead of reading a manifest, remove the challenge records whose cleanup certbot "
+                             "deferred (--dns-desec-defer-cleanup)")
+    cli.add_client_arguments(parser)
+    args = parser.parse_args(argv)
+    cli.setup_logging(args)
+    fmt = args.format or ('csv' if args.manifest.endswith('.csv') else 'jsonl')
+
+    client = cli.client_from_args(parser, args)
+    runner = BatchRunner(
+        client, cli.rrset_locks_from_args(args), zone_list_threshold=args.zone_list_threshold,
+        resolver=dns_desec._CnameResolver if args.follow_cnames else None,
+        challenge_ttls=cli.challenge_ttls_from_args(parser, args), prune_stale=args.prune_stale,
+        prestage=args.prestage,
+    )
+    if args.drain_cleanup:
+        journal = cli.cleanup_journal_from_args(args)
+        try:
+            removed = runner.drain(journal)
+        finally:
+            client.close()
+        if removed is None:
+            print("Deferred cleanups are being removed by another process")
+            sys.exit(0)
+        print(f"Removed {removed} deferred challenge record(s)")
+        sys.exit(1 if journal.pending() else 0)
+
+    manifest = sys.stdin if args.manifest == "-" else open(args.manifest, newline='')
+    try:
+        success = runner.run(read_manifest(manifest, fmt), chunk_size=args.chunk_size)
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+        client.close()
+    runner.report(sys.stdout)
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
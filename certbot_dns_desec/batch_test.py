@@ -0,0 +1,188 @@
+"""Tests for certbot_dns_desec.batch."""
+
+import io
+import unittest
+from unittest.mock import patch
+
+import mock
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins import dns_test_common
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import api
+from certbot_dns_desec import batch
+from certbot_dns_desec import cleanup_journal
+from certbot_dns_desec import dns_desec
+from certbot_dns_desec import locking
+from certbot_dns_desec import txt
+from certbot_dns_desec.dns_desec_test import mock_client
+
+ZONES = [{'name': 'example.com', 'minimum_ttl': 3600}, {'name': 'sub.example.org', 'minimum_ttl': 60}]
+
+
+class ReadManifestTest(unittest.TestCase):
+    def test_jsonl(self):
+        lines = [
+            '{"name": "_acme-challenge.example.com", "value": "a"}\n',
+            '\n',
+            '{"name": "_acme-challenge.example.com", "value": "a", "op": "remove"}\n',
+            '{"name": "_acme-challenge.example.com"}\n',
+            'not json\n',
+        ]
+        self.assertEqual(list(batch.read_manifest(lines, 'jsonl')), [
+            (1, "_acme-challenge.example.com", "a", "add"),
+            (3, "_acme-challenge.example.com", "a", "remove"),
+            (4, None, None, None),
+            (5, None, None, None),
+        ])
+
+    def test_csv(self):
+        lines = ["name,value,op\n", "_acme-challenge.example.com, a\n", "x.example.com,b,remove\n", "x,y,z,w\n"]
+        self.assertEqual(list(batch.read_manifest(lines, 'csv')), [
+            (2, "_acme-challenge.example.com", "a", "add"),
+            (3, "x.example.com", "b", "remove"),
+            (4, None, None, None),
+        ])
+
+    def test_streaming(self):
+        def lines():
+            yield '{"name": "a.example.com", "value": "a"}\n'
+            raise AssertionError("read too far")
+
+        self.assertEqual(next(batch.read_manifest(lines(), 'jsonl')), (1, "a.example.com", "a", "add"))
+
+
+class BatchRunnerTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(BatchRunnerTest, self).setUp()
+        self.client = mock_client(zone_cache=None)
+        self.client.get_domains.return_value = ZONES
+        self.client.get_authoritative_zone.side_effect = self._zone
+        self.client.get_txt_rrset.return_value = {'"old"'}
+        self.runner = batch.BatchRunner(self.client, locking.RRsetLocks(self.tempdir), zone_list_threshold=2)
+
+    @staticmethod
+    def _zone(name):
+        zone = api.ZoneIndex(ZONES).lookup(name)
+        if zone is None:
+            raise errors.PluginError("Could not find suitable domain in your account (did you create it?)")
+        return zone
+
+    def test_group_by_zone(self):
+        success = self.runner.run([
+            (1, "_acme-challenge.example.com", "a", "add"),
+            (2, "_acme-challenge.www.example.com", "b", "add"),
+            (3, "_acme-challenge.example.com", "c", "add"),
+            (4, "_acme-challenge.example.com", "old", "remove"),
+            (5, "_acme-challenge.sub.example.org", "d", "add"),
+        ], chunk_size=10)
+
+        self.assertTrue(success)
+        self.assertEqual(self.client.set_txt_rrsets.call_args_list, [
+            mock.call(ZONES[0], {"_acme-challenge": {'"a"', '"c"'}, "_acme-challenge.www": {'"old"', '"b"'}}),
+            mock.call(ZONES[1], {"_acme-challenge": {'"old"', '"d"'}}),
+        ])
+        self.client.get_domains.assert_called_once_with()
+        self.assertEqual(self.runner.stats['example.com']['changes'], 4)
+        self.assertEqual(self.runner.stats['example.com']['writes'], 1)
+
+    def test_chunks(self):
+        entries = [(i, f"_acme-challenge.h{i}.example.com", "a", "add") for i in range(1, 8)]
+
+        self.assertTrue(self.runner.run(iter(entries), chunk_size=3))
+
+        self.assertEqual(self.client.set_txt_rrsets.call_count, 3)
+        self.assertEqual(self.runner.stats['example.com'], {
+            'changes': 7, 'writes': 3, 'seconds': self.runner.stats['example.com']['seconds'],
+        })
+        self.client.get_domains.assert_called_once_with()  # the domain list is reused for later chunks
+        self.client.get_authoritative_zone.assert_not_called()
+
+    def test_prestage(self):
+        self.runner.prestage = True
+        self.runner.challenge_ttls = dns_desec._ChallengeTTLs(os.path.join(self.tempdir, "ttls.json"))
+        self.client.get_txt_rrset.side_effect = lambda zone, subname: txt.TXTRecords({'"old"'}, ttl=86400)
+
+        self.assertTrue(self.runner.run([
+            (1, "_acme-challenge.example.com", "a", "add"),
+            (2, "_acme-challenge.www.example.com", "b", "remove"),
+        ]))
+
+        rrsets = self.client.set_txt_rrsets.call_args.args[1]
+        self.assertEqual(rrsets, {"_acme-challenge": {'"old"'}, "_acme-challenge.www": {'"old"'}})
+        self.assertEqual({rrset.ttl for rrset in rrsets.values()}, {3600})  # the zone's minimum TTL
+        self.assertEqual(self.runner.original_ttls, {
+            "_acme-challenge.example.com": 86400, "_acme-challenge.www.example.com": 86400,
+        })
+        out = io.StringIO()
+        self.runner.report(out)
+        self.assertIn("for up to 86400 seconds", out.getvalue())
+
+    def test_failures(self):
+        def set_txt_rrsets(zone, rrsets):
+            if zone['name'] == 'sub.example.org':
+                raise errors.PluginError("Throttled")
+
+        self.client.set_txt_rrsets.side_effect = set_txt_rrsets
+        success = self.runner.run([
+            (1, "_acme-challenge.example.com", "a", "add"),
+            (2, "_acme-challenge.example.net", "b", "add"),
+            (3, "_acme-challenge.example.com", "c", "replace"),
+            (4, None, None, None),
+            (5, "_acme-challenge.sub.example.org", "d", "add"),
+        ])
+
+        self.assertFalse(success)
+        self.assertEqual(self.runner.failed, 4)
+        self.assertEqual(set(self.runner.stats), {'example.com'})
+        out = io.StringIO()
+        self.runner.report(out)
+        self.assertIn("4 line(s) failed", out.getvalue())
+
+
+class MainTest(test_util.TempDirTestCase):
+    def test_main(self):
+        credentials = os.path.join(self.tempdir, "desec.ini")
+        dns_test_common.write({"dns_desec_token": "faketoken"}, credentials)
+        manifest = os.path.join(self.tempdir, "manifest.csv")
+        with open(manifest, "w") as f:
+            f.write("name,value,op\n_acme-challenge.example.com,a,add\n")
+        client = mock_client(zone_cache=None)
+        client.get_authoritative_zone.return_value = ZONES[0]
+        client.get_txt_rrset.return_value = set()
+
+        with patch('certbot_dns_desec.api.DesecConfigClient', return_value=client) as client_class, \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(SystemExit) as exit_:
+                batch.main([manifest, "--credentials", credentials, "--work-dir", self.tempdir, "--rate-limit", ""])
+
+        self.assertEqual(exit_.exception.code, 0)
+        self.assertEqual(client_class.call_args.args, (dns_desec.Authenticator.DEFAULT_ENDPOINT, "faketoken"))
+        client.set_txt_rrsets.assert_called_once_with(ZONES[0], {"_acme-challenge": {'"a"'}})
+        client.close.assert_called_once_with()
+        self.assertIn("example.com", stdout.getvalue())
+
+    def test_drain_cleanup(self):
+        credentials = os.path.join(self.tempdir, "desec.ini")
+        dns_test_common.write({"dns_desec_token": "faketoken"}, credentials)
+        journal = cleanup_journal.CleanupJournal(os.path.join(self.tempdir, "dns-desec-cleanup.jsonl"))
+        journal.append([("_acme-challenge.example.com", "a")])
+        client = mock_client(zone_cache=None)
+        client.get_authoritative_zone.return_value = ZONES[0]
+        client.get_txt_rrset.return_value = {'"a"', '"b"'}
+
+        with patch('certbot_dns_desec.api.DesecConfigClient', return_value=client), \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(SystemExit) as exit_:
+                batch.main(["--drain-cleanup", "--credentials", credentials, "--work-dir", self.tempdir,
+                            "--rate-limit", ""])
+
+        self.assertEqual(exit_.exception.code, 0)
+        client.set_txt_rrsets.assert_called_once_with(ZONES[0], {"_acme-challenge": {'"b"'}})
+        self.assertIn("Removed 1 deferred challenge record(s)", stdout.getvalue())
+        self.assertFalse(journal.pending())
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,123 @@
+"""Journal of challenge records whose removal was deferred, see ``--dns-desec-defer-cleanup``."""
+import contextlib
+import logging
+import time
+
+from certbot import errors
+from certbot.compat import os
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the state files are not locked
+    fcntl = None
+
+from certbot_dns_desec import locking
+from certbot_dns_desec import txt
+
+logger = logging.getLogger(__name__)
+
+
+class CleanupJournal(object):
+    """
+    Durable journal of challenge TXT records whose removal was deferred, shared by all processes on the host.
+
+    `append` adds ``(validation_name, validation)`` entries and returns once they are on disk. `drain` removes the
+    journaled records with one write per zone; entries whose zone could not be written stay in the journal for the
+    next drain, and are given up after ``max_attempts`` drains. Only one process drains at a time.
+    """
+
+    def __init__(self, path, max_attempts=10):
+        self.path = path
+        self.max_attempts = max_attempts
+
+    def append(self, challenges):
+        """
+        :param challenges: iterable of ``(validation_name, validation)`` tuples, with CNAMEs already followed
+        """
+        import uuid
+        now = time.time()
+        appended = [
+            {'id': uuid.uuid4().hex, 'time': now, 'name': validation_name, 'value': validation, 'attempts': 0}
+            for validation_name, validation in challenges
+        ]
+        locking.edit_json_lines(self.path, lambda entries: entries + appended, sync=True)
+
+    def pending(self):
+        """
+        Tells whether the journal may hold entries, without locking it.
+        """
+        try:
+            return os.path.getsize(self.path) > 0
+        except OSError:
+            return False
+
+    def drain(self, lookup_zones, remove):
+        """
+        Removes the journaled records.
+
+        :param lookup_zones: callable mapping a list of names to a mapping of each name to its zone (or None); if it
+            raises `errors.PluginError`, the names are looked up one by one, so that only the entries whose zone
+            cannot be found stay in the journal
+        :param remove: callable taking a zone and a mapping of subname to the (quoted) values to remove from it
+        :return: number of entries whose records were removed, or None if another process is draining
+        """
+        with contextlib.ExitStack() as stack:
+            if fcntl:
+                drain_lock = stack.enter_context(open(f"{self.path}.drain", 'a'))
+                try:
+                    fcntl.flock(drain_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            entries = locking.edit_json_lines(self.path, lambda entries: entries)
+            if not entries:
+                return 0
+            zones_by_qname = self._lookup_zones(lookup_zones, list(dict.fromkeys(entry['name'] for entry in entries)))
+            known = [entry for entry in entries if zones_by_qname.get(entry['name'])]
+            zones, validations = txt.group_by_zone(
+                [(entry['name'], entry['value']) for entry in known], zones_by_qname,
+            )
+            removed = set()
+            for zone_name, subnames in validations.items():
+                try:
+                    remove(zones[zone_name], subnames)
+                except errors.PluginError as e:
+                    logger.warning("Deferred cleanup in %s failed, will retry: %s", zone_name, e)
+                    continue
+                removed.update(entry['id'] for entry in known if zones_by_qname[entry['name']]['name'] == zone_name)
+
+            attempted = {entry['id'] for entry in entries}
+
+            def edit(current):
+                kept = []
+                for entry in current:
+                    if entry['id'] in removed:
+                        continue
+                    if entry['id'] in attempted:
+                        entry = dict(entry, attempts=entry['attempts'] + 1)
+                        if entry['attempts'] >= self.max_attempts:
+                            logger.warning("Giving up removing TXT record %s from %s after %d attempts",
+                                           entry['value'], entry['name'], entry['attempts'])
+                            continue
+                    kept.append(entry)
+                return kept
+
+            locking.edit_json_lines(self.path, edit, sync=True)
+            logger.debug("Drained %d of %d deferred cleanup(s)", len(removed), len(entries))
+            return len(removed)
+
+    @staticmethod
+    def _lookup_zones(lookup_zones, qnames):
+        try:
+            return lookup_zones(qnames)
+        except errors.PluginError as e:
+            if len(qnames) == 1:
+                logger.warning("Could not look up the zone of deferred cleanup %s: %s", qnames[0], e)
+                return {}
+            logger.debug("Zone lookup of %d deferred cleanup name(s) failed, looking them up one by one: %s",
+                         len(qnames), e)
+        zones = {}
+        for qname in qnames:
+            try:
+                zones.update(lookup_zones([qname]))
+            except errors.PluginError as e:
+                logger.warning("Could not look up the zone of deferred cleanup %s: %s", qname, e)
+        return zones
@@ -0,0 +1,89 @@
+"""Tests for certbot_dns_desec.cleanup_journal."""
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import json
+import unittest
+
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import cleanup_journal
+
+
+class CleanupJournalTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(CleanupJournalTest, self).setUp()
+
+        self.journal = cleanup_journal.CleanupJournal(os.path.join(self.tempdir, "cleanup.jsonl"), max_attempts=2)
+        self.zones = {
+            f"_acme-challenge.{DOMAIN}": {'name': DOMAIN},
+            f"_acme-challenge.www.{DOMAIN}": {'name': DOMAIN},
+            "_acme-challenge.example.org": {'name': "example.org"},
+        }
+        self.removed = []
+
+    def _remove(self, zone, subnames):
+        if zone['name'] == "example.org":
+            raise errors.PluginError("Throttled")
+        self.removed.append((zone['name'], subnames))
+
+    def _entries(self):
+        with open(self.journal.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_drain(self):
+        self.assertFalse(self.journal.pending())
+        self.journal.append([(f"_acme-challenge.{DOMAIN}", "a"), (f"_acme-challenge.www.{DOMAIN}", "b")])
+        self.journal.append([("_acme-challenge.example.org", "c"), (f"_acme-challenge.{DOMAIN}", "d")])
+        self.assertTrue(self.journal.pending())
+
+        self.assertEqual(self.journal.drain(lambda qnames: self.zones, self._remove), 3)
+
+        self.assertEqual(self.removed, [(DOMAIN, {"_acme-challenge": {'"a"', '"d"'}, "_acme-challenge.www": {'"b"'}})])
+        self.assertEqual([(entry['value'], entry['attempts']) for entry in self._entries()], [("c", 1)])
+
+    def test_give_up(self):
+        self.journal.append([("_acme-challenge.example.org", "c"), ("_acme-challenge.example.net", "d")])
+
+        self.assertEqual(self.journal.drain(lambda qnames: self.zones, self._remove), 0)
+        self.assertEqual(len(self._entries()), 2)
+        self.assertEqual(self.journal.drain(lambda qnames: self.zones, self._remove), 0)
+        self.assertEqual(self._entries(), [])
+
+    def test_lookup_failure(self):
+        self.journal.append([(f"_acme-challenge.{DOMAIN}", "a")])
+
+        def lookup(qnames):
+            raise errors.PluginError("Could not find suitable domain")
+
+        self.assertEqual(self.journal.drain(lookup, self._remove), 0)
+        self.assertEqual(self._entries()[0]['attempts'], 1)
+
+    def test_lookup_failure_of_one_name(self):
+        self.journal.append([(f"_acme-challenge.{DOMAIN}", "a"), ("_acme-challenge.deleted.example", "b")])
+
+        def lookup(qnames):
+            if "_acme-challenge.deleted.example" in qnames:
+                raise errors.PluginError("Could not find suitable domain")
+            return {qname: self.zones[qname] for qname in qnames}
+
+        self.assertEqual(self.journal.drain(lookup, self._remove), 1)
+        self.assertEqual(self.removed, [(DOMAIN, {"_acme-challenge": {'"a"'}})])
+        self.assertEqual([(entry['value'], entry['attempts']) for entry in self._entries()], [("b", 1)])
+
+    @unittest.skipIf(fcntl is None, "flock is not available")
+    def test_single_drainer(self):
+        self.journal.append([(f"_acme-challenge.{DOMAIN}", "a")])
+        with open(f"{self.journal.path}.drain", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertIsNone(self.journal.drain(lambda qnames: self.zones, self._remove))
+        self.assertEqual(len(self._entries()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
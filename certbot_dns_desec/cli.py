@@ -0,0 +1,86 @@
+"""Command line options and setup shared by the standalone entry points (daemon and batch mode)."""
+import logging
+
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins import dns_common
+
+from certbot_dns_desec import api
+from certbot_dns_desec import cleanup_journal
+from certbot_dns_desec import dns_desec
+from certbot_dns_desec import locking
+from certbot_dns_desec import ratelimit
+
+
+def add_client_arguments(parser):
+    """
+    Adds the options needed to talk to the deSEC API, mirroring the plugin's options of the same names.
+    """
+    parser.add_argument("--credentials", required=True, help="deSEC credentials INI file")
+    parser.add_argument("--work-dir", default="/var/lib/letsencrypt",
+                        help="directory for the zone cache, rate limiter state and RRset locks, shared with "
+                             "certbot runs (default: certbot's work directory)")
+    parser.add_argument("--zone-cache-ttl", type=int, default=86400)
+    parser.add_argument("--zone-list-threshold", type=int, default=10)
+    parser.add_argument("--rate-limit", default=ratelimit.RateLimiter.DEFAULT_RATES,
+                        help="client-side API rate limits shared with certbot runs, as comma-separated "
+                             "<category>:<requests>/<s|min|h> entries (default: %(default)s); each zone written "
+                             "costs one read and one write")
+    parser.add_argument("--max-attempts", type=int, default=4)
+    parser.add_argument("--retry-deadline", type=int, default=600)
+    parser.add_argument("--max-concurrency", type=int, default=8,
+                        help="number of API connections kept alive for reuse")
+    parser.add_argument("--challenge-ttl", default="",
+                        help="TTL of written TXT RRsets, as seconds and/or <zone>:<seconds> entries (default: the "
+                             "zone's minimum TTL)")
+    parser.add_argument("--prune-stale", type=int, default=None,
+                        help="drop stale ACME validations from written RRsets, keeping at most this many per name")
+    parser.add_argument("--verbose", "-v", action="store_true")
+
+
+def setup_logging(args):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+def client_from_args(parser, args):
+    """
+    Reads the credentials file and returns a `api.DesecConfigClient`, exiting on invalid options.
+    """
+    try:
+        credentials = dns_common.CredentialsConfiguration(args.credentials, lambda key: f"dns_desec_{key}")
+        credentials.require({"token": "Access token for deSEC API."})
+        return api.DesecConfigClient(
+            credentials.conf("endpoint") or dns_desec.Authenticator.DEFAULT_ENDPOINT,
+            credentials.conf("token"),
+            zone_cache=dns_desec._ZoneCache(
+                os.path.join(args.work_dir, "dns-desec-zones.json"), args.zone_cache_ttl,
+            ) if args.zone_cache_ttl > 0 else None,
+            rate_limiter=ratelimit.RateLimiter(
+                os.path.join(args.work_dir, "dns-desec-ratelimit.json"),
+                ratelimit.RateLimiter.parse_rates(args.rate_limit),
+            ) if args.rate_limit else None,
+            retry_policy=api.RetryPolicy(max_attempts=args.max_attempts, deadline=args.retry_deadline),
+            pool_size=args.max_concurrency,
+        )
+    except errors.PluginError as e:
+        parser.exit(1, f"{parser.prog}: {e}\n")
+
+
+def rrset_locks_from_args(args):
+    return locking.RRsetLocks(os.path.join(args.work_dir, "dns-desec-locks"))
+
+
+def cleanup_journal_from_args(args):
+    return cleanup_journal.CleanupJournal(os.path.join(args.work_dir, "dns-desec-cleanup.jsonl"))
+
+
+def challenge_ttls_from_args(parser, args):
+    """
+    Returns the `dns_desec._ChallengeTTLs` shared with certbot runs, exiting on an invalid ``--challenge-ttl``.
+    """
+    try:
+        overrides = dns_desec._ChallengeTTLs.parse_overrides(args.challenge_ttl)
+    except errors.PluginError as e:
+        parser.exit(1, f"{parser.prog}: {e}\n")
+    return dns_desec._ChallengeTTLs(os.path.join(args.work_dir, "dns-desec-ttls.json"), overrides)
@@ -0,0 +1,249 @@
+"""
+Long-running daemon that sets and removes challenge TXT records on behalf of many certbot processes.
+
+The daemon holds the deSEC API session, zone cache and rate limiter, and accepts requests from the Authenticator
+(``--dns-desec-daemon-socket``) over a Unix socket. Concurrent requests for the same zone are coalesced into a single
+bulk RRset write.
+
+Each connection carries one request line and one response line, both JSON::
+
+    {"action": "add", "challenges": [["_acme-challenge.example.com", "<validation>"], ...]}
+    {"validations": {"example.com": {"_acme-challenge": ["\\"<validation>\\""]}}}
+
+On failure, the response is ``{"error": "<message>"}``.
+"""
+import argparse
+import json
+import logging
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+
+from certbot_dns_desec import cli
+from certbot_dns_desec import dns_desec
+from certbot_dns_desec import txt
+
+logger = logging.getLogger(__name__)
+
+
+class _ZoneWriter(object):
+    """
+    Serializes and coalesces the TXT RRset changes of one zone.
+
+    Changes are queued; the first thread to find the writer idle becomes the combiner and, after waiting ``delay``
+    seconds for more changes to arrive, applies all queued changes with one read of the affected RRsets and one bulk
+    write. Threads arriving while a write is in progress only queue their changes and wait for the combiner.
+    Writes are coordinated with other processes through ``rrset_locks``, and their TTLs chosen by ``challenge_ttls``
+    (the zone's minimum TTL if None). See `dns_desec._write_txt_rrsets` for ``prune_stale``.
+    """
+
+    def __init__(self, client, zone, rrset_locks, delay=0.0, challenge_ttls=None, prune_stale=None):
+        self.client = client
+        self.zone = zone
+        self.rrset_locks = rrset_locks
+        self.delay = delay
+        self.challenge_ttls = challenge_ttls
+        self.prune_stale = prune_stale
+        self.lock = threading.Lock()
+        self.pending = []  # (validations, set_operator, done event, [error])
+        self.busy = False
+
+    def apply(self, validations, set_operator):
+        """
+        Applies ``set_operator`` to the TXT RRsets of the given subnames and returns once the change is written.
+
+        :param validations: mapping of subname to (quoted) validation values
+        :raises errors.PluginError: if the write failed
+        """
+        done, error = threading.Event(), []
+        with self.lock:
+            self.pending.append((validations, set_operator, done, error))
+            combine, self.busy = not self.busy, True
+        if combine:
+            self._combine()
+        done.wait()
+        if error:
+            raise error[0]
+
+    def _combine(self):
+        while True:
+            time.sleep(self.delay)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                self._write(batch)
+            except Exception as e:  # pylint: disable=broad-except
+                error = e if isinstance(e, errors.PluginError) else errors.PluginError(f"Unexpected error: {e!r}")
+                for _, _, _, errors_ in batch:
+                    errors_.append(error)
+            for _, _, done, _ in batch:
+                done.set()
+            with self.lock:
+                if not self.pending:
+                    self.busy = False
+                    return
+
+    def _write(self, batch):
+        changes = {}
+        for validations, set_operator, _, _ in batch:
+            for subname, values in validations.items():
+                changes.setdefault(subname, []).append((set_operator, values))
+        logger.debug("Writing %d change(s) to %s in one request", len(batch), self.zone['name'])
+        dns_desec._write_txt_rrsets(
+            self.client, self.rrset_locks, self.zone, changes,
+            challenge_ttls=self.challenge_ttls, prune_stale=self.prune_stale,
+        )
+
+
+class ChallengeDaemon(object):
+    """
+    Applies challenge requests received over a Unix socket through one shared `api.DesecConfigClient`.
+
+    :param client: the API client used for all requests
+    :param rrset_locks: `locking.RRsetLocks` shared with certbot processes that do not use the daemon
+    :param zone_list_threshold: see ``--dns-desec-zone-list-threshold``
+    :param coalesce_delay: seconds a zone writer waits for further changes before writing
+    :param challenge_ttls: `dns_desec._ChallengeTTLs` choosing the TTL of written RRsets, or None
+    :param prune_stale: see ``--dns-desec-prune-stale``
+    """
+
+    def __init__(self, client, rrset_locks, zone_list_threshold=10, coalesce_delay=0.05, challenge_ttls=None,
+                 prune_stale=None):
+        self.client = client
+        self.rrset_locks = rrset_locks
+        self.zone_list_threshold = zone_list_threshold
+        self.coalesce_delay = coalesce_delay
+        self.challenge_ttls = challenge_ttls
+        self.prune_stale = prune_stale
+        self.lock = threading.Lock()  # guards the zone cache and the writers
+        self.writers = {}  # zone name -> _ZoneWriter
+
+    def _writer(self, zone):
+        with self.lock:
+            if zone['name'] not in self.writers:
+                self.writers[zone['name']] = _ZoneWriter(
+                    self.client, zone, self.rrset_locks, delay=self.coalesce_delay,
+                    challenge_ttls=self.challenge_ttls, prune_stale=self.prune_stale,
+                )
+            return self.writers[zone['name']]
+
+    def handle(self, request):
+        """
+        Applies one request and returns the response, see the module documentation for the format.
+        """
+        try:
+            set_operator = txt.OPERATORS[request['action']]
+            challenges = [(validation_name, validation) for validation_name, validation in request['challenges']]
+        except (KeyError, TypeError, ValueError) as e:
+            return {'error': f"Invalid request: {e!r}"}
+        try:
+            with self.lock:
+                zones_by_qname = self.client.get_authoritative_zones(
+                    [validation_name for validation_name, _ in challenges], list_threshold=self.zone_list_threshold,
+                )
+                if self.client.zone_cache:
+                    self.client.zone_cache.save()
+            zones, validations = txt.group_by_zone(challenges, zones_by_qname)
+            for zone_name, subnames in validations.items():
+                self._writer(zones[zone_name]).apply(subnames, set_operator)
+        except errors.PluginError as e:
+            logger.warning("Request %s failed: %s", request, e)
+            return {'error': str(e)}
+        return {
+            'validations': {
+                zone_name: {subname: sorted(values) for subname, values in subnames.items()}
+                for zone_name, subnames in validations.items()
+            },
+        }
+
+    def drain_cleanup_journal(self, journal):
+        """
+        Removes the challenge records whose cleanup certbot deferred, see `cleanup_journal.CleanupJournal.drain`.
+        """
+        def lookup_zones(qnames):
+            with self.lock:
+                return self.client.get_authoritative_zones(qnames, list_threshold=self.zone_list_threshold)
+
+        return journal.drain(
+            lookup_zones, lambda zone, subnames: self._writer(zone).apply(subnames, set.difference),
+        )
+
+    def server(self, path):
+        """
+        Returns a threading server accepting requests on a Unix socket at ``path``, readable only by the owner.
+        """
+        if os.path.exists(path):
+            os.remove(path)  # left over from a previous daemon
+        server = socketserver.ThreadingUnixStreamServer(path, _RequestHandler)
+        server.daemon_threads = True
+        server.challenge_daemon = self
+        filesystem.chmod(path, 0o600)
+        return server
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = {'error': f"Invalid request: {line!r}"}
+        else:
+            response = self.server.challenge_daemon.handle(request)
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def _drain_periodically(daemon, journal, interval):
+    while True:
+        if journal.pending():
+            try:
+                daemon.drain_cleanup_journal(journal)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Draining deferred cleanups failed")
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="certbot-dns-desec-daemon",
+        description="Set and remove ACME challenge TXT records at deSEC on behalf of certbot processes that use "
+                    "--dns-desec-daemon-socket.",
+    )
+    parser.add_argument("--socket", required=True, help="path of the Unix socket to listen on")
+    parser.add_argument("--coalesce-delay", type=float, default=0.05,
+                        help="seconds to wait for further requests for a zone before writing to it")
+    parser.add_argument("--drain-interval", type=float, default=60,
+                        help="seconds between removals of challenge records whose cleanup certbot deferred "
+                             "(--dns-desec-defer-cleanup); 0 disables")
+    cli.add_client_arguments(parser)
+    args = parser.parse_args(argv)
+    cli.setup_logging(args)
+    client = cli.client_from_args(parser, args)
+
+    daemon = ChallengeDaemon(client, cli.rrset_locks_from_args(args), zone_list_threshold=args.zone_list_threshold,
+                             coalesce_delay=args.coalesce_delay, challenge_ttls=cli.challenge_ttls_from_args(parser, args),
+                             prune_stale=args.prune_stale)
+    server = daemon.server(args.socket)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if args.drain_interval > 0:
+        journal = cli.cleanup_journal_from_args(args)
+        threading.Thread(target=_drain_periodically, args=(daemon, journal, args.drain_interval), daemon=True).start()
+    logger.info("Listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Tests for certbot_dns_desec.daemon."""
+
+import socket
+import threading
+import unittest
+
+import mock
+from certbot import errors
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import cleanup_journal
+from certbot_dns_desec import daemon
+from certbot_dns_desec import dns_desec
+from certbot_dns_desec import locking
+from certbot_dns_desec import txt
+from certbot_dns_desec.dns_desec_test import mock_client
+
+ZONE = {'name': 'example.com', 'minimum_ttl': 3600}
+
+
+class ZoneWriterTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(ZoneWriterTest, self).setUp()
+        self.client = mock_client()
+        self.client.get_txt_rrset.side_effect = lambda zone, subname: {'"old"'} if subname == "_acme-challenge" else set()
+        self.writer = daemon._ZoneWriter(self.client, ZONE, locking.RRsetLocks(self.tempdir), delay=0.1)
+
+    def test_coalesce(self):
+        changes = [
+            ({"_acme-challenge": {'"a"'}}, set.union),
+            ({"_acme-challenge": {'"b"'}}, set.union),
+            ({"_acme-challenge.www": {'"c"'}}, set.union),
+            ({"_acme-challenge": {'"old"'}}, set.difference),
+        ]
+        threads = [threading.Thread(target=self.writer.apply, args=change) for change in changes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.client.set_txt_rrsets.assert_called_once_with(ZONE, {
+            "_acme-challenge": {'"a"', '"b"'},
+            "_acme-challenge.www": {'"c"'},
+        })
+        self.assertEqual(self.client.get_txt_rrset.call_count, 2)
+        self.assertFalse(self.writer.busy)
+
+    def test_sequential(self):
+        self.writer.delay = 0
+        self.writer.apply({"_acme-challenge": {'"a"'}}, set.union)
+        self.writer.apply({"_acme-challenge": {'"old"'}}, set.union)
+
+        self.assertEqual(self.client.set_txt_rrsets.call_args_list, [
+            mock.call(ZONE, {"_acme-challenge": {'"old"', '"a"'}}),
+            mock.call(ZONE, {}),
+        ])
+
+    def test_challenge_ttls(self):
+        self.writer.delay = 0
+        self.writer.challenge_ttls = dns_desec._ChallengeTTLs(os.path.join(self.tempdir, "ttls.json"))
+        self.client.get_txt_rrset.side_effect = lambda zone, subname: txt.TXTRecords({'"old"'}, ttl=60)
+
+        self.writer.apply({"_acme-challenge": {'"a"'}}, set.union)
+
+        rrsets = self.client.set_txt_rrsets.call_args.args[1]
+        self.assertEqual(rrsets, {"_acme-challenge": {'"old"', '"a"'}})
+        self.assertEqual(rrsets["_acme-challenge"].ttl, 60)  # already below the zone's minimum TTL
+
+    def test_error(self):
+        self.client.set_txt_rrsets.side_effect = errors.PluginError("boom")
+        results = []
+
+        def apply(subname):
+            try:
+                self.writer.apply({subname: {'"a"'}}, set.union)
+            except errors.PluginError as e:
+                results.append(str(e))
+
+        threads = [threading.Thread(target=apply, args=(subname,)) for subname in ["a", "b"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["boom", "boom"])
+        self.assertFalse(self.writer.busy)
+
+
+class ChallengeDaemonTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(ChallengeDaemonTest, self).setUp()
+        self.client = mock_client(zone_cache=None)
+        self.client.get_authoritative_zones.side_effect = lambda qnames, **kwargs: {qname: ZONE for qname in qnames}
+        self.client.get_txt_rrset.return_value = set()
+        self.daemon = daemon.ChallengeDaemon(self.client, locking.RRsetLocks(self.tempdir), coalesce_delay=0)
+
+    def test_handle(self):
+        response = self.daemon.handle({'action': 'add', 'challenges': [
+            ["_acme-challenge.example.com", "a"], ["_acme-challenge.www.example.com", "b"],
+        ]})
+
+        self.assertEqual(response, {'validations': {'example.com': {
+            '_acme-challenge': ['"a"'], '_acme-challenge.www': ['"b"'],
+        }}})
+        self.client.set_txt_rrsets.assert_called_once_with(ZONE, {
+            "_acme-challenge": {'"a"'}, "_acme-challenge.www": {'"b"'},
+        })
+
+    def test_handle_invalid(self):
+        self.assertIn('error', self.daemon.handle({'action': 'replace', 'challenges': []}))
+        self.assertIn('error', self.daemon.handle({'action': 'add', 'challenges': [["only-name"]]}))
+        self.client.set_txt_rrsets.assert_not_called()
+
+    def test_handle_error(self):
+        self.client.get_authoritative_zones.side_effect = errors.PluginError("Could not find suitable domain")
+
+        response = self.daemon.handle({'action': 'remove', 'challenges': [["_acme-challenge.example.com", "a"]]})
+
+        self.assertEqual(response, {'error': "Could not find suitable domain"})
+
+    def test_drain_cleanup_journal(self):
+        journal = cleanup_journal.CleanupJournal(os.path.join(self.tempdir, "cleanup.jsonl"))
+        journal.append([("_acme-challenge.example.com", "a"), ("_acme-challenge.www.example.com", "b")])
+        self.client.get_txt_rrset.side_effect = lambda zone, subname: {'"a"', '"b"'}
+
+        self.assertEqual(self.daemon.drain_cleanup_journal(journal), 2)
+
+        self.client.set_txt_rrsets.assert_called_once_with(ZONE, {
+            "_acme-challenge": {'"b"'}, "_acme-challenge.www": {'"a"'},
+        })
+        self.assertFalse(journal.pending())
+
+    def test_socket(self):
+        path = os.path.join(self.tempdir, "daemon.sock")
+        server = self.daemon.server(path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            validations = dns_desec._DaemonClient(path).apply([("_acme-challenge.example.com", "a")], set.union)
+            self.client.get_txt_rrset.return_value = {'"a"'}
+            dns_desec._DaemonClient(path).apply([("_acme-challenge.example.com", "a")], set.difference)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(validations, {'example.com': {'_acme-challenge': {'"a"'}}})
+        self.assertEqual(self.client.set_txt_rrsets.call_args_list, [
+            mock.call(ZONE, {"_acme-challenge": {'"a"'}}),
+            mock.call(ZONE, {"_acme-challenge": set()}),
+        ])
+        self.assertTrue(filesystem.check_mode(path, 0o600))
+
+    def test_socket_timeout(self):
+        path = os.path.join(self.tempdir, "stalled.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(path)
+            server.listen(1)  # accepts connections, but never answers
+            client = dns_desec._DaemonClient(path, timeout=0.1)
+            with self.assertRaisesRegex(errors.PluginError, "did not respond within 0.1 seconds"):
+                client.apply([("_acme-challenge.example.com", "a")], set.union)
+
+    def test_socket_unreachable(self):
+        client = dns_desec._DaemonClient(os.path.join(self.tempdir, "missing.sock"))
+        with self.assertRaises(errors.PluginError):
+            client.apply([("_acme-challenge.example.com", "a")], set.union)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -1,28 +1,54 @@
-"""DNS Authenticator for deSEC."""
+"""DNS Authenticator for deSEC.
+
+certbot imports all installed plugins on every run, including runs that do not use this one. Heavy dependencies
+(dnspython, asyncio) are therefore imported in the functions that use them, and the asynchronous client in `async_api`
+is only imported when it is used.
+"""
+import functools
 import json
 import logging
+import socket
+import threading
 import time
 
-import dns.resolver
-import requests
+import certbot
+from certbot import errors
 from certbot import interfaces
+from certbot.compat import filesystem
+from certbot.compat import os
+from certbot.display import util as display_util
+from certbot.plugins import dns_common
 try:
-    # needed for compatibility with older certbots, see #13
-    import zope.interface
-    zope_interface_implementer = zope.interface.implementer
-    zope_interface_provider = zope.interface.provider
-    i_authenticator = interfaces.IAuthenticator
-    i_plugin_factory = interfaces.IPluginFactory
-except ImportError:
-    def get_noop_dec(*args):
-        def noop_dec(obj):
-            return obj
-        return noop_dec
-    zope_interface_implementer = zope_interface_provider = get_noop_dec
-    i_authenticator = i_plugin_factory = None
+    import fcntl
+except ImportError:  # not available on Windows, where the state files are not locked
+    fcntl = None
 
-from certbot import errors
-from certbot.plugins import dns_common
+from certbot_dns_desec import api
+from certbot_dns_desec import cleanup_journal
+from certbot_dns_desec import locking
+from certbot_dns_desec import ratelimit
+from certbot_dns_desec import telemetry
+from certbot_dns_desec import txt
+
+
+def get_noop_dec(*args):
+    def noop_dec(obj):
+        return obj
+    return noop_dec
+
+
+zope_interface_implementer = zope_interface_provider = get_noop_dec
+i_authenticator = i_plugin_factory = None
+if int(certbot.__version__.split('.')[0]) < 2:
+    try:
+        # needed for compatibility with older certbots, see #13
+        import zope.interface
+        zope_interface_implementer = zope.interface.implementer
+        zope_interface_provider = zope.interface.provider
+        i_authenticator = interfaces.IAuthenticator
+        i_plugin_factory = interfaces.IPluginFactory
+    except ImportError:
+        pass
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -42,6 +68,20 @@ class Authenticator(dns_common.DNSAuthenticator):
     def __init__(self, *args, **kwargs):
         super(Authenticator, self).__init__(*args, **kwargs)
         self.credentials = None
+        self._desec_clients = {}  # token -> api.DesecConfigClient
+        self._async_desec_clients = {}  # token -> async_api.AsyncDesecConfigClient
+        self._event_loop = None  # of the asynchronous clients
+        self._token_index = None
+        self._zone_cache = None
+        self._resolver = None
+        self._rate_limiters = {}  # token -> ratelimit.RateLimiter
+        self._retry_policy = None
+        self._rrset_locks = None
+        self._challenge_ttls = None
+        self._cleanup_journal = None
+        self.skipped_writes = 0  # RRset writes left out because the RRset already had the desired content
+        self._skipped_writes_lock = threading.Lock()  # accounts are worked on concurrently
+        self.metrics = telemetry.Metrics()
 
     @classmethod
     def add_parser_arguments(cls, add):  # pylint: disable=arguments-differ
@@ -49,6 +89,74 @@ class Authenticator(dns_common.DNSAuthenticator):
             add, default_propagation_seconds=80  # TODO decrease after deSEC fixed their NOTIFY problem
         )
         add("credentials", help="deSEC credentials INI file.")
+        add("propagation-check", choices=["sleep", "txt", "soa"], default="sleep",
+            help="How to wait for DNS propagation. 'sleep' waits for the full propagation time, 'txt' polls "
+                 "deSEC's authoritative nameservers and stops waiting as soon as all of them serve the challenge "
+                 "records, using the propagation time as upper bound. 'soa' checks one challenge record per zone and "
+                 "then waits until all nameservers have the zone's SOA serial under which it was served, which needs "
+                 "fewer queries when there are many challenges per zone.")
+        add("zone-cache-ttl", type=int, default=86400,
+            help="Number of seconds for which the zone responsible for a challenge name is cached in certbot's "
+                 "work directory across runs. Set to 0 to disable the cache.")
+        add("resolver-nameservers", default=None,
+            help="Comma-separated list of nameserver IP addresses used to follow CNAMEs of challenge names and to "
+                 "look up deSEC's nameservers. Defaults to the system resolver configuration.")
+        add("resolver-timeout", type=float, default=5.0,
+            help="Number of seconds after which a DNS lookup is given up.")
+        add("resolver-concurrency", type=int, default=8,
+            help="Maximum number of challenge names whose CNAME chains are followed in parallel.")
+        add("rate-limit", default=ratelimit.RateLimiter.DEFAULT_RATES,
+            help="Client-side API rate limits shared by all certbot processes on this host, as comma-separated "
+                 "<category>:<requests>/<s|min|h> entries, where category is 'read' or 'write'. Requests are delayed "
+                 "until they fit into all limits of their category. Set to an empty string to disable.")
+        add("async", action="store_true", default=False,
+            help="Talk to the deSEC API with an asynchronous client, working on all zones concurrently. "
+                 "Requires httpx (pip install certbot-dns-desec[async]).")
+        add("max-concurrency", type=int, default=8,
+            help="Maximum number of concurrent API requests of the asynchronous client, and number of connections "
+                 "kept alive for reuse by either client.")
+        add("http2", action="store_true", default=False,
+            help="Use HTTP/2 for the asynchronous client.")
+        add("max-attempts", type=int, default=4,
+            help="Maximum number of attempts for a deSEC API request that is throttled or fails temporarily.")
+        add("retry-deadline", type=int, default=600,
+            help="Number of seconds after the first attempt of an API request after which it is no longer retried.")
+        add("metrics-json", default=None,
+            help="Path of a file to which a JSON summary of request counts and timings is written after each run.")
+        add("metrics-textfile", default=None,
+            help="Path of a file to which request counts and timings are written in OpenMetrics text format after "
+                 "each run, e.g. into the directory of node_exporter's textfile collector.")
+        add("zone-list-threshold", type=int, default=10,
+            help="If more than this many challenge names need a zone lookup, fetch the list of all domains in the "
+                 "deSEC account once instead of looking up each name separately.")
+        add("challenge-ttl", default="",
+            help="TTL of challenge TXT RRsets, as a number of seconds for all zones and/or comma-separated "
+                 "<zone>:<seconds> entries. Defaults to each zone's minimum TTL, to which lower values are raised. "
+                 "Existing RRsets with a higher TTL are lowered while they hold a challenge, and their original TTL "
+                 "is restored on cleanup.")
+        add("prestage", action="store_true", default=False,
+            help="Only lower the TTL of existing challenge TXT RRsets to the challenge TTL, keeping their records, "
+                 "and stop before answering the challenges. Run this well ahead of the actual issuance, so that "
+                 "resolvers no longer cache the RRsets with their original TTL when the challenge is written. "
+                 "Stopping fails the challenges, so certbot exits with status 1 even if pre-staging succeeded; "
+                 "certbot-dns-desec-batch --prestage does the same with a successful exit status.")
+        add("defer-cleanup", action="store_true", default=False,
+            help="Instead of removing the challenge records during cleanup, append them to a journal in certbot's "
+                 "work directory and return immediately. The journal is drained in batched per-zone writes at the "
+                 "start of later runs, by certbot-dns-desec-daemon, or by certbot-dns-desec-batch --drain-cleanup.")
+        add("prune-stale", type=int, default=None,
+            help="Drop stale ACME validations (43 character base64url TXT values that are not being added, e.g. left "
+                 "over from aborted runs) from the RRsets that are written, keeping at most this many per name. "
+                 "Validations that this plugin added on this host during the last day and did not remove yet are "
+                 "kept. Do not use this if other ACME clients may have challenges pending at the same names.")
+        add("daemon-socket", default=None,
+            help="Path of the Unix socket of a running certbot-dns-desec-daemon. If given, TXT records are set and "
+                 "removed by the daemon, which holds the API session and credentials, and the credentials INI file "
+                 "is not read.")
+        add("daemon-timeout", type=int, default=1800,
+            help="Number of seconds after which a daemon that does not respond is given up on. A request to the "
+                 "daemon makes up to three API requests that it retries for up to its own --retry-deadline, so "
+                 "keep this above three times that deadline.")
 
     def more_info(self):  # pylint: disable=missing-docstring,no-self-use
         return (
@@ -60,129 +168,1001 @@ class Authenticator(dns_common.DNSAuthenticator):
         self.credentials = self._configure_credentials(
             key="credentials",
             label="deSEC credentials INI file",
-            required_variables={
-                "token": "Access token for deSEC API.",
-            },
+            validator=self._validate_credentials,
+        )
+
+    @staticmethod
+    def _validate_credentials(credentials):
+        zone_tokens = _parse_zone_tokens(credentials.conf("zone_tokens"))
+        if not zone_tokens:
+            credentials.require({"token": "Access token for deSEC API."})
+
+    def _token_for(self, qname):
+        """
+        Returns the API token of the deSEC account holding the zone of ``qname``.
+
+        Zones whose name ends in a suffix listed in ``dns_desec_zone_tokens`` use the token of the longest such suffix,
+        all other zones use ``dns_desec_token``.
+        """
+        if self._token_index is None:
+            self._token_index = api.ZoneIndex([
+                {'name': suffix, 'token': token}
+                for suffix, token in _parse_zone_tokens(self.credentials.conf("zone_tokens"))
+            ])
+        entry = self._token_index.lookup(qname)
+        if entry is not None:
+            return entry['token']
+        if not self.credentials.conf("token"):
+            raise errors.PluginError(f"No deSEC token for {qname}: it matches no suffix in dns_desec_zone_tokens and "
+                                     f"dns_desec_token is not set.")
+        return self.credentials.conf("token")
+
+    def _by_account(self, items, name=lambda item: item):
+        """
+        Groups items by the API token used for them, in order.
+
+        :param name: callable returning the name that determines an item's account
+        :return: mapping of token to the list of its items
+        """
+        accounts = {}
+        for item in items:
+            accounts.setdefault(self._token_for(name(item)), []).append(item)
+        return accounts
+
+    def _for_each_account(self, accounts, work):
+        """
+        Calls ``work(token, items)`` for each account, concurrently if there are several.
+
+        The clients of the accounts and the components they share are created beforehand, as their getters are not
+        thread-safe.
+
+        :return: list of the results, in the order of ``accounts``
+        :raises: the first exception raised by ``work``, after all calls finished
+        """
+        if len(accounts) <= 1:
+            return [work(token, items) for token, items in accounts.items()]
+        for token in accounts:
+            self._get_desec_client(token)
+        self._get_rrset_locks()
+        self._get_challenge_ttls()
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+            futures = [executor.submit(work, token, items) for token, items in accounts.items()]
+        return [future.result() for future in futures]
+
+    def perform(self, achalls):  # pylint: disable=missing-function-docstring
+        if not self.conf('daemon-socket') or self.conf('prestage'):
+            self._setup_credentials()
+
+        if self.conf('prestage'):
+            self._prestage([
+                achall.validation_domain_name(_achall_domain(achall)) for achall in achalls
+            ])
+        if not self.conf('daemon-socket'):
+            self._drain_cleanup_journal()
+        self._attempt_cleanup = True
+
+        responses = []
+        challenges = []
+        for achall in achalls:
+            domain = _achall_domain(achall)
+            challenges.append((achall.validation_domain_name(domain), achall.validation(achall.account_key)))
+            responses.append(achall.response(achall.account_key))
+        logger.debug("Authenticator.perform: %s", challenges)
+        written = self._desec_work(challenges, set.union)
+        with self.metrics.timer('propagation_wait'):
+            self._wait_for_propagation(written)
+
+        return responses
+
+    def cleanup(self, achalls):  # pylint: disable=missing-function-docstring
+        try:
+            if self._attempt_cleanup:
+                challenges = [
+                    (achall.validation_domain_name(_achall_domain(achall)), achall.validation(achall.account_key))
+                    for achall in achalls
+                ]
+                logger.debug("Authenticator.cleanup: %s", challenges)
+                if self.conf('defer-cleanup'):
+                    targets = self._get_resolver().resolve_all([validation_name for validation_name, _ in challenges])
+                    self._get_cleanup_journal().append(
+                        [(targets[validation_name], validation) for validation_name, validation in challenges]
+                    )
+                    logger.info("Deferred the removal of %d challenge record(s)", len(challenges))
+                else:
+                    self._desec_work(challenges, set.difference)
+        finally:
+            self._close_desec_client()
+            self._write_metrics()
+
+    def _write_metrics(self):
+        self.metrics.add('skipped_writes', self.skipped_writes)
+        self.metrics.write(json_path=self.conf('metrics-json'), openmetrics_path=self.conf('metrics-textfile'))
+
+    def _wait_for_propagation(self, written):
+        seconds = self.conf('propagation-seconds')
+        if self.conf('propagation-check') in ('txt', 'soa'):
+            display_util.notify("Waiting up to %d seconds for DNS changes to propagate" % seconds)
+            expected = {
+                zone_name: {txt.fqdn(subname, zone_name): values for subname, values in subnames.items()}
+                for zone_name, subnames in written.items()
+            }
+            checker = _PropagationChecker(self._get_resolver().resolver)
+            wait = checker.wait_for_serial if self.conf('propagation-check') == 'soa' else checker.wait
+            propagated = wait(expected, seconds)
+            if propagated is not None:
+                if not propagated:
+                    logger.warning("DNS changes did not propagate to all deSEC nameservers within %ss", seconds)
+                return
+            logger.warning("Could not check the deSEC nameservers, waiting %ss instead", seconds)
+
+        # DNS updates take time to propagate and checking to see if the update has occurred is not
+        # reliable (the machine this code is running on might be able to see an update before
+        # the ACME server). So: we sleep for a short amount of time we believe to be long enough.
+        display_util.notify("Waiting %d seconds for DNS changes to propagate" % seconds)
+        time.sleep(seconds)
+
+    def _get_resolver(self):
+        if self._resolver is None:
+            nameservers = self.conf('resolver-nameservers')
+            self._resolver = _CnameResolver(
+                timeout=self.conf('resolver-timeout'),
+                nameservers=[ns.strip() for ns in nameservers.split(',') if ns.strip()] if nameservers else None,
+                concurrency=self.conf('resolver-concurrency'),
+            )
+        return self._resolver
+
+    def _desec_work(self, challenges, set_operator):
+        """
+        Applies ``set_operator`` to the TXT RRsets of all given challenges, using one bulk write per zone.
+
+        :param challenges: iterable of ``(validation_name, validation)`` tuples
+        :param set_operator: ``set.union`` to add the validations, ``set.difference`` to remove them
+        :return: mapping of zone name to subname to the (quoted) validation values that were applied
+        """
+        challenges = list(challenges)
+        with self.metrics.timer('cname_resolution'):
+            targets = self._get_resolver().resolve_all([validation_name for validation_name, _ in challenges])
+        challenges = [(targets[validation_name], validation) for validation_name, validation in challenges]
+        if self.conf('daemon-socket'):
+            validations = _DaemonClient(
+                self.conf('daemon-socket'), timeout=self.conf('daemon-timeout'),
+            ).apply(challenges, set_operator)
+        elif self.conf('async'):
+            import asyncio
+            # the clients are bound to the event loop, which is therefore kept until cleanup along with them
+            if self._event_loop is None:
+                self._event_loop = asyncio.new_event_loop()
+            validations = self._event_loop.run_until_complete(self._desec_work_async(challenges, set_operator))
+        else:
+            validations = {}
+            for account_validations in self._for_each_account(
+                self._by_account(challenges, name=lambda challenge: challenge[0]),
+                lambda token, account_challenges: self._desec_account_work(token, account_challenges, set_operator),
+            ):
+                validations.update(account_validations)
+        if self._zone_cache:
+            self._zone_cache.save()
+        return validations
+
+    def _desec_account_work(self, token, challenges, set_operator):
+        """
+        Like `_desec_work`, for challenges whose zones belong to the account of ``token``, with CNAMEs followed.
+        """
+        client = self._get_desec_client(token)
+        zones_by_qname = client.get_authoritative_zones(
+            [validation_name for validation_name, _ in challenges], list_threshold=self.conf('zone-list-threshold'),
+        )
+        zones, validations = txt.group_by_zone(challenges, zones_by_qname)
+        for zone_name, subnames in validations.items():
+            self._write_zone(client, zones[zone_name], subnames, set_operator)
+        return validations
+
+    def _write_zone(self, client, zone, subnames, set_operator):
+        """
+        Applies ``set_operator`` to TXT RRsets of one zone with a single bulk write.
+
+        :param subnames: mapping of subname to (quoted) validation values
+        """
+        batch, rrsets, _ = _write_txt_rrsets(
+            client, self._get_rrset_locks(), zone,
+            {subname: [(set_operator, values)] for subname, values in subnames.items()},
+            challenge_ttls=self._get_challenge_ttls(), prune_stale=self.conf('prune-stale'),
+        )
+        self._count_write(batch, rrsets)
+
+    def _count_write(self, batch, rrsets):
+        with self._skipped_writes_lock:
+            self.skipped_writes += len(batch.changes) - len(rrsets)
+        self.metrics.add('combined_changes', batch.combined)
+
+    def _drain_cleanup_journal(self):
+        """
+        Removes the challenge records of earlier runs whose cleanup was deferred, see ``--dns-desec-defer-cleanup``.
+        """
+        journal = self._get_cleanup_journal()
+        if not journal.pending():
+            return
+
+        def lookup_zones(qnames):
+            zones = {}
+            for token, account_qnames in self._by_account(qnames).items():
+                zones.update(self._get_desec_client(token).get_authoritative_zones(
+                    account_qnames, list_threshold=self.conf('zone-list-threshold'),
+                ))
+            return zones
+
+        removed = journal.drain(
+            lookup_zones,
+            lambda zone, subnames: self._write_zone(
+                self._get_desec_client(self._token_for(zone['name'])), zone, subnames, set.difference,
+            ),
+        )
+        if removed:
+            self.metrics.add('deferred_cleanups', removed)
+
+    async def _desec_work_async(self, challenges, set_operator):
+        import asyncio
+        validations = {}
+        for account_validations in await asyncio.gather(*(
+            self._desec_account_work_async(token, account_challenges, set_operator)
+            for token, account_challenges in self._by_account(challenges, name=lambda challenge: challenge[0]).items()
+        )):
+            validations.update(account_validations)
+        return validations
+
+    async def _desec_account_work_async(self, token, challenges, set_operator):
+        import asyncio
+        import concurrent.futures
+        from certbot_dns_desec import async_api
+        client = self._get_async_desec_client(token)
+        await client.open()
+        zones_by_qname = await client.get_authoritative_zones(
+            [validation_name for validation_name, _ in challenges], list_threshold=self.conf('zone-list-threshold'),
+        )
+        zones, validations = txt.group_by_zone(challenges, zones_by_qname)
+        # waiting for other processes to release the RRsets blocks, so the writes are done in worker threads;
+        # these wait for the client's requests, whose rate limiting runs in the default executor, so they must
+        # not take up its threads
+        writers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(validations), self.conf('max-concurrency')) or 1,
         )
 
-    def _desec_work(self, domain, validation_name, validation, set_operator):
-        client = self._get_desec_client()
+        async def work_zone(zone, subnames):
+            loop = asyncio.get_running_loop()
+            batch, rrsets, _ = await loop.run_in_executor(writers, functools.partial(
+                _write_txt_rrsets, async_api.BlockingClient(client, loop), self._get_rrset_locks(), zone,
+                {subname: [(set_operator, values)] for subname, values in subnames.items()},
+                challenge_ttls=self._get_challenge_ttls(), prune_stale=self.conf('prune-stale'),
+            ))
+            self._count_write(batch, rrsets)
+
+        with writers:
+            await asyncio.gather(*(
+                work_zone(zones[zone_name], subnames) for zone_name, subnames in validations.items()
+            ))
+        return validations
+
+    def _prestage(self, validation_names):
+        """
+        Lowers the TTL of the existing TXT RRsets of the given names, see ``--dns-desec-prestage``, and stops the run.
+        """
+        targets = list(dict.fromkeys(self._get_resolver().resolve_all(validation_names).values()))
+        ttls = self._get_challenge_ttls()
+        original_ttls = {}
         try:
-            for _ in range(7):
-                validation_name = dns.resolver.resolve(validation_name, 'CNAME')[0].target
-                logger.debug(f"CNAME lookup result: {validation_name}")
-        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoResolverConfiguration):
-            pass
-        if isinstance(validation_name, dns.name.Name):
-            validation_name = validation_name.to_text().rstrip('.')
-        zone = client.get_authoritative_zone(validation_name)
-        subname = validation_name.rsplit(zone['name'], 1)[0].rstrip('.')
-        records = client.get_txt_rrset(zone, subname)
-        logger.debug(f"Current TXT records: {records}")
-        records = set_operator(records, {f'"{validation}"'})
-        logger.debug(f"Setting TXT records: {records}")
-        client.set_txt_rrset(zone, subname, records)
+            for token, account_targets in self._by_account(targets).items():
+                client = self._get_desec_client(token)
+                zones_by_qname = client.get_authoritative_zones(
+                    account_targets, list_threshold=self.conf('zone-list-threshold'),
+                )
+                zones, subnames_by_zone = txt.group_by_zone([(target, '') for target in account_targets], zones_by_qname)
+                for zone_name, subnames in subnames_by_zone.items():
+                    # an empty addition, so that changes queued by other processes are written along
+                    _, _, originals = _write_txt_rrsets(
+                        client, self._get_rrset_locks(), zones[zone_name],
+                        {subname: [(set.union, set())] for subname in subnames},
+                        challenge_ttls=ttls, prune_stale=self.conf('prune-stale'), lower_ttls=True,
+                    )
+                    original_ttls.update(originals)
+        finally:
+            self._close_desec_client()
+        if not original_ttls:
+            raise errors.PluginError("Pre-staging done: no challenge TXT RRset has a TTL above the challenge TTL. "
+                                     "Run certbot without --dns-desec-prestage to obtain the certificate.")
+        raise errors.PluginError(
+            f"Pre-staging done: lowered the TTL of {', '.join(sorted(original_ttls))}. Resolvers may serve cached "
+            f"copies for up to {max(original_ttls.values())} seconds; run certbot without --dns-desec-prestage after "
+            f"that to obtain the certificate."
+        )
 
     def _perform(self, domain, validation_name, validation):
-        logger.debug(f"Authenticator._perform: {domain}, {validation_name}, {validation}")
-        self._desec_work(domain, validation_name, validation, set.union)
+        logger.debug("Authenticator._perform: %s, %s, %s", domain, validation_name, validation)
+        self._desec_work([(validation_name, validation)], set.union)
 
     def _cleanup(self, domain, validation_name, validation):
-        logger.debug(f"Authenticator._cleanup: {domain}, {validation_name}, {validation}")
-        self._desec_work(domain, validation_name, validation, set.difference)
+        logger.debug("Authenticator._cleanup: %s, %s, %s", domain, validation_name, validation)
+        self._desec_work([(validation_name, validation)], set.difference)
 
-    def _get_desec_client(self):
-        return _DesecConfigClient(
-            self.credentials.conf("endpoint") or self.DEFAULT_ENDPOINT,
-            self.credentials.conf("token"),
-        )
+    def _get_desec_client(self, token=None):
+        """
+        Returns the client of the account of ``token`` (default: ``dns_desec_token``), which is kept until cleanup.
+        """
+        token = token or self.credentials.conf("token")
+        if token not in self._desec_clients:
+            self._desec_clients[token] = api.DesecConfigClient(
+                self.credentials.conf("endpoint") or self.DEFAULT_ENDPOINT,
+                token,
+                zone_cache=self._get_zone_cache(),
+                rate_limiter=self._get_rate_limiter(token),
+                retry_policy=self._get_retry_policy(),
+                metrics=self.metrics,
+                pool_size=self.conf('max-concurrency'),
+            )
+        return self._desec_clients[token]
+
+    def _close_desec_client(self):
+        for client in self._desec_clients.values():
+            logger.debug("Closing deSEC API session after opening %d connection(s)", client.connections_opened)
+            client.close()
+        self._desec_clients = {}
+        if self._event_loop is not None:
+            for client in self._async_desec_clients.values():
+                self._event_loop.run_until_complete(client.aclose())
+            self._event_loop.close()
+            self._event_loop = None
+        self._async_desec_clients = {}
+
+    def _get_async_desec_client(self, token=None):
+        """
+        Like `_get_desec_client`, for the asynchronous client; it has to be opened in the event loop it is used in.
+        """
+        from certbot_dns_desec import async_api
+        token = token or self.credentials.conf("token")
+        if token not in self._async_desec_clients:
+            self._async_desec_clients[token] = async_api.AsyncDesecConfigClient(
+                self.credentials.conf("endpoint") or self.DEFAULT_ENDPOINT,
+                token,
+                zone_cache=self._get_zone_cache(),
+                rate_limiter=self._get_rate_limiter(token),
+                retry_policy=self._get_retry_policy(),
+                metrics=self.metrics,
+                max_concurrency=self.conf('max-concurrency'),
+                http2=self.conf('http2'),
+            )
+        return self._async_desec_clients[token]
+
+    def _get_retry_policy(self):
+        if self._retry_policy is None:
+            self._retry_policy = api.RetryPolicy(
+                max_attempts=self.conf('max-attempts'), deadline=self.conf('retry-deadline'),
+            )
+        return self._retry_policy
+
+    def _get_zone_cache(self):
+        if self._zone_cache is None and self.conf('zone-cache-ttl') > 0:
+            self._zone_cache = _ZoneCache(
+                os.path.join(self.config.work_dir, "dns-desec-zones.json"), self.conf('zone-cache-ttl'),
+            )
+        return self._zone_cache
+
+    def _get_rrset_locks(self):
+        if self._rrset_locks is None:
+            self._rrset_locks = locking.RRsetLocks(os.path.join(self.config.work_dir, "dns-desec-locks"))
+        return self._rrset_locks
+
+    def _get_challenge_ttls(self):
+        if self._challenge_ttls is None:
+            self._challenge_ttls = _ChallengeTTLs(
+                os.path.join(self.config.work_dir, "dns-desec-ttls.json"),
+                _ChallengeTTLs.parse_overrides(self.conf('challenge-ttl')),
+            )
+        return self._challenge_ttls
+
+    def _get_cleanup_journal(self):
+        if self._cleanup_journal is None:
+            self._cleanup_journal = cleanup_journal.CleanupJournal(os.path.join(self.config.work_dir, "dns-desec-cleanup.jsonl"))
+        return self._cleanup_journal
+
+    def _get_rate_limiter(self, token):
+        """
+        Returns the rate limiter of the account of ``token``, as deSEC's limits apply per account.
+        """
+        if token not in self._rate_limiters and self.conf('rate-limit'):
+            if token == self.credentials.conf("token"):
+                filename = "dns-desec-ratelimit.json"
+            else:
+                import hashlib
+                filename = f"dns-desec-ratelimit-{hashlib.sha256(token.encode()).hexdigest()[:16]}.json"
+            self._rate_limiters[token] = ratelimit.RateLimiter(
+                os.path.join(self.config.work_dir, filename), ratelimit.RateLimiter.parse_rates(self.conf('rate-limit')),
+            )
+        return self._rate_limiters.get(token)
 
 
-class _DesecConfigClient(object):
+def _achall_domain(achall):
     """
-    Encapsulates all communication with the deSEC REST API.
+    Returns the domain name of an annotated challenge, also with certbot releases before 4.0 that have no
+    ``identifier`` attribute (newer releases deprecate ``domain``).
     """
+    identifier = getattr(achall, 'identifier', None)
+    return identifier.value if identifier is not None else achall.domain
 
-    def __init__(self, endpoint, token):
-        logger.debug("creating _DesecConfigClient")
-        self.endpoint = endpoint.rstrip('/')
-        self.token = token
-        self.session = requests.Session()
-        self.session.headers["Authorization"] = f"Token {token}"
-        self.session.headers["Content-Type"] = "application/json"
 
-    @staticmethod
-    def desec_request(method, **kwargs):
-        for _ in range(3):
-            response: requests.Response = method(**kwargs)
-            if response.status_code == 429 and 'Retry-After' in response.headers:
-                try:
-                    cooldown = int(response.headers['Retry-After'])
-                except ValueError:
-                    return response
-                logger.debug(f"deSEC API limit reached. Retrying request after {cooldown}s.")
-                time.sleep(cooldown)
-            else:
-                return response
-        return response
+def _write_txt_rrsets(client, rrset_locks, zone, changes, challenge_ttls=None, prune_stale=None, lower_ttls=False):
+    """
+    Applies changes to TXT RRsets of one zone with one read of the affected RRsets (see
+    `api.DesecConfigClient.get_txt_rrsets`) and one bulk write.
+
+    Changes that other processes queued for the same RRsets are written along, see `locking.RRsetLocks`.
 
-    def desec_get(self, **kwargs):
-        return self.desec_request(self.session.get, **kwargs)
+    :param client: `api.DesecConfigClient`, or `async_api.BlockingClient` around the asynchronous client
+    :param changes: mapping of subname to a list of ``(set_operator, values)`` to apply in order
+    :param challenge_ttls: `_ChallengeTTLs` choosing the TTL of the written RRsets, or None for the zone's minimum TTL
+    :param prune_stale: see `txt.merge_rrsets`
+    :param lower_ttls: also lower the TTL of RRsets whose records do not change, see `_ChallengeTTLs.lower`
+    :return: the committed `locking.RRsetBatch`, the RRsets that were written, and the original TTLs saved by ``lower_ttls``
+    """
+    with rrset_locks.hold(zone['name'], changes) as batch:
+        records = client.get_txt_rrsets(zone, batch.changes)
+        logger.debug("Current TXT records in %s: %s", zone['name'], records)
+        live = rrset_locks.live_validations(zone['name'], batch.changes) if prune_stale is not None else None
+        rrsets = txt.merge_rrsets(records, batch.changes, prune_stale=prune_stale, live=live)
+        if challenge_ttls:
+            rrsets = challenge_ttls.apply(zone, records, rrsets)
+        original_ttls = {}
+        if lower_ttls:
+            lowered, original_ttls = challenge_ttls.lower(zone, records, rrsets)
+            rrsets = {**rrsets, **lowered}
+        if rrsets:
+            logger.debug("Setting TXT records in %s: %s", zone['name'], rrsets)
+        else:
+            logger.debug("TXT records in %s are already up to date, not writing", zone['name'])
+        client.set_txt_rrsets(zone, rrsets)
+        rrset_locks.track(zone['name'], batch.changes)
+    return batch, rrsets, original_ttls
 
-    def desec_put(self, **kwargs):
-        return self.desec_request(self.session.put, **kwargs)
 
-    def get_authoritative_zone(self, qname):
-        response = self.desec_get(url=f"{self.endpoint}/domains/?owns_qname={qname}")
-        self._check_response_status(response)
-        data = self._response_json(response)
+class _CnameResolver(object):
+    """
+    Follows the CNAME chains of challenge names, concurrently for several names.
+
+    All lookups, including negative answers, are memoized for the lifetime of the instance, so that cleanup
+    reuses the results obtained during perform.
+    """
+
+    MAX_CHAIN_LENGTH = 7
+
+    def __init__(self, timeout=None, nameservers=None, concurrency=8):
+        import dns.resolver
+        self.concurrency = max(concurrency, 1)
+        self._targets = {}  # name -> CNAME target, or None if the name has no CNAME
         try:
-            return data[0]
-        except IndexError:
-            raise errors.PluginError(f"Could not find suitable domain in your account (did you create it?): {qname}")
-
-    def get_txt_rrset(self, zone, subname):
-        domain = zone['name']
-        response = self.desec_get(
-            url=f"{self.endpoint}/domains/{domain}/rrsets/{subname}.../TXT/",
-        )
+            self.resolver = dns.resolver.Resolver(configure=not nameservers)
+        except dns.resolver.NoResolverConfiguration:
+            logger.debug("No resolver configuration found, not following CNAMEs")
+            self.resolver = None
+            return
+        if nameservers:
+            self.resolver.nameservers = list(nameservers)
+        if timeout:
+            self.resolver.lifetime = timeout
+
+    def _lookup(self, name):
+        import dns.resolver
+        if name not in self._targets:
+            try:
+                target = self.resolver.resolve(name, 'CNAME')[0].target.to_text().rstrip('.')
+                logger.debug("CNAME lookup result: %s", target)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                target = None
+            self._targets[name] = target
+        return self._targets[name]
+
+    def resolve(self, name):
+        """
+        Returns the name at the end of the CNAME chain starting at ``name`` (which may be ``name`` itself).
+        """
+        if self.resolver is None:
+            return name
+        for _ in range(self.MAX_CHAIN_LENGTH):
+            target = self._lookup(name)
+            if target is None:
+                break
+            name = target
+        return name
+
+    def resolve_all(self, names):
+        """
+        Resolves the CNAME chains of all given names in parallel.
+
+        :return: mapping of each given name to the name at the end of its CNAME chain
+        """
+        import concurrent.futures
+        names = list(dict.fromkeys(names))
+        if len(names) <= 1 or self.concurrency == 1:
+            return {name: self.resolve(name) for name in names}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, len(names))) as executor:
+            return dict(zip(names, executor.map(self.resolve, names)))
+
 
-        if response.status_code == 404:
+class _PropagationChecker(object):
+    """
+    Polls the authoritative nameservers of zones until all of them serve the expected TXT records.
+
+    `wait` queries every TXT name at every nameserver. `wait_for_serial` needs only one TXT name per zone: once a
+    nameserver serves its values, that nameserver's SOA serial identifies a zone version containing the write, and
+    the other nameservers are polled for their SOA serial until they reach that version.
+
+    Nameserver addresses that cannot be reached from this host (e.g. IPv6 ones without IPv6 connectivity) are not
+    checked.
+    """
+
+    INITIAL_DELAY = 1
+    MAX_DELAY = 30
+
+    def __init__(self, resolver=None, timeout=5, port=53):
+        self.resolver = resolver
+        self.timeout = timeout
+        self.port = port
+        self.unreachable = set()
+
+    def authoritative_addresses(self, zone_name):
+        import dns.resolver
+        resolver = self.resolver or dns.resolver.get_default_resolver()
+        addresses = []
+        for ns in resolver.resolve(zone_name, 'NS'):
+            for rdtype in ['A', 'AAAA']:
+                try:
+                    addresses += [rdata.address for rdata in resolver.resolve(ns.target, rdtype)]
+                except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                    pass
+        return addresses
+
+    def query_txt(self, address, qname):
+        import dns.message
+        import dns.query
+        import dns.rdatatype
+        query = dns.message.make_query(qname, 'TXT')
+        response, _ = dns.query.udp_with_fallback(query, address, timeout=self.timeout, port=self.port)
+        return {
+            rdata.to_text()
+            for rrset in response.answer if rrset.rdtype == dns.rdatatype.TXT
+            for rdata in rrset
+        }
+
+    def query_soa_serial(self, address, zone_name):
+        import dns.message
+        import dns.query
+        import dns.rdatatype
+        query = dns.message.make_query(zone_name, 'SOA')
+        response, _ = dns.query.udp_with_fallback(query, address, timeout=self.timeout, port=self.port)
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return rrset[0].serial
+        return None
+
+    @staticmethod
+    def serial_reached(serial, target):
+        """
+        Tells whether ``serial`` is ``target`` or newer, in serial number arithmetic (RFC 1982).
+        """
+        return serial is not None and (serial - target) % 2 ** 32 < 2 ** 31
+
+    def _served(self, address, qname):
+        import dns.exception
+        if address in self.unreachable:
             return set()
+        try:
+            return self.query_txt(address, qname)
+        except dns.exception.DNSException as e:
+            logger.debug("Query for %s TXT at %s failed: %r", qname, address, e)
+        except OSError as e:
+            logger.debug("Query for %s TXT at %s failed, not checking this address: %r", qname, address, e)
+            self.unreachable.add(address)
+        return set()
+
+    def _serial(self, address, zone_name):
+        import dns.exception
+        if address in self.unreachable:
+            return None
+        try:
+            return self.query_soa_serial(address, zone_name)
+        except dns.exception.DNSException as e:
+            logger.debug("Query for %s SOA at %s failed: %r", zone_name, address, e)
+        except OSError as e:
+            logger.debug("Query for %s SOA at %s failed, not checking this address: %r", zone_name, address, e)
+            self.unreachable.add(address)
+        return None
 
-        self._check_response_status(response, domain=domain)
-        return set(self._response_json(response).get('records', set()))
+    def _addresses(self, zone_names):
+        """
+        Returns the nameserver addresses of each zone, or None if they could not be determined for all zones.
+        """
+        import dns.exception
+        addresses = {}
+        for zone_name in zone_names:
+            try:
+                addresses[zone_name] = self.authoritative_addresses(zone_name)
+            except dns.exception.DNSException as e:
+                logger.debug("Could not determine nameservers of %s: %r", zone_name, e)
+                return None
+            if not addresses[zone_name]:
+                logger.debug("The nameservers of %s have no addresses", zone_name)
+                return None
+        return addresses
 
-    def set_txt_rrset(self, zone, subname, records: set):
-        domain = zone['name']
-        response = self.desec_put(
-            url=f"{self.endpoint}/domains/{domain}/rrsets/",
-            data=json.dumps([
-                {"subname": subname, "type": "TXT", "ttl": zone['minimum_ttl'], "records": list(records)},
-            ]),
-        )
-        return self._check_response_status(response, domain=domain)
+    def _reachable(self, addresses):
+        """
+        Removes the addresses found unreachable from the nameserver addresses of each zone.
+
+        :return: False if no address is left for some zone, True otherwise
+        """
+        for zone_name, zone_addresses in addresses.items():
+            zone_addresses[:] = [address for address in zone_addresses if address not in self.unreachable]
+            if not zone_addresses:
+                logger.debug("None of the nameservers of %s can be reached", zone_name)
+                return False
+        return True
+
+    def _poll(self, max_seconds, check):
+        """
+        Calls ``check`` until it returns 0, using exponential backoff, for at most ``max_seconds``.
+
+        :param check: callable returning the number of checks that did not succeed yet, or None if they cannot be
+            done
+        :return: True if ``check`` returned 0 in time, False otherwise, and None if ``check`` returned None
+        """
+        deadline = time.monotonic() + max_seconds
+        delay = self.INITIAL_DELAY
+        while True:
+            pending = check()
+            if pending is None:
+                return None
+            if not pending:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            logger.debug("%d DNS lookups do not show the expected result yet, retrying in %ss", pending, delay)
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, self.MAX_DELAY)
+
+    def wait(self, expected, max_seconds):
+        """
+        Waits until every authoritative nameserver serves all expected TXT values, using exponential backoff.
+
+        :param expected: mapping of zone name to qname to the set of TXT values (in presentation format)
+        :param max_seconds: upper bound for the total waiting time
+        :return: True if all values were observed in time, False if not, and None if the nameservers could not be
+            determined or none of a zone's nameservers can be reached
+        """
+        addresses = self._addresses(expected)
+        if addresses is None:
+            return None
+        pending = [
+            (address, qname, values)
+            for zone_name, names in expected.items()
+            for address in addresses[zone_name] for qname, values in names.items()
+        ]
+
+        def check():
+            pending[:] = [
+                (address, qname, values) for address, qname, values in pending
+                if not values <= self._served(address, qname)
+            ]
+            if not self._reachable(addresses):
+                return None
+            pending[:] = [entry for entry in pending if entry[0] not in self.unreachable]
+            return len(pending)
+
+        return self._poll(max_seconds, check)
+
+    def wait_for_serial(self, expected, max_seconds):
+        """
+        Waits until every authoritative nameserver of each zone has a zone version containing the expected values.
+
+        For each zone, one TXT name is queried until a nameserver serves its values; the SOA serial of that
+        nameserver is then the target that all nameservers of the zone have to reach.
+
+        :param expected: see `wait`
+        :param max_seconds: upper bound for the total waiting time
+        :return: True if all nameservers reached their zone's target serial in time, False if not, and None if the
+            nameservers could not be determined or none of a zone's nameservers can be reached
+        """
+        addresses = self._addresses(expected)
+        if addresses is None:
+            return None
+        spot_checks = {zone_name: min(names.items()) for zone_name, names in expected.items() if names}
+        targets = {}  # zone name -> serial
+
+        def check():
+            for zone_name, (qname, values) in spot_checks.items():
+                if zone_name in targets:
+                    continue
+                for address in addresses[zone_name]:
+                    serial = self._serial(address, zone_name) if values <= self._served(address, qname) else None
+                    if serial is not None:
+                        logger.debug("%s serves %s TXT with serial %s of %s", address, qname, serial, zone_name)
+                        targets[zone_name] = serial
+                        break
+            serials = {
+                zone_name: {address: self._serial(address, zone_name) for address in addresses[zone_name]}
+                for zone_name in targets
+            }
+            if not self._reachable(addresses):
+                return None
+            lagging = len(spot_checks) - len(targets)
+            for zone_name, target in list(targets.items()):
+                behind = [
+                    address for address in addresses[zone_name]
+                    if not self.serial_reached(serials[zone_name][address], target)
+                ]
+                if behind:
+                    lagging += len(behind)
+                else:
+                    spot_checks.pop(zone_name)
+                    targets.pop(zone_name)
+            return lagging
+
+        return self._poll(max_seconds, check)
+
+
+class _ZoneCache(object):
+    """
+    Persistent cache mapping challenge names to the deSEC zone (name and minimum TTL) responsible for them.
+
+    Entries expire after ``ttl`` seconds; if there are more than ``max_entries``, the least recently used ones are
+    evicted when the cache is saved.
+    """
+
+    def __init__(self, path, ttl, max_entries=1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.dirty = False
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring unreadable zone cache %s: %r", self.path, e)
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, qname):
+        entry = self.entries.get(qname)
+        if entry is None:
+            return None
+        if entry['expires'] <= time.time():
+            self.entries.pop(qname)
+            self.dirty = True
+            return None
+        entry['used'] = time.time()
+        self.dirty = True
+        return entry['zone']
+
+    def put(self, qname, zone):
+        now = time.time()
+        self.entries[qname] = {
+            'zone': {'name': zone['name'], 'minimum_ttl': zone['minimum_ttl']},
+            'expires': now + self.ttl,
+            'used': now,
+        }
+        self.dirty = True
 
-    def _check_response_status(self, response, **kwargs):
-        if 200 <= response.status_code <= 299:
+    def invalidate_zone(self, zone_name):
+        stale = [qname for qname, entry in self.entries.items() if entry['zone']['name'] == zone_name]
+        for qname in stale:
+            self.entries.pop(qname)
+        self.dirty |= bool(stale)
+
+    def save(self):
+        if not self.dirty:
             return
-        elif response.status_code in [401, 403]:
-            raise errors.PluginError(f"Could not authenticate against deSEC API: {response.content}")
-        elif response.status_code == 404:
-            raise errors.PluginError(f"Not found ({kwargs}): {response.content}")
-        elif response.status_code == 429:
-            raise errors.PluginError(f"deSEC throttled your request even after we waited the prescribed cool-down "
-                                     f"time. Did you use the API in parallel? {response.content}")
-        elif response.status_code >= 500:
-            raise errors.PluginError(f"deSEC API server error (status {response.status_code}): {response.content}")
-        else:
-            raise errors.PluginError(f"Unknown error when talking to deSEC (status {response.status_code}: "
-                                     f"Request was on '{response.request.url}' with payload {response.request.body}. "
-                                     f"Response was '{response.content}'.")
+        now = time.time()
+        entries = sorted(
+            ((qname, entry) for qname, entry in self.entries.items() if entry['expires'] > now),
+            key=lambda item: item[1]['used'], reverse=True,
+        )
+        self.entries = dict(entries[:self.max_entries])
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            filesystem.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug("Could not write zone cache %s: %r", self.path, e)
+            return
+        self.dirty = False
+
+
+class _ChallengeTTLs(object):
+    """
+    Chooses the TTL with which TXT RRsets are written, and remembers the original TTL of existing RRsets that were
+    lowered for a challenge, so that it can be restored once the challenges are gone.
+
+    Challenges are written with the zone's minimum TTL, or a per-zone override that is at least that. The original
+    TTLs are kept in a state file shared by all processes on the host, serialized with ``flock`` where available.
+    """
+
+    def __init__(self, path, overrides=None):
+        """
+        :param path: path of the state file, mapping names to original TTLs
+        :param overrides: mapping of zone name ('' for all zones) to challenge TTL, see `parse_overrides`
+        """
+        self.path = path
+        self.overrides = overrides or {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_overrides(spec):
+        overrides = {}
+        for entry in (spec or '').split(','):
+            if not entry.strip():
+                continue
+            zone_name, _, ttl = entry.strip().rpartition(':')
+            try:
+                overrides[zone_name.rstrip('.').lower()] = int(ttl)
+            except ValueError:
+                raise errors.PluginError(f"Invalid challenge TTL '{entry}', expected <seconds> or <zone>:<seconds>")
+        return overrides
+
+    def challenge_ttl(self, zone):
+        ttl = self.overrides.get(zone['name'], self.overrides.get('', zone['minimum_ttl']))
+        return max(ttl, zone['minimum_ttl'])
+
+    def _edit(self, edit):
+        """
+        Replaces the saved TTLs by ``edit(saved)`` while holding the lock of the state file.
+        """
+        with self.lock, open(self.path, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                saved = json.loads(f.read() or '{}')
+            except ValueError:
+                saved = {}
+            edited = edit(dict(saved))
+            if edited != saved:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(edited))
+
+    def apply(self, zone, records, rrsets):
+        """
+        Chooses the TTL of each RRset to write.
+
+        An RRset that gains records gets the challenge TTL, or keeps its current TTL if that is lower; a higher
+        current TTL is saved. An RRset that only loses records keeps its current TTL, unless no validations remain, in
+        which case the saved TTL is restored. The saved TTL of deleted RRsets is forgotten.
+
+        :param records: mapping of subname to its current `txt.TXTRecords`
+        :param rrsets: mapping of subname to the records to write
+        :return: ``rrsets`` with `txt.TXTRecords` values carrying the TTL to write
+        """
+        target = self.challenge_ttl(zone)
+        ttls, save, restore = {}, {}, {}
+        for subname, new in rrsets.items():
+            current = getattr(records[subname], 'ttl', None)
+            fqdn = txt.fqdn(subname, zone['name'])
+            if new - records[subname]:
+                ttls[subname] = target if current is None else min(current, target)
+                if current is not None and current > target:
+                    logger.warning("Lowering the TTL of %s from %ss to %ss while it holds a challenge; resolvers may "
+                                   "still serve cached copies for that long. Pre-staging lowers it ahead of time.",
+                                   fqdn, current, target)
+                    save[fqdn] = current
+            else:
+                ttls[subname] = current
+                if not any(txt.VALIDATION.match(value) for value in new):
+                    restore[fqdn] = subname
 
-    def _response_json(self, response):
+        def edit(saved):
+            for fqdn, ttl in save.items():
+                saved.setdefault(fqdn, ttl)
+            for fqdn, subname in restore.items():
+                original = saved.pop(fqdn, None)
+                if original is not None and rrsets[subname]:
+                    logger.debug("Restoring the TTL of %s to %ss", fqdn, original)
+                    ttls[subname] = original
+            return saved
+
+        if save or restore:
+            self._edit(edit)
+        return {subname: txt.TXTRecords(new, ttl=ttls[subname]) for subname, new in rrsets.items()}
+
+    def lower(self, zone, records, rrsets):
+        """
+        Lowers the TTL of existing RRsets to the challenge TTL without changing their records, saving the original.
+
+        :param records: mapping of subname to its current `txt.TXTRecords`
+        :param rrsets: RRsets that are written anyway, as returned by `apply`
+        :return: mapping of subname to `txt.TXTRecords` for the RRsets that need to be written with a lower TTL, and
+            mapping of their names to the original TTL, which is saved
+        """
+        target = self.challenge_ttl(zone)
+        lowered, save = {}, {}
+        for subname, current in records.items():
+            new = rrsets.get(subname, current)
+            ttl = getattr(new, 'ttl', None) or getattr(current, 'ttl', None)
+            if new and ttl is not None and ttl > target:
+                lowered[subname] = txt.TXTRecords(new, ttl=target)
+                save[txt.fqdn(subname, zone['name'])] = ttl
+
+        def edit(saved):
+            for fqdn, ttl in save.items():
+                saved.setdefault(fqdn, ttl)
+            return saved
+
+        if save:
+            self._edit(edit)
+        return lowered, save
+
+
+def _parse_zone_tokens(spec):
+    """
+    Parses comma-separated ``<zone suffix>:<token>`` entries.
+
+    :return: list of ``(suffix, token)`` tuples
+    """
+    zone_tokens = []
+    for entry in (spec or '').split(','):
+        if not entry.strip():
+            continue
+        suffix, _, token = entry.strip().partition(':')
+        if not suffix.strip() or not token.strip():
+            raise errors.PluginError(f"Invalid dns_desec_zone_tokens entry '{entry.strip()}', expected "
+                                     f"<zone suffix>:<token>")
+        zone_tokens.append((suffix.strip().rstrip('.').lower(), token.strip()))
+    return zone_tokens
+
+
+class _DaemonClient(object):
+    """
+    Hands challenges to a certbot-dns-desec-daemon over its Unix socket, see `certbot_dns_desec.daemon`.
+
+    Each call sends one JSON request line and reads one JSON response line on a fresh connection. Connecting and each
+    read or write on the socket are given up after ``timeout`` seconds, so that a stalled daemon cannot block certbot.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def apply(self, challenges, set_operator):
+        """
+        Has the daemon apply ``set_operator`` to the TXT RRsets of the given challenges.
+
+        :param challenges: iterable of ``(validation_name, validation)`` tuples, with CNAMEs already followed
+        :param set_operator: ``set.union`` to add the validations, ``set.difference`` to remove them
+        :return: mapping of zone name to subname to the (quoted) validation values that were applied
+        """
+        request = {'action': txt.ACTIONS[set_operator], 'challenges': [list(challenge) for challenge in challenges]}
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps(request).encode() + b"\n")
+                with sock.makefile('rb') as f:
+                    line = f.readline()
+        except socket.timeout:
+            raise errors.PluginError(f"certbot-dns-desec-daemon at {self.path} did not respond within "
+                                     f"{self.timeout} seconds")
+        except OSError as e:
+            raise errors.PluginError(f"Could not talk to certbot-dns-desec-daemon at {self.path}: {e}")
         try:
-            return response.json()
-        except json.JSONDecodeError:
-            raise errors.PluginError(f"deSEC API sent non-JSON response (status {response.status_code}): "
-                                     f"{response.content}")
+            response = json.loads(line)
+        except ValueError:
+            raise errors.PluginError(f"certbot-dns-desec-daemon at {self.path} sent an invalid response: {line!r}")
+        if 'error' in response:
+            raise errors.PluginError(f"certbot-dns-desec-daemon: {response['error']}")
+        return {
+            zone_name: {subname: set(values) for subname, values in subnames.items()}
+            for zone_name, subnames in response['validations'].items()
+        }
@@ -1,21 +1,62 @@
 """Tests for certbot_dns_desec.dns_desec."""
 
+import asyncio
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import json
+import subprocess
+import sys
+import threading
 import unittest
 from unittest.mock import patch
 
 import mock
-import requests_mock
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from acme import messages
+from certbot import achallenges
 from certbot import errors
 from certbot.compat import os
 from certbot.plugins import dns_test_common
 from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import acme_util
 from certbot.tests import util as test_util
 
+from certbot_dns_desec import async_api
+from certbot_dns_desec import locking
+from certbot_dns_desec import ratelimit
+from certbot_dns_desec import txt
+
 FAKE_TOKEN = "faketoken"
 FAKE_ENDPOINT = "mock://endpoint"
 
 
+def mock_client(**kwargs):
+    """
+    Returns a mock API client whose ``get_txt_rrsets`` reads each RRset through ``get_txt_rrset``, so that tests only
+    need to configure the latter.
+    """
+    client = mock.MagicMock(**kwargs)
+    client.get_txt_rrsets.side_effect = lambda zone, subnames: {
+        subname: client.get_txt_rrset(zone, subname) for subname in subnames
+    }
+    return client
+
+
+def _identifier_kwargs(domain):
+    """
+    Returns the keyword argument naming the domain of an annotated challenge, which certbot 4.0 renamed.
+    """
+    if 'identifier' in achallenges.KeyAuthorizationAnnotatedChallenge.__slots__:
+        return {'identifier': messages.Identifier(typ=messages.IDENTIFIER_FQDN, value=domain)}
+    return {'domain': domain}
+
+
 class AuthenticatorTest(
     test_util.TempDirTestCase, dns_test_common.BaseAuthenticatorTest
 ):
@@ -37,18 +78,32 @@ class AuthenticatorTest(
 
         super(AuthenticatorTest, self).setUp()
         self.config = mock.MagicMock(
-            desec_credentials=path, desec_propagation_seconds=0
+            desec_credentials=path, desec_propagation_seconds=0, desec_propagation_check="sleep",
+            desec_zone_list_threshold=10, desec_resolver_nameservers=None, desec_resolver_timeout=5.0,
+            desec_resolver_concurrency=8, desec_zone_cache_ttl=0, desec_rate_limit="",
+            desec_async=False, desec_max_concurrency=8, desec_metrics_json=None, desec_metrics_textfile=None, desec_daemon_socket=None,
+            desec_challenge_ttl="", desec_prestage=False, desec_defer_cleanup=False, desec_prune_stale=None,
         )  # don't wait during tests
 
+        self.config.work_dir = self.tempdir
         self.auth = Authenticator(self.config, "desec")
         self.mock_zone = {'name': DOMAIN, 'minimum_ttl': 42}
 
-        self.mock_client = mock.MagicMock()
+        self.mock_client = mock_client()
         self.mock_client.get_authoritative_zone.return_value = self.mock_zone
+        self.mock_client.get_authoritative_zones.side_effect = lambda qnames, **kwargs: {
+            qname: self.mock_client.get_authoritative_zone(qname) for qname in qnames
+        }
         self.mock_client.get_txt_rrset.return_value = self.TXT
         # _get_desec_client | pylint: disable=protected-access
         self.auth._get_desec_client = mock.MagicMock(return_value=self.mock_client)
 
+    @staticmethod
+    def _achall(domain):
+        return achallenges.KeyAuthorizationAnnotatedChallenge(
+            challb=acme_util.DNS01, account_key=dns_test_common.KEY, **_identifier_kwargs(domain),
+        )
+
     @test_util.patch_display_util()
     def test_perform(self, unused_mock_get_utility):
         self.auth.perform([self.achall])
@@ -56,163 +111,692 @@ class AuthenticatorTest(
 
         self.mock_client.get_authoritative_zone.assert_called_once_with(f'_acme-challenge.{DOMAIN}')
         self.mock_client.get_txt_rrset.assert_called_once_with(self.mock_zone, "_acme-challenge")
-        self.mock_client.set_txt_rrset.assert_called_once_with(self.mock_zone, "_acme-challenge",
-                                                               self.TXT | {f'"{validation}"'})
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {
+            "_acme-challenge": self.TXT | {f'"{validation}"'},
+        })
+
+    @test_util.patch_display_util()
+    def test_perform_bulk_per_zone(self, unused_mock_get_utility):
+        other_zone = {'name': 'example.org', 'minimum_ttl': 3600}
+        self.mock_client.get_authoritative_zone.side_effect = \
+            lambda qname: other_zone if qname.endswith('example.org') else self.mock_zone
+        self.mock_client.get_txt_rrset.return_value = set()
+        achalls = [self._achall(domain) for domain in [DOMAIN, f'www.{DOMAIN}', f'sub.{DOMAIN}', 'example.org']]
+        wildcard = self._achall(DOMAIN)  # wildcard challenges share the validation name with the apex
+
+        self.auth.perform(achalls + [wildcard])
+
+        def validation(achall):
+            return f'"{achall.validation(achall.account_key)}"'
+
+        self.assertEqual(self.mock_client.set_txt_rrsets.call_count, 2)
+        self.mock_client.set_txt_rrsets.assert_any_call(self.mock_zone, {
+            "_acme-challenge": {validation(achalls[0]), validation(wildcard)},
+            "_acme-challenge.www": {validation(achalls[1])},
+            "_acme-challenge.sub": {validation(achalls[2])},
+        })
+        self.mock_client.set_txt_rrsets.assert_any_call(other_zone, {
+            "_acme-challenge": {validation(achalls[3])},
+        })
+        # one read per zone
+        self.assertEqual(sorted(len(call.args[1]) for call in self.mock_client.get_txt_rrsets.call_args_list), [1, 3])
+
+    @test_util.patch_display_util()
+    @patch('certbot_dns_desec.dns_desec._PropagationChecker.wait', return_value=True)
+    def test_perform_propagation_check(self, patched_wait, unused_mock_get_utility):
+        self.config.desec_propagation_check = "txt"
+        self.config.desec_propagation_seconds = 80
+        self.mock_client.get_txt_rrset.return_value = set()
+
+        self.auth.perform([self.achall])
+
+        validation = self.achall.validation(self.achall.account_key)
+        patched_wait.assert_called_once_with({DOMAIN: {f'_acme-challenge.{DOMAIN}': {f'"{validation}"'}}}, 80)
+
+    @test_util.patch_display_util()
+    @patch('time.sleep', return_value=None)
+    @patch('certbot_dns_desec.dns_desec._PropagationChecker.wait', return_value=None)
+    def test_perform_propagation_check_unavailable(self, patched_wait, patched_time_sleep, unused_mock_get_utility):
+        self.config.desec_propagation_check = "txt"
+        self.config.desec_propagation_seconds = 80
+        self.mock_client.get_txt_rrset.return_value = set()
+
+        self.auth.perform([self.achall])
+
+        patched_wait.assert_called_once()
+        patched_time_sleep.assert_called_once_with(80)  # the full propagation time, as without checking
+
+    @test_util.patch_display_util()
+    @patch('certbot_dns_desec.dns_desec._PropagationChecker.wait_for_serial', return_value=True)
+    def test_perform_propagation_check_soa(self, patched_wait, unused_mock_get_utility):
+        self.config.desec_propagation_check = "soa"
+        self.config.desec_propagation_seconds = 80
+        self.mock_client.get_txt_rrset.return_value = set()
+
+        self.auth.perform([self.achall])
+
+        validation = self.achall.validation(self.achall.account_key)
+        patched_wait.assert_called_once_with({DOMAIN: {f'_acme-challenge.{DOMAIN}': {f'"{validation}"'}}}, 80)
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    @test_util.patch_display_util()
+    def test_perform_async(self, unused_mock_get_utility):
+        self.config.desec_async = True
+        sent = []
+
+        def handler(request):
+            sent.append((request.method, str(request.url)))
+            if request.url.path == "/domains/":
+                zone_name = '.'.join(request.url.params['owns_qname'].split('.')[-2:])
+                return httpx.Response(200, json=[{'name': zone_name, 'minimum_ttl': 3600}])
+            if request.method == 'GET' and request.url.params.get('type') == 'TXT':
+                return httpx.Response(200, json=[])
+            if request.method == 'GET':
+                return httpx.Response(404, json={"detail": "Not found."})
+            return httpx.Response(200, json=json.loads(request.content))
+
+        client = async_api.AsyncDesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN)
+        client.transport = httpx.MockTransport(handler)
+        self.auth._get_async_desec_client = mock.MagicMock(return_value=client)
+
+        self.auth.perform([self._achall(domain) for domain in [DOMAIN, f'www.{DOMAIN}', 'www.example.org']])
+
+        self.assertEqual(sorted(url for method, url in sent if method == 'PUT'), [
+            f"{FAKE_ENDPOINT}/domains/example.com/rrsets/", f"{FAKE_ENDPOINT}/domains/example.org/rrsets/",
+        ])
+        self.assertIn(('GET', f"{FAKE_ENDPOINT}/domains/example.com/rrsets/?type=TXT&cursor="), sent)
+        self.assertEqual(len(sent), 7)  # 3 zone lookups, one RRset read and one bulk write per zone
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    def test_perform_async_rate_limited_many_zones(self):
+        import concurrent.futures
+
+        def handler(request):
+            if request.url.path == "/domains/":
+                zone_name = request.url.params['owns_qname'].split('.', 1)[1]
+                return httpx.Response(200, json=[{'name': zone_name, 'minimum_ttl': 3600}])
+            if request.method == 'GET':
+                return httpx.Response(404, json={"detail": "Not found."})
+            return httpx.Response(200, json=json.loads(request.content))
+
+        client = async_api.AsyncDesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN, rate_limiter=ratelimit.RateLimiter(
+            os.path.join(self.tempdir, "ratelimit.json"), ratelimit.RateLimiter.parse_rates("read:100/s,write:100/s"),
+        ))
+        client.transport = httpx.MockTransport(handler)
+        self.auth._get_async_desec_client = mock.MagicMock(return_value=client)
+        self.auth._setup_credentials()  # as done by perform
+        challenges = [(f"_acme-challenge.zone{i}.example", "a") for i in range(4)]
+
+        async def work():
+            # the rate limiter waits in the default executor, which must not be taken up by the zones' writes
+            asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+            try:
+                return await asyncio.wait_for(self.auth._desec_work_async(challenges, set.union), 10)
+            finally:
+                await client.aclose()
+
+        validations = asyncio.run(work())
+
+        self.assertEqual(len(validations), 4)
+
+    @test_util.patch_display_util()
+    def test_client_reused_until_cleanup(self, unused_mock_get_utility):
+        del self.auth._get_desec_client
+        self.config.desec_max_attempts, self.config.desec_retry_deadline = 4, 600
+        with patch('certbot_dns_desec.api.DesecConfigClient', return_value=self.mock_client) as client_class:
+            self.auth.perform([self.achall, self._achall(f"www.{DOMAIN}")])
+            self.auth.cleanup([self.achall, self._achall(f"www.{DOMAIN}")])
+            self.mock_client.close.assert_called_once_with()
+            self.auth.perform([self.achall])
+
+        self.assertEqual(client_class.call_count, 2)
+        self.assertEqual(client_class.call_args.args, (FAKE_ENDPOINT, FAKE_TOKEN))
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    @test_util.patch_display_util()
+    def test_async_client_reused_until_cleanup(self, unused_mock_get_utility):
+        self.config.desec_async, self.config.desec_http2 = True, False
+        self.config.desec_max_attempts, self.config.desec_retry_deadline = 4, 600
+        pools = []
+
+        def handler(request):
+            pools.append(client._client)
+            if request.url.path == "/domains/":
+                return httpx.Response(200, json=[{'name': DOMAIN, 'minimum_ttl': 3600}])
+            if request.method == 'GET':
+                return httpx.Response(404, json={"detail": "Not found."})
+            return httpx.Response(200, json=json.loads(request.content) if request.content else None)
+
+        client = async_api.AsyncDesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN)
+        client.transport = httpx.MockTransport(handler)
+        with patch('certbot_dns_desec.async_api.AsyncDesecConfigClient', return_value=client) as client_class:
+            self.auth.perform([self.achall])
+            self.auth.cleanup([self.achall])
+
+        self.assertEqual(client_class.call_count, 1)
+        self.assertEqual(len(pools), 5)  # zone lookup, RRset read and write on perform, RRset read and write on cleanup
+        self.assertEqual(len({id(pool) for pool in pools}), 1)
+        self.assertIsNone(client._client)
+        self.assertIsNone(self.auth._event_loop)
+
+    @test_util.patch_display_util()
+    def test_perform_zone_tokens(self, unused_mock_get_utility):
+        dns_test_common.write({
+            "desec_endpoint": FAKE_ENDPOINT, "desec_zone_tokens": "example.org:tokenB, sub.example.org:tokenC",
+        }, self.config.desec_credentials)
+        clients = {token: mock_client() for token in ["tokenB", "tokenC"]}
+        for client, zone_name in [(clients["tokenB"], 'example.org'), (clients["tokenC"], 'sub.example.org')]:
+            zone = {'name': zone_name, 'minimum_ttl': 3600}
+            client.get_authoritative_zones.side_effect = lambda qnames, zone=zone, **kwargs: {
+                qname: zone for qname in qnames
+            }
+            client.get_txt_rrset.return_value = set()
+        self.auth._get_desec_client = mock.MagicMock(side_effect=clients.get)
+
+        self.auth.perform([self._achall("example.org"), self._achall("www.sub.example.org")])
+
+        self.assertEqual(clients["tokenB"].set_txt_rrsets.call_args.args[0]['name'], 'example.org')
+        self.assertEqual(list(clients["tokenB"].set_txt_rrsets.call_args.args[1]), ["_acme-challenge"])
+        self.assertEqual(clients["tokenC"].set_txt_rrsets.call_args.args[0]['name'], 'sub.example.org')
+        self.assertEqual(list(clients["tokenC"].set_txt_rrsets.call_args.args[1]), ["_acme-challenge.www"])
+
+        with self.assertRaises(errors.PluginError):  # no dns_desec_token to fall back to
+            self.auth.perform([self.achall])
+
+    @test_util.patch_display_util()
+    def test_perform_zone_tokens_shared_components(self, unused_mock_get_utility):
+        del self.auth._get_desec_client
+        dns_test_common.write({
+            "desec_endpoint": FAKE_ENDPOINT, "desec_zone_tokens": "example.org:tokenB, example.net:tokenC",
+        }, self.config.desec_credentials)
+        self.config.desec_zone_cache_ttl, self.config.desec_max_attempts, self.config.desec_retry_deadline = 60, 4, 600
+        created = []
+
+        def client_class(endpoint, token, **kwargs):
+            created.append((token, threading.current_thread(), kwargs['zone_cache']))
+            client = mock_client(zone_cache=kwargs['zone_cache'])
+            zone = {'name': f"example.{'org' if token == 'tokenB' else 'net'}", 'minimum_ttl': 60}
+            client.get_authoritative_zones.return_value = {f"_acme-challenge.{zone['name']}": zone}
+            client.get_txt_rrset.return_value = set()
+            return client
+
+        with patch('certbot_dns_desec.api.DesecConfigClient', side_effect=client_class):
+            self.auth.perform([self._achall("example.org"), self._achall("example.net")])
+
+        self.assertEqual(sorted(token for token, _, _ in created), ["tokenB", "tokenC"])
+        # created before working on the accounts in threads, sharing one zone cache that is saved after the run
+        self.assertEqual({thread for _, thread, _ in created}, {threading.current_thread()})
+        self.assertIs(created[0][2], created[1][2])
+        self.assertIs(created[0][2], self.auth._zone_cache)
 
     def test_cleanup(self):
-        # _attempt_cleanup | pylint: disable=protected-access
+        validation = self.achall.validation(self.achall.account_key)
+        self.mock_client.get_txt_rrset.return_value = self.TXT | {f'"{validation}"'}
+        # _attempt_cleanup, _setup_credentials | pylint: disable=protected-access
         self.auth._attempt_cleanup = True
+        self.auth._setup_credentials()  # as done by perform
         self.auth.cleanup([self.achall])
 
         self.mock_client.get_authoritative_zone.assert_called_once_with(f'_acme-challenge.{DOMAIN}')
         self.mock_client.get_txt_rrset.assert_called_once_with(self.mock_zone, "_acme-challenge")
-        self.mock_client.set_txt_rrset.assert_called_once_with(self.mock_zone, "_acme-challenge", self.TXT)
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {"_acme-challenge": self.TXT})
+        self.assertEqual(self.auth.skipped_writes, 0)
 
+    @test_util.patch_display_util()
+    def test_metrics(self, unused_mock_get_utility):
+        self.config.desec_metrics_json = os.path.join(self.tempdir, "metrics.json")
+        self.config.desec_metrics_textfile = os.path.join(self.tempdir, "metrics.prom")
 
-class DesecConfigClientTest(unittest.TestCase):
-    record_name = "foo"
-    record_content = ["bar"]
-    record_ttl = 42
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
 
-    def setUp(self):
-        from certbot_dns_desec.dns_desec import _DesecConfigClient
-
-        self.adapter = requests_mock.Adapter()
-
-        self.client = _DesecConfigClient(FAKE_ENDPOINT, FAKE_TOKEN)
-        self.client.session.mount("mock", self.adapter)
-
-    def _register_response(self, url, response=None, requires_token=True, status=200):
-        def additional_matcher(request):
-            okay = True
-            okay &= request.headers["Content-Type"] == "application/json"
-            if requires_token:
-                okay &= request.headers["Authorization"] == f"Token {FAKE_TOKEN}"
-            return okay
-
-        self.adapter.register_uri(
-            method=requests_mock.ANY,
-            url=url,
-            text=json.dumps(response),
-            additional_matcher=additional_matcher,
-            status_code=status,
-        )
+        with open(self.config.desec_metrics_json) as f:
+            summary = json.load(f)
+        self.assertEqual(set(summary['phases']), {'cname_resolution', 'propagation_wait'})
+        self.assertEqual(summary['phases']['cname_resolution']['count'], 2)
+        with open(self.config.desec_metrics_textfile) as f:
+            textfile = f.read()
+        self.assertIn('certbot_dns_desec_duration_seconds_count{phase="propagation_wait"} 1\n', textfile)
+        self.assertTrue(textfile.endswith("# EOF\n"))
+
+    def test_cleanup_skips_unchanged(self):
+        # _attempt_cleanup, _setup_credentials | pylint: disable=protected-access
+        self.auth._attempt_cleanup = True
+        self.auth._setup_credentials()  # as done by perform
+        self.auth.cleanup([self.achall])
 
-    def test_get_authoritative_zone(self):
-        self._register_response(
-            url=f"{FAKE_ENDPOINT}/domains/?owns_qname=_acme-challenge.{DOMAIN}",
-            response=[
-                {
-                    "created": "2021-06-14T14:30:35.463899Z",
-                    "minimum_ttl": 3600,
-                    "name": 'name.to.be.extracted',
-                    "published": "2021-06-14T14:30:35.772212Z",
-                    "touched": "2021-06-14T14:30:35.772212Z"
-                }
-            ]
-        )
+        self.mock_client.get_txt_rrset.assert_called_once_with(self.mock_zone, "_acme-challenge")
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {})
+        self.assertEqual(self.auth.skipped_writes, 1)
 
-        zone = self.client.get_authoritative_zone(f"_acme-challenge.{DOMAIN}")
-        self.assertEqual(zone['name'], 'name.to.be.extracted')
-        self.assertEqual(zone['minimum_ttl'], 3600)
-
-    def test_set_txt_rrset(self):
-        self._register_response(
-            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            response=[
-                {
-                    "created": "2021-05-13T09:38:41.576975Z",
-                    "domain": DOMAIN,
-                    "subname": "_acme_challenge",
-                    "name": self.record_name,
-                    "records": [self.record_content],
-                    "ttl": self.record_ttl,
-                    "type": "TXT",
-                    "touched": "2021-05-13T09:38:41.585257Z"
-                }
-            ]
+    @test_util.patch_display_util()
+    def test_perform_skips_unchanged(self, unused_mock_get_utility):
+        present = self._achall(f"www.{DOMAIN}")
+        self.mock_client.get_txt_rrset.side_effect = lambda zone, subname: (
+            {f'"{present.validation(present.account_key)}"'} if subname == "_acme-challenge.www" else set()
         )
 
-        self.client.set_txt_rrset(
-            {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-        )
+        self.auth.perform([self.achall, present])
 
-    def test_set_txt_rrset_fail_to_find_domain(self):
-        self._register_response(
-            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            response={"detail": "Not found."},
-            status=404,
-        )
-        with self.assertRaises(errors.PluginError):
-            self.client.set_txt_rrset(
-                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-            )
-
-    def test_set_txt_rrset_fail_to_authenticate(self):
-        self._register_response(
-            url=f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            response={"detail": "Invalid token."},
-            status=403,
+        validation = self.achall.validation(self.achall.account_key)
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {
+            "_acme-challenge": {f'"{validation}"'},
+        })
+        self.assertEqual(self.auth.skipped_writes, 1)
+
+    @test_util.patch_display_util()
+    def test_perform_restores_ttl_on_cleanup(self, unused_mock_get_utility):
+        validation = f'"{self.achall.validation(self.achall.account_key)}"'
+        self.mock_client.get_txt_rrset.return_value = txt.TXTRecords(self.TXT, ttl=3600)
+        self.auth.perform([self.achall])
+        written = self.mock_client.set_txt_rrsets.call_args.args[1]["_acme-challenge"]
+        self.assertEqual((written, written.ttl), (self.TXT | {validation}, 42))
+
+        self.mock_client.get_txt_rrset.return_value = txt.TXTRecords(self.TXT | {validation}, ttl=42)
+        self.auth.cleanup([self.achall])
+        written = self.mock_client.set_txt_rrsets.call_args.args[1]["_acme-challenge"]
+        self.assertEqual((written, written.ttl), (self.TXT, 3600))
+
+    @test_util.patch_display_util()
+    def test_prestage(self, unused_mock_get_utility):
+        self.config.desec_prestage = True
+        self.mock_client.get_txt_rrset.return_value = txt.TXTRecords(self.TXT, ttl=3600)
+
+        with self.assertRaises(errors.PluginError) as error:
+            self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        self.assertIn("3600 seconds", str(error.exception))
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {"_acme-challenge": self.TXT})
+        self.assertEqual(self.mock_client.set_txt_rrsets.call_args.args[1]["_acme-challenge"].ttl, 42)
+
+    @test_util.patch_display_util()
+    def test_deferred_cleanup(self, unused_mock_get_utility):
+        validation = f'"{self.achall.validation(self.achall.account_key)}"'
+        self.config.desec_defer_cleanup = True
+        self.mock_client.get_txt_rrset.return_value = set()
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+        self.mock_client.set_txt_rrsets.assert_called_once_with(self.mock_zone, {"_acme-challenge": {validation}})
+
+        # the next run removes the record before adding its own
+        self.mock_client.set_txt_rrsets.reset_mock()
+        self.mock_client.get_txt_rrset.return_value = self.TXT | {validation}
+        other = self._achall(f"www.{DOMAIN}")
+        self.auth.perform([other])
+
+        self.assertEqual(self.mock_client.set_txt_rrsets.call_args_list[0],
+                         mock.call(self.mock_zone, {"_acme-challenge": self.TXT}))
+        self.assertFalse(self.auth._get_cleanup_journal().pending())
+
+    @test_util.patch_display_util()
+    def test_perform_daemon(self, unused_mock_get_utility):
+        self.config.desec_daemon_socket = os.path.join(self.tempdir, "daemon.sock")
+        self.config.desec_credentials = os.path.join(self.tempdir, "missing.ini")  # not read when using the daemon
+        self.config.desec_daemon_timeout = 1800
+        validation = self.achall.validation(self.achall.account_key)
+
+        with patch('certbot_dns_desec.dns_desec._DaemonClient') as daemon_client:
+            apply = daemon_client.return_value.apply
+            apply.return_value = {}
+            self.auth.perform([self.achall])
+            self.auth.cleanup([self.achall])
+
+        daemon_client.assert_called_with(self.config.desec_daemon_socket, timeout=1800)
+        apply.assert_any_call([(f'_acme-challenge.{DOMAIN}', validation)], set.union)
+        apply.assert_called_with([(f'_acme-challenge.{DOMAIN}', validation)], set.difference)
+        self.auth._get_desec_client.assert_not_called()
+
+
+class ImportTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        # certbot imports all installed plugins on every run, so importing this one must stay cheap. requests is not
+        # checked, as certbot's dns_common already imports it.
+        lazy = {'asyncio', 'concurrent', 'dns', 'httpx', 'zope'}
+        code = (
+            "import sys; import certbot.plugins.dns_common; before = set(sys.modules); print(' '.join(before)); "
+            "import certbot_dns_desec.dns_desec; print(' '.join(set(sys.modules) - before))"
         )
-        with self.assertRaises(errors.PluginError):
-            self.client.set_txt_rrset(
-                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-            )
+        before, loaded = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, check=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.split('\n')[:2]
+        self.assertEqual({name.split('.')[0] for name in before.split()} & lazy, set())  # or the check would be moot
+        self.assertEqual({name.split('.')[0] for name in loaded.split()} & lazy, set())
+
+
+class CnameResolverTest(unittest.TestCase):
+    CNAMES = {
+        f"_acme-challenge.{DOMAIN}": "a.example.org",
+        "a.example.org": "b.example.org",
+        f"_acme-challenge.www.{DOMAIN}": "b.example.org",
+    }
+
+    def setUp(self):
+        from certbot_dns_desec.dns_desec import _CnameResolver
+
+        self.resolver = _CnameResolver(nameservers=['192.0.2.53'], timeout=2, concurrency=4)
+        self.resolver.resolver = mock.MagicMock()
+        self.resolver.resolver.resolve.side_effect = self._resolve
+
+    def _resolve(self, name, rdtype):
+        import dns.name
+        import dns.resolver
+
+        self.assertEqual(rdtype, 'CNAME')
+        if name not in self.CNAMES:
+            raise dns.resolver.NXDOMAIN if name.startswith('nx') else dns.resolver.NoAnswer
+        return [mock.MagicMock(target=dns.name.from_text(self.CNAMES[name]))]
+
+    def test_configuration(self):
+        from certbot_dns_desec.dns_desec import _CnameResolver
+
+        resolver = _CnameResolver(nameservers=['192.0.2.53'], timeout=2).resolver
+        self.assertEqual(resolver.nameservers, ['192.0.2.53'])
+        self.assertEqual(resolver.lifetime, 2)
+
+    def test_resolve_all(self):
+        names = [f"_acme-challenge.{DOMAIN}", f"_acme-challenge.www.{DOMAIN}", "nx.example.net", "b.example.org"]
+        self.assertEqual(self.resolver.resolve_all(names + names[:1]), {
+            f"_acme-challenge.{DOMAIN}": "b.example.org",
+            f"_acme-challenge.www.{DOMAIN}": "b.example.org",
+            "nx.example.net": "nx.example.net",
+            "b.example.org": "b.example.org",
+        })
+        lookups = {c.args[0] for c in self.resolver.resolver.resolve.call_args_list}
+        self.assertEqual(lookups, set(names) | {"a.example.org"})
+
+        # results, including negative ones, are memoized
+        self.resolver.resolver.resolve.reset_mock()
+        self.resolver.resolve_all(names)
+        self.resolver.resolver.resolve.assert_not_called()
+
+    def test_chain_length_limit(self):
+        self.CNAMES = {f"{i}.example": f"{i + 1}.example" for i in range(10)}
+        self.assertEqual(self.resolver.resolve("0.example"), "7.example")
+
+    def test_no_resolver_configuration(self):
+        self.resolver.resolver = None
+        self.assertEqual(self.resolver.resolve_all(["a.example"]), {"a.example": "a.example"})
+
+
+class PropagationCheckerTest(unittest.TestCase):
+    def setUp(self):
+        from certbot_dns_desec.dns_desec import _PropagationChecker
+
+        self.checker = _PropagationChecker()
+        self.checker.authoritative_addresses = mock.MagicMock(return_value=['192.0.2.1', '192.0.2.2'])
+        self.served = {'192.0.2.1': [], '192.0.2.2': []}
+        self.checker.query_txt = mock.MagicMock(side_effect=lambda address, qname: self._answer(self.served, address))
+        self.expected = {DOMAIN: {f'_acme-challenge.{DOMAIN}': {'"token"'}}}
 
     @patch('time.sleep', return_value=None)
-    def test_set_txt_rrset_throttling_retry(self, patched_time_sleep):
-        self.adapter.register_uri(
-            'PUT',
-            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            [
-                dict(status_code=429, headers={'Retry-After': '2'}),
-                dict(status_code=429, headers={'Retry-After': '31'}),
-                dict(status_code=200),
-            ]
-        )
-        self.client.set_txt_rrset(
-            {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-        )
-        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(2), mock.call(31)])
+    def test_wait_backoff(self, patched_time_sleep):
+        self.served['192.0.2.1'] = [set(), {'"token"', '"other"'}]
+        self.served['192.0.2.2'] = [set(), set(), {'"token"'}]
+
+        self.assertTrue(self.checker.wait(self.expected, 80))
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(1), mock.call(2)])
+        self.assertEqual(self.checker.query_txt.call_count, 5)
 
     @patch('time.sleep', return_value=None)
-    def test_set_txt_rrset_throttling_retry_fail(self, patched_time_sleep):
-        self.adapter.register_uri(
-            'PUT',
-            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            [
-                dict(status_code=429, headers={'Retry-After': '2'}),
-            ] * 4
-        )
-        with self.assertRaises(errors.PluginError):
-            self.client.set_txt_rrset(
-                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-            )
-        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(2)] * 3)
-
-    def test_set_txt_rrset_throttling_no_retry(self):
-        self.adapter.register_uri(
-            'PUT',
-            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            [
-                dict(status_code=429),  # no Retry-After header
-            ]
-        )
-        with self.assertRaises(errors.PluginError):
-            self.client.set_txt_rrset(
-                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-            )
-        self.adapter.register_uri(
-            'PUT',
-            f"{FAKE_ENDPOINT}/domains/{DOMAIN}/rrsets/",
-            [
-                dict(status_code=429, headers={'Retry-After': 'asdf'}),  # Retry-After header not int
-            ]
-        )
+    def test_wait_immediate(self, patched_time_sleep):
+        self.served['192.0.2.1'] = [{'"token"'}]
+        self.served['192.0.2.2'] = [{'"token"'}]
+
+        self.assertTrue(self.checker.wait(self.expected, 80))
+        patched_time_sleep.assert_not_called()
+
+    @patch('time.sleep', return_value=None)
+    def test_wait_timeout(self, patched_time_sleep):
+        self.served['192.0.2.1'] = [set()] * 10
+        self.served['192.0.2.2'] = [set()] * 10
+
+        self.assertFalse(self.checker.wait(self.expected, 0))
+        patched_time_sleep.assert_not_called()
+
+    @patch('time.sleep', return_value=None)
+    def test_wait_for_serial(self, patched_time_sleep):
+        self.expected[DOMAIN][f'_acme-challenge.www.{DOMAIN}'] = {'"other"'}
+        self.served['192.0.2.1'] = [set(), {'"token"'}]
+        self.served['192.0.2.2'] = [set()]
+        serials = {'192.0.2.1': [7, 7, 7], '192.0.2.2': [6, 8]}
+        self.checker.query_soa_serial = mock.MagicMock(side_effect=lambda address, zone: serials[address].pop(0))
+
+        self.assertTrue(self.checker.wait_for_serial(self.expected, 80))
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(1), mock.call(2)])
+        # only the first name is spot-checked, and only until one nameserver serves it
+        self.assertEqual(self.checker.query_txt.call_args_list, [
+            mock.call('192.0.2.1', f'_acme-challenge.{DOMAIN}'),
+            mock.call('192.0.2.2', f'_acme-challenge.{DOMAIN}'),
+            mock.call('192.0.2.1', f'_acme-challenge.{DOMAIN}'),
+        ])
+        self.assertEqual(self.checker.query_soa_serial.call_count, 5)
+
+    @patch('time.sleep', return_value=None)
+    def test_wait_for_serial_timeout(self, patched_time_sleep):
+        self.served['192.0.2.1'] = [{'"token"'}]
+        self.checker.query_soa_serial = mock.MagicMock(side_effect=[5, 5, 4])
+
+        self.assertFalse(self.checker.wait_for_serial(self.expected, 0))
+        patched_time_sleep.assert_not_called()
+
+    @staticmethod
+    def _answer(answers, address):
+        if isinstance(answers[address], Exception):
+            raise answers[address]
+        return answers[address].pop(0)
+
+    @patch('time.sleep', return_value=None)
+    def test_wait_unreachable_address(self, patched_time_sleep):
+        self.checker.authoritative_addresses.return_value += ['2001:db8::1']
+        self.served['2001:db8::1'] = OSError(errno.ENETUNREACH, "Network is unreachable")
+        self.served['192.0.2.1'] = [set(), {'"token"'}]
+        self.served['192.0.2.2'] = [{'"token"'}]
+
+        self.assertTrue(self.checker.wait(self.expected, 80))
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(1)])
+        self.assertEqual(self.checker.query_txt.call_count, 4)  # the unreachable address is queried once
+
+    @patch('time.sleep', return_value=None)
+    def test_wait_for_serial_unreachable_address(self, patched_time_sleep):
+        self.checker.authoritative_addresses.return_value = ['2001:db8::1', '192.0.2.1', '192.0.2.2']
+        self.served['2001:db8::1'] = OSError(errno.ENETUNREACH, "Network is unreachable")
+        self.served['192.0.2.1'] = [{'"token"'}]
+        serials = {'192.0.2.1': [7, 7, 7], '192.0.2.2': [6, 7]}
+        self.checker.query_soa_serial = mock.MagicMock(side_effect=lambda address, zone: self._answer(serials, address))
+
+        self.assertTrue(self.checker.wait_for_serial(self.expected, 80))
+        self.assertEqual(patched_time_sleep.call_args_list, [mock.call(1)])
+        self.assertEqual(self.checker.query_txt.call_count, 2)
+
+    @patch('time.sleep', return_value=None)
+    def test_nameservers_unreachable(self, patched_time_sleep):
+        self.checker.authoritative_addresses.return_value = ['2001:db8::1']
+        self.served['2001:db8::1'] = OSError(errno.ENETUNREACH, "Network is unreachable")
+
+        self.assertIsNone(self.checker.wait(self.expected, 80))
+        self.assertIsNone(self.checker.wait_for_serial(self.expected, 80))
+        patched_time_sleep.assert_not_called()
+
+    @patch('time.sleep', return_value=None)
+    def test_nameservers_unknown(self, patched_time_sleep):
+        import dns.resolver
+
+        self.checker.authoritative_addresses.return_value = []
+        self.assertIsNone(self.checker.wait(self.expected, 80))
+        self.checker.authoritative_addresses.side_effect = dns.resolver.NoResolverConfiguration
+        self.assertIsNone(self.checker.wait_for_serial(self.expected, 80))
+        self.checker.query_txt.assert_not_called()
+        patched_time_sleep.assert_not_called()
+
+    def test_serial_reached(self):
+        self.assertTrue(self.checker.serial_reached(7, 7))
+        self.assertTrue(self.checker.serial_reached(8, 7))
+        self.assertFalse(self.checker.serial_reached(6, 7))
+        self.assertFalse(self.checker.serial_reached(None, 7))
+        self.assertTrue(self.checker.serial_reached(3, 2 ** 32 - 3))  # wrapped around
+
+
+class ZoneCacheTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(ZoneCacheTest, self).setUp()
+        from certbot_dns_desec.dns_desec import _ZoneCache
+
+        self.cache_class = _ZoneCache
+        self.path = os.path.join(self.tempdir, "zones.json")
+
+    def test_persistence(self):
+        cache = self.cache_class(self.path, ttl=60)
+        self.assertIsNone(cache.get(f"_acme-challenge.{DOMAIN}"))
+        cache.put(f"_acme-challenge.{DOMAIN}", {'name': DOMAIN, 'minimum_ttl': 3600, 'created': 'ignored'})
+        cache.save()
+
+        cache = self.cache_class(self.path, ttl=60)
+        self.assertEqual(cache.get(f"_acme-challenge.{DOMAIN}"), {'name': DOMAIN, 'minimum_ttl': 3600})
+
+    def test_expiry(self):
+        cache = self.cache_class(self.path, ttl=60)
+        with patch('time.time', return_value=1000):
+            cache.put(DOMAIN, {'name': DOMAIN, 'minimum_ttl': 3600})
+        with patch('time.time', return_value=1059):
+            self.assertIsNotNone(cache.get(DOMAIN))
+        with patch('time.time', return_value=1060):
+            self.assertIsNone(cache.get(DOMAIN))
+
+    def test_lru_eviction(self):
+        cache = self.cache_class(self.path, ttl=60, max_entries=2)
+        for i, qname in enumerate(["a.example", "b.example", "c.example"]):
+            with patch('time.time', return_value=1000 + i):
+                cache.put(qname, {'name': 'example', 'minimum_ttl': 3600})
+        with patch('time.time', return_value=1010):
+            cache.get("a.example")
+            cache.save()
+
+        with patch('time.time', return_value=1020):
+            cache = self.cache_class(self.path, ttl=60)
+            self.assertEqual(set(cache.entries), {"a.example", "c.example"})
+
+    def test_invalidate_zone(self):
+        cache = self.cache_class(self.path, ttl=60)
+        cache.put("a.example.com", {'name': DOMAIN, 'minimum_ttl': 3600})
+        cache.put("a.example.org", {'name': 'example.org', 'minimum_ttl': 3600})
+        cache.invalidate_zone(DOMAIN)
+        self.assertIsNone(cache.get("a.example.com"))
+        self.assertIsNotNone(cache.get("a.example.org"))
+
+    def test_corrupt_file(self):
+        with open(self.path, 'w') as f:
+            f.write("{not json")
+        self.assertEqual(self.cache_class(self.path, ttl=60).entries, {})
+
+
+class WriteTXTRRsetsTest(test_util.TempDirTestCase):
+    STALE = ['"' + c * 43 + '"' for c in "ab"]
+
+    @unittest.skipIf(fcntl is None, "flock is not available")
+    def test_prune_spares_live_validations(self):
+        from certbot_dns_desec.dns_desec import _write_txt_rrsets
+        zone = {'name': DOMAIN, 'minimum_ttl': 60}
+        first, second = self.STALE[:2]
+        locks = locking.RRsetLocks(self.tempdir)
+        client = mock_client()
+
+        def write(records, changes):
+            client.get_txt_rrset.return_value = records
+            _write_txt_rrsets(client, locks, zone, {"_acme-challenge": changes}, prune_stale=0)
+            return client.set_txt_rrsets.call_args.args[1]["_acme-challenge"]
+
+        write(set(), [(set.union, {first})])
+        # a concurrent run on the host does not prune the first run's pending validation
+        self.assertEqual(write({first}, [(set.union, {second})]), {first, second})
+        write({first, second}, [(set.difference, {first})])
+        # once removed by its run, a leftover copy of it is stale
+        self.assertEqual(write({first, second, '"static"'}, [(set.difference, {second})]), {'"static"'})
+
+
+class ChallengeTTLsTest(test_util.TempDirTestCase):
+    VALIDATION = '"' + 'a' * 43 + '"'
+
+    def setUp(self):
+        super(ChallengeTTLsTest, self).setUp()
+        from certbot_dns_desec.dns_desec import _ChallengeTTLs
+
+        self.records_class = txt.TXTRecords
+        self.ttls = _ChallengeTTLs(os.path.join(self.tempdir, "ttls.json"))
+        self.zone = {'name': DOMAIN, 'minimum_ttl': 60}
+
+    def _saved(self):
+        with open(self.ttls.path) as f:
+            return json.load(f)
+
+    def test_parse_overrides(self):
+        from certbot_dns_desec.dns_desec import _ChallengeTTLs
+
+        self.assertEqual(_ChallengeTTLs.parse_overrides(""), {})
+        self.assertEqual(_ChallengeTTLs.parse_overrides("300, Example.com.:120"), {'': 300, DOMAIN: 120})
         with self.assertRaises(errors.PluginError):
-            self.client.set_txt_rrset(
-                {'name': DOMAIN, 'minimum_ttl': self.record_ttl}, self.record_name, self.record_content
-            )
+            _ChallengeTTLs.parse_overrides("example.com:soon")
+
+    def test_challenge_ttl(self):
+        self.assertEqual(self.ttls.challenge_ttl(self.zone), 60)
+        self.ttls.overrides = {'': 300, DOMAIN: 30}
+        self.assertEqual(self.ttls.challenge_ttl(self.zone), 60)  # raised to the zone's minimum
+        self.assertEqual(self.ttls.challenge_ttl({'name': 'example.org', 'minimum_ttl': 60}), 300)
+
+    def test_lower_and_restore(self):
+        static = self.records_class({'"static"'}, ttl=3600)
+        rrsets = self.ttls.apply(self.zone, {"_acme-challenge": static},
+                                 {"_acme-challenge": {'"static"', self.VALIDATION}})
+        self.assertEqual(rrsets["_acme-challenge"].ttl, 60)
+        self.assertEqual(self._saved(), {f"_acme-challenge.{DOMAIN}": 3600})
+
+        current = self.records_class({'"static"', self.VALIDATION}, ttl=60)
+        rrsets = self.ttls.apply(self.zone, {"_acme-challenge": current}, {"_acme-challenge": {'"static"'}})
+        self.assertEqual(rrsets["_acme-challenge"].ttl, 3600)
+        self.assertEqual(self._saved(), {})
+
+    def test_restore_waits_for_other_validations(self):
+        self.ttls.lower(self.zone, {"x": self.records_class({'"static"'}, ttl=3600)}, {})
+        current = self.records_class({'"static"', self.VALIDATION, '"' + 'b' * 43 + '"'}, ttl=60)
+
+        rrsets = self.ttls.apply(self.zone, {"x": current}, {"x": {'"static"', self.VALIDATION}})
+
+        self.assertEqual(rrsets["x"].ttl, 60)
+        self.assertEqual(self._saved(), {f"x.{DOMAIN}": 3600})
+
+    def test_new_rrset(self):
+        rrsets = self.ttls.apply(self.zone, {"x": self.records_class()}, {"x": {self.VALIDATION}})
+
+        self.assertEqual(rrsets["x"].ttl, 60)
+        self.assertFalse(os.path.exists(self.ttls.path))
+
+    def test_lower(self):
+        records = {
+            "a": self.records_class({'"static"'}, ttl=3600),
+            "b": self.records_class({'"static"'}, ttl=60),
+            "c": self.records_class(),
+        }
+
+        lowered, originals = self.ttls.lower(self.zone, records, {})
+
+        self.assertEqual(lowered, {"a": {'"static"'}})
+        self.assertEqual(lowered["a"].ttl, 60)
+        self.assertEqual(originals, {f"a.{DOMAIN}": 3600})
+        self.assertEqual(self._saved(), originals)
+
+
+class ParseZoneTokensTest(unittest.TestCase):
+    def test_parse(self):
+        from certbot_dns_desec.dns_desec import _parse_zone_tokens
+
+        self.assertEqual(_parse_zone_tokens(None), [])
+        self.assertEqual(_parse_zone_tokens("Example.org.:tokenB, other.net:tokenC,"), [
+            ("example.org", "tokenB"), ("other.net", "tokenC"),
+        ])
+        for spec in ["example.org", "example.org:", ":tokenB"]:
+            with self.assertRaises(errors.PluginError):
+                _parse_zone_tokens(spec)
 
 
 if __name__ == "__main__":
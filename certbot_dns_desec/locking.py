@@ -0,0 +1,205 @@
+"""Per-RRset locks and queues in the work directory, which let processes on the host write changes for each other."""
+import contextlib
+import json
+import logging
+import time
+
+from certbot.compat import filesystem
+from certbot.compat import os
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the state files are not locked
+    fcntl = None
+
+from certbot_dns_desec import txt
+
+logger = logging.getLogger(__name__)
+
+
+def edit_json_lines(path, edit, sync=False):
+    """
+    Replaces the entries of the JSON lines file at ``path`` by ``edit(entries)`` while holding its ``flock``.
+
+    :param sync: whether to flush the file to disk before releasing the lock
+    :return: the edited entries
+    """
+    with open(path, 'a+') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        entries = [json.loads(line) for line in f if line.strip()]
+        edited = edit(entries)
+        if edited != entries:
+            f.seek(0)
+            f.truncate()
+            f.write(''.join(json.dumps(entry) + '\n' for entry in edited))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    return edited
+
+
+class RRsetLocks(object):
+    """
+    Serializes the read-modify-write cycles on TXT RRsets of all processes on the host, with one lock file per RRset.
+
+    Changes are first queued in a file next to the lock. The process that gets the lock applies all queued changes,
+    including those of processes still waiting for it, and removes them from the queue once written; processes whose
+    changes were written this way have nothing left to do when they get the lock. Queued changes older than
+    ``max_age`` seconds, e.g. of crashed processes, are discarded.
+
+    The validations that were added to each RRset and not removed yet are tracked in a third file, so that they are
+    not pruned as stale by other processes while their challenge is pending. They are forgotten after
+    ``live_max_age`` seconds. Without ``flock`` (on Windows), nothing is locked or tracked.
+    """
+
+    def __init__(self, directory, max_age=3600, live_max_age=86400):
+        self.directory = directory
+        self.max_age = max_age
+        self.live_max_age = live_max_age
+
+    def _path(self, zone_name, subname, suffix):
+        return os.path.join(self.directory, f"{txt.fqdn(subname, zone_name)}.{suffix}")
+
+    @staticmethod
+    def _edit_queue(path, edit):
+        return edit_json_lines(path, edit)
+
+    @contextlib.contextmanager
+    def hold(self, zone_name, changes):
+        """
+        Context manager around `acquire`, yielding the batch and committing it if no exception occurs.
+        """
+        batch = self.acquire(zone_name, changes)
+        try:
+            yield batch
+            batch.commit()
+        finally:
+            batch.release()
+
+    def acquire(self, zone_name, changes):
+        """
+        Queues ``changes`` and locks their RRsets, waiting for other processes holding any of them.
+
+        :param changes: mapping of subname to a list of ``(set_operator, values)`` to apply in order
+        :return: `RRsetBatch` whose ``changes`` hold the queued changes of all processes for the RRsets that still
+            need to be written
+        """
+        if fcntl is None:
+            return RRsetBatch(self, zone_name, changes, {}, [])
+        try:
+            filesystem.makedirs(self.directory, 0o700)
+        except FileExistsError:
+            pass
+        import uuid
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        for subname in sorted(changes):
+            queued = [
+                {'id': batch_id, 'time': now, 'action': txt.ACTIONS[set_operator], 'values': sorted(values)}
+                for set_operator, values in changes[subname]
+            ]
+            self._edit_queue(self._path(zone_name, subname, 'queue'), lambda entries: entries + queued)
+
+        locks = []
+        try:
+            for subname in sorted(changes):  # always lock in the same order, so that processes cannot deadlock
+                lock = open(self._path(zone_name, subname, 'lock'), 'a')
+                locks.append(lock)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+        except BaseException:
+            for lock in locks:
+                lock.close()
+            raise
+
+        pending, entry_ids = {}, {}
+        for subname in sorted(changes):
+            entries = self._edit_queue(
+                self._path(zone_name, subname, 'queue'),
+                lambda entries: [entry for entry in entries if entry['time'] > time.time() - self.max_age],
+            )
+            if not any(entry['id'] == batch_id for entry in entries):
+                logger.debug("TXT records of %s were already written by another process",
+                             txt.fqdn(subname, zone_name))
+                continue
+            pending[subname] = [(txt.OPERATORS[entry['action']], set(entry['values'])) for entry in entries]
+            entry_ids[subname] = {entry['id'] for entry in entries}
+        return RRsetBatch(self, zone_name, pending, entry_ids, locks)
+
+    def live_validations(self, zone_name, subnames):
+        """
+        Returns the validations that were added to the given RRsets within ``live_max_age`` and not removed yet.
+
+        :return: mapping of subname to the set of (quoted) validation values
+        """
+        if fcntl is None:
+            return {}
+        cutoff = time.time() - self.live_max_age
+        return {
+            subname: {entry['value'] for entry in edit_json_lines(
+                self._path(zone_name, subname, 'live'),
+                lambda entries: [entry for entry in entries if entry['time'] > cutoff],
+            )}
+            for subname in subnames
+        }
+
+    def track(self, zone_name, changes):
+        """
+        Records the validations added to and removed from RRsets by written changes, see `live_validations`.
+
+        :param changes: mapping of subname to a list of ``(set_operator, values)`` that were written
+        """
+        if fcntl is None:
+            return
+        now = time.time()
+        for subname, operations in changes.items():
+            def edit(entries, operations=operations):
+                live = {entry['value']: entry for entry in entries if entry['time'] > now - self.live_max_age}
+                for set_operator, values in operations:
+                    for value in filter(txt.VALIDATION.match, values):
+                        if set_operator is set.union:
+                            live[value] = {'value': value, 'time': now}
+                        else:
+                            live.pop(value, None)
+                return list(live.values())
+
+            edit_json_lines(self._path(zone_name, subname, 'live'), edit)
+
+    def dequeue(self, zone_name, entry_ids):
+        """
+        Removes queued changes after they have been written.
+
+        :param entry_ids: mapping of subname to the ids of the changes to remove
+        """
+        for subname, ids in entry_ids.items():
+            self._edit_queue(
+                self._path(zone_name, subname, 'queue'),
+                lambda entries: [entry for entry in entries if entry['id'] not in ids],
+            )
+
+
+class RRsetBatch(object):
+    """
+    Changes to a zone's TXT RRsets whose locks are held by this process, see `RRsetLocks.acquire`.
+    """
+
+    def __init__(self, locks, zone_name, changes, entry_ids, files):
+        self.locks = locks
+        self.zone_name = zone_name
+        self.changes = changes
+        self.entry_ids = entry_ids  # subname -> ids of the queued changes included in self.changes
+        self.files = files
+        # number of queued changes of other processes that are included, counted per RRset
+        self.combined = sum(len(ids) - 1 for ids in entry_ids.values())
+
+    def commit(self):
+        """
+        Removes the included changes from the queues, after they have been written.
+        """
+        self.locks.dequeue(self.zone_name, self.entry_ids)
+        self.entry_ids = {}
+
+    def release(self):
+        for f in self.files:
+            f.close()
+        self.files = []
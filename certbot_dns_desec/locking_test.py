@@ -0,0 +1,73 @@
+"""Tests for certbot_dns_desec.locking."""
+
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from certbot import errors
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import locking
+
+
+class RRsetLocksTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(RRsetLocksTest, self).setUp()
+
+        self.locks = locking.RRsetLocks(os.path.join(self.tempdir, "locks"))
+        self.queue_path = os.path.join(self.tempdir, "locks", f"_acme-challenge.{DOMAIN}.queue")
+
+    def _queued(self):
+        with open(self.queue_path) as f:
+            return len(f.readlines())
+
+    def test_combine_waiting(self):
+        holder = self.locks.acquire(DOMAIN, {"_acme-challenge": [(set.union, {'"a"'})]})
+        self.assertEqual(holder.changes, {"_acme-challenge": [(set.union, {'"a"'})]})
+        results = {}
+
+        def wait(name, set_operator):
+            with self.locks.hold(DOMAIN, {"_acme-challenge": [(set_operator, {f'"{name}"'})]}) as batch:
+                results[name] = batch.changes, batch.combined
+
+        waiters = []
+        for name, set_operator in [("b", set.union), ("c", set.difference)]:
+            waiters.append(threading.Thread(target=wait, args=(name, set_operator)))
+            waiters[-1].start()
+            while self._queued() < len(waiters) + 1:
+                time.sleep(.01)
+        holder.commit()
+        holder.release()
+        for waiter in waiters:
+            waiter.join()
+
+        # the first waiter to get the lock writes the changes of both, the other one has nothing left to do
+        (first, changes, combined), (second, *_) = sorted(
+            [(name, *result) for name, result in results.items()], key=lambda item: -len(item[1]),
+        )
+        self.assertEqual(changes, {"_acme-challenge": [(set.union, {'"b"'}), (set.difference, {'"c"'})]})
+        self.assertEqual(combined, 1)
+        self.assertEqual(results[second], ({}, 0))
+        self.assertEqual(self._queued(), 0)
+
+    def test_failed_write_stays_queued(self):
+        with self.assertRaises(errors.PluginError):
+            with self.locks.hold(DOMAIN, {"_acme-challenge": [(set.union, {'"a"'})]}):
+                raise errors.PluginError("Write failed")
+
+        with self.locks.hold(DOMAIN, {"_acme-challenge": [(set.union, {'"b"'})]}) as batch:
+            self.assertEqual(batch.changes, {"_acme-challenge": [(set.union, {'"a"'}), (set.union, {'"b"'})]})
+
+    def test_stale_entries_discarded(self):
+        with patch('time.time', return_value=time.time() - 7200):
+            self.locks.acquire(DOMAIN, {"_acme-challenge": [(set.union, {'"old"'})]}).release()
+
+        with self.locks.hold(DOMAIN, {"_acme-challenge": [(set.union, {'"a"'})]}) as batch:
+            self.assertEqual(batch.changes, {"_acme-challenge": [(set.union, {'"a"'})]})
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
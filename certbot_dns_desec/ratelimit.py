@@ -0,0 +1,86 @@
+"""Client-side rate limiting of deSEC API requests, shared by all processes on the host."""
+import json
+import logging
+import threading
+import time
+
+from certbot import errors
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the state files are not locked
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter whose state is kept in a file, so that all processes on the host share one budget.
+
+    Each request category (e.g. ``read``, ``write``) can have several buckets, one per limit. Access to the state file
+    is serialized with ``flock`` where available.
+    """
+
+    DEFAULT_RATES = "read:10/s,read:50/min,write:2/s,write:15/min,write:30/h"
+    UNITS = {'s': 1, 'min': 60, 'h': 3600}
+
+    def __init__(self, path, rates):
+        """
+        :param path: path of the shared state file
+        :param rates: mapping of category to a list of ``(requests, seconds)`` limits
+        """
+        self.path = path
+        self.rates = rates
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse_rates(cls, spec):
+        rates = {}
+        for entry in spec.split(','):
+            if not entry.strip():
+                continue
+            try:
+                category, rate = entry.strip().split(':')
+                count, unit = rate.split('/')
+                rates.setdefault(category, []).append((int(count), cls.UNITS[unit]))
+            except (ValueError, KeyError):
+                raise errors.PluginError(f"Invalid rate limit '{entry}', expected <category>:<requests>/<s|min|h>")
+        return rates
+
+    def acquire(self, category):
+        """
+        Blocks until a request of the given category is allowed and takes a token from each of its buckets.
+
+        :return: number of seconds spent waiting
+        """
+        limits = self.rates.get(category)
+        if not limits:
+            return 0
+        waited = 0
+        while True:
+            with self.lock, open(self.path, 'a+') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                now = time.time()
+                delay = 0
+                buckets = {}
+                for count, seconds in limits:
+                    key = f"{category}:{count}/{seconds}"
+                    bucket = state.get(key, {'tokens': count, 'updated': now})
+                    tokens = min(count, bucket['tokens'] + max(now - bucket['updated'], 0) * count / seconds)
+                    buckets[key] = tokens
+                    delay = max(delay, (1 - tokens) * seconds / count)
+                if delay < 1e-6:  # tolerate floating point error in the refill computation
+                    state.update({key: {'tokens': tokens - 1, 'updated': now} for key, tokens in buckets.items()})
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    return waited
+            logger.debug("Client-side rate limit for %s requests reached, waiting %.2fs", category, delay)
+            time.sleep(delay)
+            waited += delay
@@ -0,0 +1,54 @@
+"""Tests for certbot_dns_desec.ratelimit."""
+
+import unittest
+from unittest.mock import patch
+
+from certbot import errors
+from certbot.compat import os
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import ratelimit
+
+
+class RateLimiterTest(test_util.TempDirTestCase):
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+
+        self.limiter_class = ratelimit.RateLimiter
+        self.path = os.path.join(self.tempdir, "ratelimit.json")
+        self.now = 1000.0
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    def test_parse_rates(self):
+        self.assertEqual(self.limiter_class.parse_rates(self.limiter_class.DEFAULT_RATES), {
+            'read': [(10, 1), (50, 60)],
+            'write': [(2, 1), (15, 60), (30, 3600)],
+        })
+        self.assertEqual(self.limiter_class.parse_rates(""), {})
+        for spec in ["read", "read:10", "read:x/s", "read:10/d"]:
+            with self.assertRaises(errors.PluginError):
+                self.limiter_class.parse_rates(spec)
+
+    def test_acquire_shared_between_instances(self):
+        rates = {'write': [(2, 1), (3, 60)]}
+        limiters = [self.limiter_class(self.path, rates), self.limiter_class(self.path, rates)]
+        with patch('time.time', side_effect=lambda: self.now), patch('time.sleep', side_effect=self._sleep):
+            self.assertEqual(limiters[0].acquire('write'), 0)
+            self.assertEqual(limiters[1].acquire('write'), 0)
+            self.assertAlmostEqual(limiters[0].acquire('write'), 0.5)  # per-second bucket refills at 2/s
+            self.assertAlmostEqual(limiters[1].acquire('write'), 19.5)  # per-minute bucket refills at 3/min
+            self.assertEqual(limiters[0].acquire('read'), 0)  # no limits configured
+
+    def test_acquire_refill(self):
+        limiter = self.limiter_class(self.path, {'read': [(10, 1)]})
+        with patch('time.time', side_effect=lambda: self.now), patch('time.sleep', side_effect=self._sleep):
+            self.assertEqual(sum(limiter.acquire('read') for _ in range(10)), 0)
+            self.now += 10
+            self.assertEqual(sum(limiter.acquire('read') for _ in range(10)), 0)
+            self.assertAlmostEqual(limiter.acquire('read'), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
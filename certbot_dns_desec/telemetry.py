@@ -0,0 +1,104 @@
+"""Latency and request metrics of a run, exported as JSON summary or OpenMetrics text file."""
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Collects latency histograms per phase and counters for API requests, and exports them as JSON summary or
+    as OpenMetrics text file (e.g. for the node_exporter textfile collector).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    PREFIX = "certbot_dns_desec"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # phase -> [bucket counts..., +Inf count], sum, max
+        self.requests = {}  # (operation, status) -> count
+        self.counters = {}  # name -> value
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(phase, {'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0,
+                                                           'max': 0})
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - begin)
+
+    def observe_request(self, operation, status, seconds):
+        self.observe(f"api_{operation}", seconds)
+        with self.lock:
+            self.requests[operation, status] = self.requests.get((operation, status), 0) + 1
+
+    def add(self, counter, value=1):
+        if value:
+            with self.lock:
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                'phases': {
+                    phase: {'count': sum(h['buckets']), 'sum': h['sum'], 'max': h['max']}
+                    for phase, h in self.histograms.items()
+                },
+                'requests': [
+                    {'operation': operation, 'status': status, 'count': count}
+                    for (operation, status), count in sorted(self.requests.items(), key=str)
+                ],
+                'counters': dict(self.counters),
+            }
+
+    def openmetrics(self):
+        lines = []
+        with self.lock:
+            name = f"{self.PREFIX}_duration_seconds"
+            lines += [f"# TYPE {name} histogram", f"# HELP {name} Duration of the plugin's phases and API requests."]
+            for phase, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram["sum"]}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {cumulative}')
+            name = f"{self.PREFIX}_api_requests"
+            lines += [f"# TYPE {name} counter", f"# HELP {name} deSEC API requests by operation and status code."]
+            for (operation, status), count in sorted(self.requests.items(), key=str):
+                lines.append(f'{name}_total{{operation="{operation}",status="{status}"}} {count}')
+            for counter, value in sorted(self.counters.items()):
+                name = f"{self.PREFIX}_{counter}"
+                lines += [f"# TYPE {name} counter", f"{name}_total {value}"]
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, openmetrics_path=None):
+        for path, content in [(json_path, lambda: json.dumps(self.summary(), indent=2)),
+                              (openmetrics_path, self.openmetrics)]:
+            if not path:
+                continue
+            # write atomically, so that collectors never see partial files
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(content())
+                filesystem.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning("Could not write metrics to %s: %s", path, e)
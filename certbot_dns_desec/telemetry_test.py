@@ -0,0 +1,57 @@
+"""Tests for certbot_dns_desec.telemetry."""
+
+import unittest
+from unittest.mock import patch
+
+from certbot.compat import os
+from certbot.tests import util as test_util
+
+from certbot_dns_desec import telemetry
+
+
+class MetricsTest(test_util.TempDirTestCase):
+    def test_export(self):
+        metrics = telemetry.Metrics()
+        metrics.observe_request('rrset_write', 200, 0.2)
+        metrics.observe_request('rrset_write', 429, 0.01)
+        metrics.observe_request('rrset_write', 200, 0.3)
+        metrics.add('retry_wait_seconds', 2)
+        metrics.add('retry_wait_seconds', 0)
+        metrics.add('skipped_writes', 0)
+        with patch('time.perf_counter', side_effect=[10, 12.5]):
+            with metrics.timer('propagation_wait'):
+                pass
+
+        self.assertEqual(metrics.summary(), {
+            'phases': {
+                'api_rrset_write': {'count': 3, 'sum': 0.51, 'max': 0.3},
+                'propagation_wait': {'count': 1, 'sum': 2.5, 'max': 2.5},
+            },
+            'requests': [
+                {'operation': 'rrset_write', 'status': 200, 'count': 2},
+                {'operation': 'rrset_write', 'status': 429, 'count': 1},
+            ],
+            'counters': {'retry_wait_seconds': 2},
+        })
+
+        textfile = metrics.openmetrics()
+        for line in [
+            'certbot_dns_desec_duration_seconds_bucket{phase="api_rrset_write",le="0.01"} 1',
+            'certbot_dns_desec_duration_seconds_bucket{phase="api_rrset_write",le="0.25"} 2',
+            'certbot_dns_desec_duration_seconds_bucket{phase="api_rrset_write",le="+Inf"} 3',
+            'certbot_dns_desec_duration_seconds_bucket{phase="propagation_wait",le="2.5"} 1',
+            'certbot_dns_desec_duration_seconds_count{phase="propagation_wait"} 1',
+            'certbot_dns_desec_api_requests_total{operation="rrset_write",status="429"} 1',
+            'certbot_dns_desec_retry_wait_seconds_total 2',
+        ]:
+            self.assertIn(line + "\n", textfile)
+
+        path = os.path.join(self.tempdir, "metrics.prom")
+        metrics.write(openmetrics_path=path)
+        with open(path) as f:
+            self.assertEqual(f.read(), textfile)
+        self.assertEqual(os.listdir(self.tempdir), ["metrics.prom"])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,81 @@
+"""Challenge TXT records and the changes applied to them, shared by the plugin and the standalone entry points."""
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+# ACME dns-01 validations are base64url encoded SHA-256 digests, quoted as TXT records
+VALIDATION = re.compile(r'^"[A-Za-z0-9_-]{43}"$')
+
+# names of the set operations applied to TXT RRsets, as exchanged with other processes
+ACTIONS = {set.union: 'add', set.difference: 'remove'}
+OPERATORS = {action: set_operator for set_operator, action in ACTIONS.items()}
+
+
+def fqdn(subname, zone_name):
+    return f"{subname}.{zone_name}" if subname else zone_name
+
+
+def relative_name(qname, zone_name):
+    return qname.rsplit(zone_name, 1)[0].rstrip('.')
+
+
+def merge_rrsets(records, changes, prune_stale=None, live=None):
+    """
+    Applies changes to the current TXT records of several subnames.
+
+    :param records: mapping of subname to its current set of TXT records
+    :param changes: mapping of subname to a list of ``(set_operator, values)`` to apply in order
+    :param prune_stale: if not None, the number of stale validations to keep per subname, i.e. of values that look
+        like ACME validations but are neither added by ``changes`` nor ``live``; the others are dropped
+    :param live: mapping of subname to validations that are still in use, see `locking.RRsetLocks.live_validations`
+    :return: mapping of subname to the new set of TXT records, for the subnames whose records changed
+    """
+    rrsets = {}
+    for subname, operations in changes.items():
+        merged = records[subname]
+        for set_operator, values in operations:
+            merged = set_operator(merged, values)
+        if prune_stale is not None:
+            added = set().union(*(values for set_operator, values in operations if set_operator is set.union))
+            added |= (live or {}).get(subname, set())
+            stale = sorted(value for value in merged if value not in added and VALIDATION.match(value))
+            if len(stale) > prune_stale:
+                logger.info("Pruning %d stale validation(s) from %s", len(stale) - prune_stale, subname or '@')
+                merged = merged.difference(stale[prune_stale:])
+        if merged != records[subname]:
+            rrsets[subname] = merged
+    return rrsets
+
+
+def group_by_zone(challenges, zones_by_qname):
+    """
+    Groups ``(validation_name, validation)`` tuples by the zone responsible for them.
+
+    :return: mapping of zone name to zone, and mapping of zone name to subname to the (quoted) validation values
+    """
+    zones = {}
+    validations = {}
+    for validation_name, validation in challenges:
+        zone = zones_by_qname[validation_name]
+        zones[zone['name']] = zone
+        subname = relative_name(validation_name, zone['name'])
+        validations.setdefault(zone['name'], {}).setdefault(subname, set()).add(f'"{validation}"')
+    return zones, validations
+
+
+class TXTRecords(set):
+    """
+    TXT records (in presentation format) of an RRset, together with its TTL.
+
+    The TTL is that of the RRset as read from the API (None if it does not exist) or the one to write it with (None
+    for the zone's minimum TTL). Set operations return plain sets, so a merged RRset has no TTL until one is chosen.
+    """
+
+    def __init__(self, records=(), ttl=None):
+        super(TXTRecords, self).__init__(records)
+        self.ttl = ttl
+
+    def __repr__(self):
+        return f"{set(self)!r} (TTL {self.ttl})"
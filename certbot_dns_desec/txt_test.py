@@ -0,0 +1,31 @@
+"""Tests for certbot_dns_desec.txt."""
+
+import unittest
+
+from certbot_dns_desec import txt
+
+
+class MergeRRsetsTest(unittest.TestCase):
+    STALE = ['"' + c * 43 + '"' for c in "abc"]
+
+    def test_merge(self):
+        records = {"a": {'"x"'}, "b": {'"y"'}}
+        changes = {"a": [(set.union, {'"z"'}), (set.difference, {'"x"'})], "b": [(set.union, {'"y"'})]}
+        self.assertEqual(txt.merge_rrsets(records, changes), {"a": {'"z"'}})
+
+    def test_prune_stale(self):
+        fresh = '"' + 'f' * 43 + '"'
+        records = {"a": {'"static"', *self.STALE}}
+        changes = {"a": [(set.union, {fresh})]}
+
+        self.assertEqual(txt.merge_rrsets(records, changes, prune_stale=0), {"a": {'"static"', fresh}})
+        self.assertEqual(txt.merge_rrsets(records, changes, prune_stale=1), {"a": {'"static"', self.STALE[0], fresh}})
+        self.assertEqual(txt.merge_rrsets(records, changes, prune_stale=3), {"a": {'"static"', *self.STALE, fresh}})
+        self.assertEqual(txt.merge_rrsets(records, {"a": [(set.difference, {self.STALE[0]})]}, prune_stale=0),
+                         {"a": {'"static"'}})
+        self.assertEqual(txt.merge_rrsets(records, changes, prune_stale=0, live={"a": {self.STALE[1]}}),
+                         {"a": {'"static"', self.STALE[1], fresh}})
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
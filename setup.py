@@ -31,10 +31,17 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={
+        "async": ["httpx[http2]"],
+    },
     entry_points={
         "certbot.plugins": [
             "dns-desec = certbot_dns_desec.dns_desec:Authenticator"
-        ]
+        ],
+        "console_scripts": [
+            "certbot-dns-desec-daemon = certbot_dns_desec.daemon:main",
+            "certbot-dns-desec-batch = certbot_dns_desec.batch:main",
+        ],
     },
     test_suite="certbot_dns_desec",
 )